@@ -0,0 +1,87 @@
+import os
+
+from starlette.responses import JSONResponse
+
+import metrics
+from db_setup import primary_pool_load
+from ratelimit import route_cost_class
+
+"""
+Admission control: when the database can't keep up, turn requests away right away with 503
+instead of letting them queue in the threadpool until everything times out.
+Full-table lists and search are shed first, lookups only when it gets much worse, writes are always let in.
+The signals are the primary pool (connections in use, average wait for one) and the requests in progress.
+"""
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# Waiting longer than this on average for a database connection means the database is saturated
+ADMISSION_QUEUE_WAIT_SLO_SECONDS = float(os.getenv("ADMISSION_QUEUE_WAIT_SLO_SECONDS", "0.1"))
+# Requests in progress per worker, FastAPI runs at most 40 sync routes at once by default
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+# Share of the primary pool low priority requests may hold at once, the rest is kept free for lookups and writes
+ADMISSION_LOW_PRIORITY_SHARE = float(os.getenv("ADMISSION_LOW_PRIORITY_SHARE", "0.5"))
+
+# Rate limit cost class: priority
+COST_CLASS_PRIORITIES = {
+    "write": "critical",
+    "lookup": "normal",
+    "list": "low",
+    "search": "low",
+    "export": "low",
+}
+
+
+def shed_reason(priority, in_flight):
+    """
+    Returns why a request with this priority should be turned away now, or None to let it in
+    in_flight is the number of requests in progress per priority
+    """
+    if priority == "critical":
+        return None
+    in_use, pool_size, wait_seconds = primary_pool_load()
+    if priority == "low":
+        if wait_seconds > ADMISSION_QUEUE_WAIT_SLO_SECONDS:
+            return "queue_wait"
+        if in_use >= pool_size:
+            return "pool_full"
+        if in_flight["low"] >= max(1, int(pool_size * ADMISSION_LOW_PRIORITY_SHARE)):
+            return "low_priority_share"
+        return None
+    if wait_seconds > 4 * ADMISSION_QUEUE_WAIT_SLO_SECONDS:
+        return "queue_wait"
+    if sum(in_flight.values()) >= ADMISSION_MAX_IN_FLIGHT:
+        return "in_flight"
+    return None
+
+
+class AdmissionMiddleware:
+    """ ASGI middleware, add it with app.add_middleware(AdmissionMiddleware) """
+
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = {"critical": 0, "normal": 0, "low": 0}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        priority = COST_CLASS_PRIORITIES.get(route_cost_class(scope))
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+        reason = shed_reason(priority, self.in_flight)
+        if reason is not None:
+            metrics.increment("admission.shed", priority=priority, reason=reason)
+            response = JSONResponse(
+                {"detail": "The service is overloaded, try again shortly."},
+                status_code=503,
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+        # Only touched from the event loop, so no lock is needed
+        self.in_flight[priority] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight[priority] -= 1
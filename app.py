@@ -1,12 +1,128 @@
+import concurrent.futures
+import hashlib
 import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from datetime import datetime
 
-import psycopg2
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, File, Header, HTTPException, Query, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
 
+import auctions
 import db
-from db_setup import get_connection
+import export
+import media
+import metrics
+from admission import AdmissionMiddleware
+from cache import TTLCache
+from cancellation import CancelOnDisconnectMiddleware
+from compression import CompressionMiddleware
+from ratelimit import RateLimitMiddleware, route_cost_class
+from db_setup import (
+    DEFAULT_STATEMENT_TIMEOUT_MS,
+    READ_YOUR_WRITES_SECONDS,
+    STATEMENT_TIMEOUTS_MS,
+    get_connection,
+    get_read_connection,
+    primary_pool_load,
+    read_from_primary,
+    release_connection,
+    release_request_connections,
+    request_connections,
+    statement_timeout_ms,
+    unit_of_work,
+)
+from responses import FastJSONResponse, dumps
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Every worker settles ended auctions, SKIP LOCKED keeps them from settling the same one.
+    # Winners and sellers get notified, their badges in this worker's cache are dropped once a batch commits
+    if auctions.AUCTION_SCHEDULER_ENABLED:
+        auctions.start_scheduler(on_settled=invalidate_badges)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+# Added last runs first: throttled requests are turned away before anything else happens,
+# then requests are shed if the database is overloaded
+app.add_middleware(CancelOnDisconnectMiddleware)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(RateLimitMiddleware)
+
+# "postgres": list routes that support it get their JSON rendered by Postgres (json_agg) and pass it through as is
+# "python": rows are fetched and serialized in Python
+JSON_RESPONSE_MODE = os.getenv("JSON_RESPONSE_MODE", "python")
+
+
+@app.middleware("http")
+async def return_connections_to_pool(request: Request, call_next):
+    # Every get_connection() during the request is collected here and returned to the pool afterwards
+    connections = []
+    token = request_connections.set(connections)
+    # Clients that wrote recently read from the primary, so they don't miss their own changes on a lagging replica
+    primary_until = request.cookies.get("read_primary_until", "0")
+    primary_token = read_from_primary.set(
+        primary_until.replace(".", "", 1).isdigit() and float(primary_until) > time.time()
+    )
+    # Searches and full lists get less time on the database than lookups and writes
+    timeout_token = statement_timeout_ms.set(
+        STATEMENT_TIMEOUTS_MS.get(route_cost_class(request.scope), DEFAULT_STATEMENT_TIMEOUT_MS)
+    )
+    try:
+        response = await call_next(request)
+    finally:
+        statement_timeout_ms.reset(timeout_token)
+        read_from_primary.reset(primary_token)
+        request_connections.reset(token)
+        release_request_connections(connections)
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        response.set_cookie(
+            "read_primary_until",
+            f"{time.time() + READ_YOUR_WRITES_SECONDS:.3f}",
+            max_age=int(READ_YOUR_WRITES_SECONDS) + 1,
+            httponly=True,
+        )
+    return response
+
+
+# Unread badge counts, deleted whenever the counts change for a user
+badges_cache = TTLCache(ttl_seconds=float(os.getenv("BADGES_CACHE_SECONDS", "5")))
+
+
+def invalidate_badges(user_ids):
+    for user_id in user_ids:
+        badges_cache.delete(user_id)
+
+
+def run_idempotent(connection, scope, idempotency_key, params, create, status_code=201):
+    """
+    Runs create(connection) once per Idempotency-Key, retries with the same key get the stored response back
+    Without a key create() simply runs
+    """
+    if idempotency_key is None:
+        return create(connection)
+    request_hash = hashlib.sha256(dumps(params)).hexdigest()
+    # Claim, write and stored response commit together: a duplicate arriving meanwhile waits on the claim
+    # and then gets the stored response, and nothing is left behind if the write fails
+    with unit_of_work(connection) as transaction:
+        stored = db.claim_idempotency_key(transaction, scope, idempotency_key, request_hash)
+        if stored is None:
+            result = create(transaction)
+            db.save_idempotent_response(transaction, scope, idempotency_key, status_code, result)
+            return result
+    if stored["request_hash"] != request_hash:
+        raise HTTPException(
+            status_code=422, detail="Idempotency-Key was already used with different parameters."
+        )
+    metrics.increment("idempotency.replayed", scope=scope)
+    return FastJSONResponse(
+        stored["response"], status_code=stored["status_code"], headers={"Idempotent-Replayed": "true"}
+    )
 
-app = FastAPI()
 
 """
 Endpoints for FastAPI
@@ -108,28 +224,111 @@ def delete_user(user_id: int):
 # Transactions
 @app.post("/transactions", status_code=201)
 def create_transaction(
-    user_id: int, listing_id: int, amount: int, status: str, bid_id: int = None
+    user_id: int,
+    listing_id: int,
+    amount: int,
+    status: str,
+    bid_id: int = None,
+    idempotency_key: str = Header(None, max_length=255),
 ):
     try:
         connection = get_connection()
-        new_transaction = db.create_transaction(
-            connection, user_id, listing_id, amount, status, bid_id
+        new_transaction = run_idempotent(
+            connection,
+            "POST /transactions",
+            idempotency_key,
+            {"user_id": user_id, "listing_id": listing_id, "amount": amount, "status": status, "bid_id": bid_id},
+            lambda transaction: db.create_transaction(transaction, user_id, listing_id, amount, status, bid_id),
         )
         return new_transaction
+    except HTTPException:
+        raise
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
-@app.get("/transactions")
+@app.post("/checkout", status_code=201)
+def checkout(
+    buyer_id: int,
+    listing_id: int,
+    payment_method: str,
+    shipping_method: str,
+    shipping_cost: float,
+    estimated_delivery_days: int = None,
+    idempotency_key: str = Header(None, max_length=255),
+):
+    def buy(transaction):
+        purchase = db.checkout(
+            transaction,
+            buyer_id,
+            listing_id,
+            payment_method,
+            shipping_method,
+            shipping_cost,
+            estimated_delivery_days
+        )
+        # Raised inside the unit of work so a retry with the same Idempotency-Key is checked again
+        if purchase is None:
+            raise HTTPException(status_code=409, detail="The listing is not for sale any more.")
+        return purchase
+
+    try:
+        connection = get_connection()
+        purchase = run_idempotent(
+            connection,
+            "POST /checkout",
+            idempotency_key,
+            {
+                "buyer_id": buyer_id,
+                "listing_id": listing_id,
+                "payment_method": payment_method,
+                "shipping_method": shipping_method,
+                "shipping_cost": shipping_cost,
+                "estimated_delivery_days": estimated_delivery_days,
+            },
+            buy,
+        )
+        # After the unit of work has committed, a badges read in between would cache the old counts again
+        badges_cache.delete(purchase["seller_id"])
+        return purchase
+    except HTTPException:
+        raise
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/transactions", response_class=FastJSONResponse)
 def get_all_transactions():
     try:
         connection = get_connection()
         all_transactions = db.get_all_transactions(connection)
-        return all_transactions
+        return FastJSONResponse(all_transactions)
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong {error}")
 
 
+def export_response(table, file_format, start, end, status):
+    """ Streams an export as a file download """
+    try:
+        chunks = export.stream_export(table, file_format, start, end, status)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    extension = "arrows" if file_format == "arrow" else file_format
+    return StreamingResponse(
+        chunks,
+        media_type=export.EXPORT_FORMATS[file_format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{extension}"'},
+    )
+
+
+@app.get("/transactions/export")
+def export_transactions(
+    format: str = "csv", start: datetime = None, end: datetime = None, status: str = None
+):
+    # start is inclusive, end exclusive, both compared to created_at
+    return export_response("transactions", format, start, end, status)
+
+
 @app.get("/transactions/{transaction_id}")
 def get_transaction_by_id(transaction_id: int):
     try:
@@ -172,16 +371,17 @@ def create_notification(
         new_notification = db.create_notification(
             connection, user_id, listing_id, notification_type, notification_message
         )
+        badges_cache.delete(user_id)
         return new_notification
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
 @app.get("/notifications/{user_id}")
-def get_notifications_by_user_id(user_id: int):
+def get_notifications_by_user_id(user_id: int, days: int = db.RECENT_WINDOW_DAYS):
     try:
         connection = get_connection()
-        notifications = db.get_notifications_by_user_id(connection, user_id)
+        notifications = db.get_notifications_by_user_id(connection, user_id, days)
         return notifications
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
@@ -198,11 +398,32 @@ def get_unread_notifications(user_id: int):
 
 
 @app.put("/notifications/mark-read")
-def mark_notifications_as_read(user_id: int):
+def mark_notifications_as_read(
+    user_id: int,
+    notification_ids: list[int] = Query(None),
+    up_to_id: int = None,
+    up_to: datetime | None = None,
+):
     try:
         connection = get_connection()
-        marked_notifications = db.mark_all_notifications_as_read(connection, user_id)
-        return marked_notifications
+        # Without ids or limits every unread notification for the user is marked
+        marked_count = db.mark_notifications_as_read(
+            connection, user_id, notification_ids, up_to_id, up_to
+        )
+        badges_cache.delete(user_id)
+        return {"marked_as_read": marked_count}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.put("/notifications/read-watermark")
+def set_notification_read_watermark(user_id: int, up_to_id: int):
+    try:
+        connection = get_connection()
+        # Moves the user's watermark instead of updating every notification row
+        watermark = db.set_notification_read_watermark(connection, user_id, up_to_id)
+        badges_cache.delete(user_id)
+        return watermark
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
@@ -212,11 +433,46 @@ def delete_notification(notification_id: int):
     try:
         connection = get_connection()
         deleted_notification = db.delete_notification(connection, notification_id)
+        if deleted_notification is not None:
+            badges_cache.delete(deleted_notification["user_id"])
         return deleted_notification
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
+@app.get("/users/{user_id}/badges")
+def get_user_badges(user_id: int):
+    try:
+        # Badges are polled often, serve them from the cache when possible
+        badges = badges_cache.get(user_id)
+        if badges is None:
+            connection = get_connection()
+            badges = db.get_user_badges(connection, user_id)
+            badges_cache.set(user_id, badges)
+        return badges
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/users/{user_id}/feed")
+def get_user_feed(
+    user_id: int,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    fields: str = None,
+):
+    try:
+        connection = get_read_connection()
+        feed = db.get_user_feed(connection, user_id, offset, limit, fields)
+        # Pass offset + limit as "offset" to get the next page,
+        # a page can be shorter than limit when listings were sold since the feed was worked out
+        return {"listings": feed}
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
 # Shipping_details
 @app.post("/shipping-details", status_code=201)
 def create_shipping_details(
@@ -287,7 +543,10 @@ def create_listing_comment(user_id: int, listing_id: int, comment_text: str):
 @app.get("/listing_comments/{listing_id}")
 def get_comments_by_listing_id(listing_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
+        if JSON_RESPONSE_MODE == "postgres":
+            comments_json = db.get_comments_by_listing_id_json(connection, listing_id)
+            return Response(comments_json, media_type="application/json")
         comment_by_listing = db.get_comments_by_listing_id(connection, listing_id)
         return comment_by_listing
     except Exception as error:
@@ -328,7 +587,7 @@ def delete_listing_comment(comment_id: int):
 @app.get("/categories")
 def get_all_categories():
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         categories = db.get_all_categories(connection)
         return categories
     except Exception as error:
@@ -338,7 +597,7 @@ def get_all_categories():
 @app.get("/categories/{category_id}")
 def get_category_by_id(category_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         category_by_id = db.get_category_by_id(connection, category_id)
         if category_by_id is None:
             raise HTTPException(status_code=404, detail="Category not found.")
@@ -359,7 +618,8 @@ def create_listing(
     price: float,
     region: str,
     description: str,
-    image_url: str = None
+    image_url: str = None,
+    ends_at: datetime = None
 ):
     try:
         connection = get_connection()
@@ -372,29 +632,97 @@ def create_listing(
             price,
             region,
             description,
-            image_url
+            image_url,
+            ends_at
         )
         return new_listing
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
-@app.get("/listings")
-def get_all_listings():
+@app.get("/listings", response_class=FastJSONResponse)
+def get_all_listings(compact: bool = False, fields: str = None):
     try:
-        connection = get_connection()
-        all_listings = db.get_all_listings(connection)
-        return {"listings": all_listings}
+        connection = get_read_connection()
+        if JSON_RESPONSE_MODE == "postgres" and not compact:
+            return Response(db.get_all_listings_json(connection, fields), media_type="application/json")
+        # compact=true returns {"columns": [...], "rows": [[...]]} instead of one object per listing
+        all_listings = db.get_all_listings(connection, compact, fields)
+        # Returning the response directly skips jsonable_encoder
+        return FastJSONResponse({"listings": all_listings})
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
 @app.get("/listings/search")
-def search_listings(search_term: str):
+def search_listings(search_term: str, fields: str = None):
     try:
-        connection = get_connection()
-        searched_listings = db.search_listings(connection, search_term)
+        connection = get_read_connection()
+        searched_listings = db.search_listings(connection, search_term, fields)
         return searched_listings
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/listings/browse")
+def browse_listings(
+    category_id: int = None,
+    region: str = None,
+    listing_type: str = None,
+    status: str = "active",
+    min_price: float = None,
+    max_price: float = None,
+    sort: str = "newest",
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    fields: str = None,
+):
+    try:
+        connection = get_read_connection()
+        browsed_listings = db.browse_listings(
+            connection,
+            category_id,
+            region,
+            listing_type,
+            status,
+            min_price,
+            max_price,
+            sort,
+            limit,
+            offset,
+            fields
+        )
+        facets = db.get_listing_facets(connection, category_id, region, listing_type, status)
+        return {"listings": browsed_listings, "facets": facets}
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/listings/nearby")
+def get_nearby_listings(
+    latitude: float = Query(ge=-90, le=90),
+    longitude: float = Query(ge=-180, le=180),
+    radius_km: float = Query(50, gt=0, le=1000),
+    limit: int = Query(20, ge=1, le=100),
+    after_region_id: int = None,
+    after_id: int = None,
+    fields: str = None,
+):
+    try:
+        connection = get_read_connection()
+        nearby_listings = db.get_nearby_listings(
+            connection, latitude, longitude, radius_km, limit, after_region_id, after_id, fields
+        )
+        # Pass region_id and id of the last listing as "after_region_id" and "after_id" to get the next page
+        return {"listings": nearby_listings}
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
@@ -402,7 +730,7 @@ def search_listings(search_term: str):
 @app.get("/listings/{listing_id}")
 def get_listing_by_id(listing_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         listing_by_id = db.get_listing_by_id(connection, listing_id)
         if listing_by_id is None:
             raise HTTPException(status_code=404, detail="Listing not found.")
@@ -464,12 +792,26 @@ def delete_listing(listing_id: int):
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
+@app.get("/listings/{listing_id}/similar")
+def get_similar_listings(listing_id: int, limit: int = Query(10, ge=1, le=20), fields: str = None):
+    try:
+        connection = get_read_connection()
+        similar_listings = db.get_similar_listings(connection, listing_id, limit, fields)
+        return {"listings": similar_listings}
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
 @app.get("/listings/categories/{category_id}")
-def get_listings_by_category(category_id: int):
+def get_listings_by_category(category_id: int, fields: str = None):
     try:
-        connection = get_connection()
-        listings_by_category = db.get_listings_by_category(connection, category_id)
+        connection = get_read_connection()
+        listings_by_category = db.get_listings_by_category(connection, category_id, fields)
         return listings_by_category
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
@@ -519,42 +861,84 @@ def create_message(
     sender_id: int,
     recipent_id: int,
     listing_id: int,
-    message_text: str
+    message_text: str,
+    idempotency_key: str = Header(None, max_length=255),
 ):
     try:
         connection = get_connection()
-        new_message = db.create_message(
+        new_message = run_idempotent(
             connection,
-            sender_id,
-            recipent_id,
-            listing_id,
-            message_text
+            "POST /messages",
+            idempotency_key,
+            {"sender_id": sender_id, "recipent_id": recipent_id, "listing_id": listing_id, "message_text": message_text},
+            lambda transaction: db.create_message(transaction, sender_id, recipent_id, listing_id, message_text),
         )
+        badges_cache.delete(recipent_id)
         return new_message
+    except HTTPException:
+        raise
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
-@app.get("/messages")
+@app.get("/messages", response_class=FastJSONResponse)
 def get_all_messages():
     try:
         connection = get_connection()
         all_messages = db.get_all_messages(connection)
-        return {"messages": all_messages}
+        return FastJSONResponse({"messages": all_messages})
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
 @app.get("/users/{user_id}/messages")
-def get_user_messages(user_id: int):
+def get_user_messages(user_id: int, days: int = db.RECENT_WINDOW_DAYS):
     try:
         connection = get_connection()
-        user_messages = db.get_all_user_messages(connection, user_id)
+        user_messages = db.get_all_user_messages(connection, user_id, days)
         return {"messages": user_messages}
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
+# Conversations
+@app.get("/users/{user_id}/conversations")
+def get_user_conversations(user_id: int, before: str = None, limit: int = 20):
+    try:
+        connection = get_connection()
+        conversations = db.get_user_conversations(connection, user_id, before, limit)
+        # Pass the last_message_at of the last row as "before" to get the next page
+        return {"conversations": conversations}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/conversations/{conversation_id}/messages")
+def get_conversation_messages(conversation_id: int, before_id: int = None, limit: int = 50):
+    try:
+        connection = get_connection()
+        conversation_messages = db.get_conversation_messages(
+            connection, conversation_id, before_id, limit
+        )
+        # Pass the id of the last message as "before_id" to get the next page
+        return {"messages": conversation_messages}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.put("/conversations/{conversation_id}/read")
+def mark_conversation_as_read(conversation_id: int, user_id: int):
+    try:
+        connection = get_connection()
+        marked_count = db.mark_conversation_as_read(connection, conversation_id, user_id)
+        badges_cache.delete(user_id)
+        return {"marked_as_read": marked_count}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
 @app.get("/messages/{message_id}")
 def get_message_by_id(message_id: int):
     try:
@@ -576,6 +960,7 @@ def delete_message(message_id: int):
         deleted_message = db.delete_message(connection, message_id)
         if deleted_message is None:
             raise HTTPException(status_code=404, detail="Message not found.")
+        badges_cache.delete(deleted_message["recipient_id"])
         return {"message": f"Message with id {message_id} deleted."}
     except HTTPException:
         raise
@@ -590,27 +975,30 @@ def create_payment(
     listing_id: int,
     payment_method: str,
     amount: float,
+    idempotency_key: str = Header(None, max_length=255),
 ):
     try:
         connection = get_connection()
-        new_payment = db.create_payment(
+        new_payment = run_idempotent(
             connection,
-            transaction_id,
-            listing_id,
-            payment_method,
-            amount
+            "POST /payments",
+            idempotency_key,
+            {"transaction_id": transaction_id, "listing_id": listing_id, "payment_method": payment_method, "amount": amount},
+            lambda transaction: db.create_payment(transaction, transaction_id, listing_id, payment_method, amount),
         )
         return new_payment
+    except HTTPException:
+        raise
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
-@app.get("/payments")
+@app.get("/payments", response_class=FastJSONResponse)
 def get_all_payments():
     try:
         connection = get_connection()
         all_payments = db.get_all_payments(connection)
-        return {"payments": all_payments}
+        return FastJSONResponse({"payments": all_payments})
     except HTTPException as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
@@ -625,6 +1013,14 @@ def get_user_payments(user_id: int):
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
+@app.get("/payments/export")
+def export_payments(
+    format: str = "csv", start: datetime = None, end: datetime = None, status: str = None
+):
+    # start is inclusive, end exclusive, both compared to paid_at
+    return export_response("payments", format, start, end, status)
+
+
 @app.get("/payments/{payment_id}")
 def get_payment_by_id(payment_id: int):
     try:
@@ -669,22 +1065,38 @@ def delete_payment(payment_id: int):
 
 # Bids
 @app.post("/bids", status_code=201)
-def create_bid(user_id: int, listing_id: int, amount: float):
+def create_bid(
+    user_id: int, listing_id: int, amount: float, idempotency_key: str = Header(None, max_length=255)
+):
+    def place_bid(transaction):
+        new_bid = db.create_bid(transaction, user_id, listing_id, amount)
+        # Raised inside the unit of work so a retry with the same Idempotency-Key is checked again
+        if new_bid is None:
+            raise HTTPException(status_code=409, detail="The listing doesn't take bids any more.")
+        return new_bid
+
     try:
         connection = get_connection()
-        new_bid = db.create_bid(
-            connection, user_id, listing_id, amount) 
+        new_bid = run_idempotent(
+            connection,
+            "POST /bids",
+            idempotency_key,
+            {"user_id": user_id, "listing_id": listing_id, "amount": amount},
+            place_bid,
+        )
         return new_bid
+    except HTTPException:
+        raise
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
-@app.get("/bids")
-def get_all_bids():
+@app.get("/bids", response_class=FastJSONResponse)
+def get_all_bids(compact: bool = False):
     try:
         connection = get_connection()
-        all_bids = db.get_all_bids(connection)
-        return {"bids": all_bids}
+        all_bids = db.get_all_bids(connection, compact)
+        return FastJSONResponse({"bids": all_bids})
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
@@ -706,7 +1118,10 @@ def get_bid_by_id(bid_id: int):
 @app.get("/listings/{listing_id}/bids")
 def get_bids_for_listing(listing_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
+        if JSON_RESPONSE_MODE == "postgres":
+            bids_json = db.get_bids_for_listing_json(connection, listing_id)
+            return Response(bids_json, media_type="application/json")
         bids_for_listing = db.get_bids_for_listing(connection, listing_id)
         return {"bids": bids_for_listing}  # If a listing has no bids it returns an empty list
     except Exception as error:
@@ -742,7 +1157,7 @@ def create_user_rating(
 @app.get("/user-ratings")
 def get_all_user_ratings():
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         all_ratings = db.get_all_user_ratings(connection)
         return {"ratings": all_ratings}
     except Exception as error:
@@ -752,7 +1167,7 @@ def get_all_user_ratings():
 @app.get("/users/{user_id}/rating")
 def get_user_rating(user_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         user_rating = db.get_user_rating_by_user_id(connection, user_id)
         if user_rating is None:
             raise HTTPException(status_code=404, detail="Rating not found.")
@@ -822,7 +1237,7 @@ def create_review(
 @app.get("/reviews")
 def get_all_reviews():
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         all_reviews = db.get_all_reviews(connection)
         return {"reviews": all_reviews}
     except Exception as error:
@@ -832,7 +1247,7 @@ def get_all_reviews():
 @app.get("/reviews/{review_id}")
 def get_review(review_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         review_by_id = db.get_review_by_id(connection, review_id)
         if review_by_id is None:
             raise HTTPException(status_code=404, detail="Review not found.")
@@ -846,7 +1261,7 @@ def get_review(review_id: int):
 @app.get("/users/{user_id}/reviews")
 def get_reviews_for_user(user_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         reviews_for_user = db.get_reviews_for_user(connection, user_id)
         return {"reviews": reviews_for_user}
     except Exception as error:
@@ -943,6 +1358,46 @@ def create_image(user_id: int, listing_id: int, image_url: str):
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
 
 
+@app.post("/images/upload", status_code=201)
+def upload_image(user_id: int, listing_id: int, file: UploadFile = File(...)):
+    if not media.IMAGE_UPLOADS_ENABLED:
+        raise HTTPException(status_code=503, detail="Image uploads need Pillow, install it with pip install pillow.")
+    try:
+        # Checked before the file is stored, so a missing user or listing leaves no files behind
+        connection = get_connection()
+        found = db.user_and_listing_exist(connection, user_id, listing_id)
+        # Processing can take IMAGE_PROCESS_TIMEOUT_SECONDS, the pool shouldn't be waiting on it
+        release_connection(connection)
+        if not found:
+            raise HTTPException(status_code=404, detail="User or listing not found.")
+        stored = media.ingest_image(file.file)
+        connection = get_connection()
+        new_image = db.create_uploaded_image(
+            connection, user_id, listing_id, stored["original"], stored["hash"], stored["thumbnails"]["small"]
+        )
+        # Deleted while the image was processed, the stored files are shared by hash with later uploads
+        if new_image is None:
+            raise HTTPException(status_code=404, detail="User or listing not found.")
+        return dict(new_image, thumbnails=stored["thumbnails"])
+    except HTTPException:
+        raise
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except (concurrent.futures.TimeoutError, BrokenProcessPool):
+        raise HTTPException(status_code=503, detail="Images can't be processed right now, try again later.")
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/media/{variant}/{filename}")
+async def get_media(variant: str, filename: str, request: Request):
+    # async: hot thumbnails come from memory, without a trip to the threadpool
+    response = await media.media_response(variant, filename, request.headers)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Image not found.")
+    return response
+
+
 @app.get("/images")
 def get_all_images():
     try:
@@ -970,7 +1425,7 @@ def get_image(image_id: int):
 @app.get("/listings/{listing_id}/images")
 def get_images_for_listing(listing_id: int):
     try:
-        connection = get_connection()
+        connection = get_read_connection()
         images_for_listing = db.get_images_for_listing(connection, listing_id)
         return {"images": images_for_listing}
     except Exception as error:
@@ -989,3 +1444,56 @@ def delete_image(image_id: int):
         raise
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+# Stats
+@app.get("/stats/listings")
+def get_listing_stats(days: int = 30, category_id: int = None, region: str = None):
+    try:
+        connection = get_read_connection()
+        listing_stats = db.get_daily_listing_stats(connection, days, category_id, region)
+        return {"listings_per_day": listing_stats}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/stats/listings/active")
+def get_active_listing_stats():
+    try:
+        connection = get_read_connection()
+        active_listings = db.get_active_listing_counts(connection)
+        return {"active_listings": active_listings}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/stats/transactions")
+def get_transaction_stats(days: int = 30):
+    try:
+        connection = get_read_connection()
+        transaction_stats = db.get_daily_transaction_stats(connection, days)
+        transaction_totals = db.get_transaction_totals(connection, days)
+        return {"totals": transaction_totals, "transactions_per_day": transaction_stats}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+@app.get("/stats/payments")
+def get_payment_stats(days: int = 30):
+    try:
+        connection = get_read_connection()
+        payment_stats = db.get_daily_payment_stats(connection, days)
+        return {"payments_per_day": payment_stats}
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f"Something went wrong: {error}")
+
+
+# Metrics
+@app.get("/metrics")
+def get_metrics():
+    # Counters and timings of this worker process
+    in_use, pool_size, wait_seconds = primary_pool_load()
+    return {
+        **metrics.snapshot(),
+        "primary_pool": {"in_use": in_use, "size": pool_size, "recent_wait_seconds": wait_seconds},
+    }
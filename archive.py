@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+
+import metrics
+from db_setup import get_connection
+
+"""
+Moves soft deleted listings and users to archived_rows once they have been deleted for ARCHIVE_AFTER_DAYS.
+Everything that refers to them (bids, images, messages, transactions, ...) is moved along with them,
+children before parents so no foreign key is ever broken.
+Work is done in batches of ARCHIVE_BATCH_SIZE listings or users, one short transaction per batch,
+so only the rows being moved are locked. Batches are claimed with FOR UPDATE SKIP LOCKED.
+
+Meant to run from cron or as its own process:
+Run once: python archive.py
+Run every ARCHIVE_POLL_SECONDS: python archive.py loop
+"""
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))
+ARCHIVE_POLL_SECONDS = float(os.getenv("ARCHIVE_POLL_SECONDS", "300"))
+
+# Deleted rows that are due, users only once their listings have been archived
+CLAIM_BATCH = {
+    "listings": """
+        SELECT id FROM listings
+        WHERE deleted_at < LOCALTIMESTAMP - make_interval(days => %s)
+        ORDER BY deleted_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED;
+    """,
+    "users": """
+        SELECT id FROM users u
+        WHERE deleted_at < LOCALTIMESTAMP - make_interval(days => %s)
+        AND NOT EXISTS (SELECT 1 FROM listings l WHERE l.user_id = u.id)
+        ORDER BY deleted_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED;
+    """,
+}
+
+# Table and which of its rows go with the claimed ids, in the order they have to be moved
+ARCHIVE_STEPS = {
+    "listings": [
+        ("payments", """listing_id = ANY(%(ids)s) OR transaction_id IN (
+            SELECT id FROM transactions WHERE listing_id = ANY(%(ids)s)
+            OR bid_id IN (SELECT id FROM bids WHERE listing_id = ANY(%(ids)s)))"""),
+        ("transactions", """listing_id = ANY(%(ids)s)
+            OR bid_id IN (SELECT id FROM bids WHERE listing_id = ANY(%(ids)s))"""),
+        ("bids", "listing_id = ANY(%(ids)s)"),
+        ("images", "listing_id = ANY(%(ids)s)"),
+        ("reviews", "listing_id = ANY(%(ids)s)"),
+        ("reports", "listing_id = ANY(%(ids)s)"),
+        ("listing_comments", "listing_id = ANY(%(ids)s)"),
+        ("listings_watch_list", "listing_id = ANY(%(ids)s)"),
+        ("shipping_details", "listing_id = ANY(%(ids)s)"),
+        ("notifications", "listing_id = ANY(%(ids)s)"),
+        ("messages", """listing_id = ANY(%(ids)s)
+            OR conversation_id IN (SELECT id FROM conversations WHERE listing_id = ANY(%(ids)s))"""),
+        ("conversation_participants", """conversation_id IN (
+            SELECT id FROM conversations WHERE listing_id = ANY(%(ids)s))"""),
+        ("conversations", "listing_id = ANY(%(ids)s)"),
+        ("listings", "id = ANY(%(ids)s)"),
+    ],
+    "users": [
+        ("payments", """transaction_id IN (
+            SELECT id FROM transactions WHERE user_id = ANY(%(ids)s)
+            OR bid_id IN (SELECT id FROM bids WHERE user_id = ANY(%(ids)s)))"""),
+        ("transactions", """user_id = ANY(%(ids)s)
+            OR bid_id IN (SELECT id FROM bids WHERE user_id = ANY(%(ids)s))"""),
+        ("bids", "user_id = ANY(%(ids)s)"),
+        ("images", "user_id = ANY(%(ids)s)"),
+        ("reviews", "reviewer_id = ANY(%(ids)s) OR reviewed_user_id = ANY(%(ids)s)"),
+        ("reports", "user_id = ANY(%(ids)s)"),
+        ("listing_comments", "user_id = ANY(%(ids)s)"),
+        ("listings_watch_list", "user_id = ANY(%(ids)s)"),
+        ("shipping_details", "user_id = ANY(%(ids)s)"),
+        ("notifications", "user_id = ANY(%(ids)s)"),
+        ("notification_read_marks", "user_id = ANY(%(ids)s)"),
+        ("user_ratings", "user_id = ANY(%(ids)s)"),
+        ("messages", """sender_id = ANY(%(ids)s) OR recipient_id = ANY(%(ids)s)
+            OR conversation_id IN (
+                SELECT id FROM conversations WHERE user_one_id = ANY(%(ids)s) OR user_two_id = ANY(%(ids)s))"""),
+        ("conversation_participants", """user_id = ANY(%(ids)s) OR conversation_id IN (
+            SELECT id FROM conversations WHERE user_one_id = ANY(%(ids)s) OR user_two_id = ANY(%(ids)s))"""),
+        ("conversations", "user_one_id = ANY(%(ids)s) OR user_two_id = ANY(%(ids)s)"),
+        ("user_counters", "user_id = ANY(%(ids)s)"),
+        ("users", "id = ANY(%(ids)s)"),
+    ],
+}
+
+# Moved rows that were unread still count in user_counters, these take them off again
+UNREAD_COUNTERS = {
+    "notifications": """,
+        unread AS (
+            SELECT m.user_id, COUNT(*) AS unread
+            FROM moved m
+            LEFT JOIN notification_read_marks r ON r.user_id = m.user_id
+            WHERE m.is_read = FALSE AND m.id > COALESCE(r.read_up_to_id, 0)
+            GROUP BY m.user_id
+        ),
+        counters AS (
+            UPDATE user_counters c
+            SET unread_notifications = GREATEST(c.unread_notifications - u.unread, 0)
+            FROM unread u
+            WHERE c.user_id = u.user_id
+        )""",
+    "messages": """,
+        unread AS (
+            SELECT recipient_id AS user_id, COUNT(*) AS unread
+            FROM moved
+            -- Messages to yourself were never counted as unread
+            WHERE is_read = FALSE AND sender_id <> recipient_id
+            GROUP BY recipient_id
+        ),
+        counters AS (
+            UPDATE user_counters c
+            SET unread_messages = GREATEST(c.unread_messages - u.unread, 0)
+            FROM unread u
+            WHERE c.user_id = u.user_id
+        )""",
+}
+
+ARCHIVE_STEP = """
+    WITH moved AS (
+        DELETE FROM {table} WHERE {condition} RETURNING *
+    ),
+    archived AS (
+        INSERT INTO archived_rows (table_name, row_data)
+        SELECT %(table)s, to_jsonb(moved) FROM moved
+    ){counters}
+    SELECT COUNT(*) FROM moved;
+"""
+
+
+def archive_batch(connection, kind, batch_size=ARCHIVE_BATCH_SIZE, after_days=ARCHIVE_AFTER_DAYS):
+    """
+    Archives up to batch_size deleted listings or users (kind) in one transaction
+    Returns how many were archived and how many rows were moved per table
+    """
+    moved = {}
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(CLAIM_BATCH[kind], (after_days, batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return 0, moved
+            for table, condition in ARCHIVE_STEPS[kind]:
+                cursor.execute(
+                    ARCHIVE_STEP.format(
+                        table=table, condition=condition, counters=UNREAD_COUNTERS.get(table, "")
+                    ),
+                    {"ids": ids, "table": table},
+                )
+                moved[table] = cursor.fetchone()[0]
+    return len(ids), moved
+
+
+def archive_deleted(connection, batch_size=ARCHIVE_BATCH_SIZE, after_days=ARCHIVE_AFTER_DAYS):
+    """ Archives batches until no deleted listings or users are due, returns the rows moved per table """
+    total = {}
+    # Listings first, a user is only archived once all of their listings are
+    for kind in ("listings", "users"):
+        while True:
+            archived, moved = archive_batch(connection, kind, batch_size, after_days)
+            for table, rows in moved.items():
+                total[table] = total.get(table, 0) + rows
+                metrics.increment("archive.rows", rows, table=table)
+            if archived < batch_size:
+                break
+    return total
+
+
+if __name__ == "__main__":
+    connection = get_connection()
+    try:
+        while True:
+            start = time.perf_counter()
+            moved = archive_deleted(connection)
+            elapsed = time.perf_counter() - start
+            summary = ", ".join(f"{table}: {rows}" for table, rows in moved.items() if rows) or "nothing"
+            print(f"Archived {summary} in {elapsed:.2f}s")
+            if len(sys.argv) < 2 or sys.argv[1] != "loop":
+                break
+            time.sleep(ARCHIVE_POLL_SECONDS)
+    finally:
+        connection.close()
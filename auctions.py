@@ -0,0 +1,155 @@
+import os
+import sys
+import threading
+import time
+
+import metrics
+from db_setup import get_connection
+
+"""
+Settles auctions (listings with ends_at) once they have ended.
+The highest bid wins: it becomes a pending transaction, the listing is marked sold and the winner and seller
+are notified. Auctions without bids are closed and the seller is notified.
+Due auctions are claimed with FOR UPDATE SKIP LOCKED, so any number of schedulers can run side by side.
+A bid holds FOR SHARE on its listing until it commits, so an auction is settled either after the bid
+(on the next poll) or before it, and then the bid is refused: no bid is left out of a settled auction.
+
+The API runs a scheduler thread per worker (AUCTION_SCHEDULER_ENABLED), it can also run on its own:
+Run once: python auctions.py
+Run every AUCTION_POLL_SECONDS: python auctions.py loop
+"""
+
+AUCTION_SCHEDULER_ENABLED = os.getenv("AUCTION_SCHEDULER_ENABLED", "true").lower() == "true"
+AUCTION_POLL_SECONDS = float(os.getenv("AUCTION_POLL_SECONDS", "5"))
+AUCTION_BATCH_SIZE = int(os.getenv("AUCTION_BATCH_SIZE", "500"))
+
+SETTLE_BATCH = """
+    WITH due AS (
+        SELECT id, user_id AS seller_id, title
+        FROM listings
+        WHERE status = 'active' AND deleted_at IS NULL AND ends_at <= LOCALTIMESTAMP
+        ORDER BY ends_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ),
+    winning_bids AS (
+        SELECT DISTINCT ON (b.listing_id) b.id, b.listing_id, b.user_id, b.amount
+        FROM bids b
+        JOIN due d ON d.id = b.listing_id
+        ORDER BY b.listing_id, b.amount DESC, b.created_at ASC
+    ),
+    settled AS (
+        UPDATE listings l
+        SET status = CASE WHEN w.id IS NULL THEN 'closed' ELSE 'sold' END
+        FROM due d
+        LEFT JOIN winning_bids w ON w.listing_id = d.id
+        WHERE l.id = d.id
+        RETURNING l.id
+    ),
+    new_transactions AS (
+        INSERT INTO transactions (user_id, bid_id, listing_id, amount, status)
+        SELECT user_id, id, listing_id, amount, 'pending'
+        FROM winning_bids
+        RETURNING id
+    ),
+    new_notifications AS (
+        INSERT INTO notifications (user_id, listing_id, notification_type, notification_message)
+        SELECT w.user_id, d.id, 'auction_won', 'Du vann auktionen "' || d.title || '"'
+        FROM due d
+        JOIN winning_bids w ON w.listing_id = d.id
+        UNION ALL
+        SELECT d.seller_id, d.id,
+            CASE WHEN w.id IS NULL THEN 'auction_ended' ELSE 'sale_completed' END,
+            CASE WHEN w.id IS NULL THEN 'Din auktion "' || d.title || '" avslutades utan bud'
+                ELSE 'Din auktion "' || d.title || '" har sålts' END
+        FROM due d
+        LEFT JOIN winning_bids w ON w.listing_id = d.id
+        RETURNING user_id
+    ),
+    counters AS (
+        -- One row per user, a user can get several notifications in one batch
+        INSERT INTO user_counters (user_id, unread_notifications, unread_messages)
+        SELECT user_id, COUNT(*), 0
+        FROM new_notifications
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET unread_notifications = user_counters.unread_notifications + EXCLUDED.unread_notifications
+    )
+    SELECT (SELECT COUNT(*) FROM settled), (SELECT COUNT(*) FROM new_transactions),
+        (SELECT COALESCE(array_agg(DISTINCT user_id), '{}') FROM new_notifications);
+"""
+
+
+def settle_batch(connection, batch_size=AUCTION_BATCH_SIZE):
+    """ Settles up to batch_size ended auctions in one transaction, returns (settled, sold, notified user ids) """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(SETTLE_BATCH, (batch_size,))
+            settled, sold, notified_user_ids = cursor.fetchone()
+    return settled, sold, notified_user_ids
+
+
+def settle_due_auctions(connection, batch_size=AUCTION_BATCH_SIZE, on_settled=None):
+    """
+    Settles batches until no ended auctions are left, returns how many were settled
+    on_settled is called with the ids of the notified winners and sellers after each batch has committed
+    """
+    total = 0
+    started = time.perf_counter()
+    while True:
+        settled, sold, notified_user_ids = settle_batch(connection, batch_size)
+        if on_settled is not None and notified_user_ids:
+            on_settled(notified_user_ids)
+        total += settled
+        metrics.increment("auctions.settled", settled - sold, outcome="closed")
+        metrics.increment("auctions.settled", sold, outcome="sold")
+        if settled < batch_size:
+            break
+    if total:
+        elapsed = time.perf_counter() - started
+        metrics.observe("auctions.settled_per_second", total / elapsed)
+    return total
+
+
+def _schedule_forever(on_settled):
+    connection = None
+    while True:
+        try:
+            if connection is None or connection.closed:
+                connection = get_connection()
+            settle_due_auctions(connection, on_settled=on_settled)
+        except Exception as error:
+            metrics.increment("auctions.errors")
+            print(f"Settling auctions failed: {error}", file=sys.stderr)
+            if connection is not None:
+                connection.close()
+            connection = None
+        time.sleep(AUCTION_POLL_SECONDS)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start_scheduler(on_settled=None):
+    """ Starts the background thread that settles auctions, once per process, see settle_due_auctions for on_settled """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = threading.Thread(target=_schedule_forever, args=(on_settled,), daemon=True)
+            _scheduler.start()
+
+
+if __name__ == "__main__":
+    connection = get_connection()
+    try:
+        while True:
+            start = time.perf_counter()
+            settled = settle_due_auctions(connection)
+            elapsed = time.perf_counter() - start
+            print(f"Settled {settled} auctions in {elapsed:.2f}s ({settled / elapsed:.0f}/s)")
+            if len(sys.argv) < 2 or sys.argv[1] != "loop":
+                break
+            time.sleep(AUCTION_POLL_SECONDS)
+    finally:
+        connection.close()
@@ -0,0 +1,123 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from db_setup import get_connection
+
+"""
+Checks load shedding against a real server with a pool of 4 connections while the categories table is locked,
+so every GET /categories gets stuck on the database.
+POST /bids and GET /listings/{id} should keep going through, and the stuck list requests should get 503
+instead of holding the whole pool. Run again with ADMISSION_ENABLED=false to see the writes time out.
+Starts uvicorn itself against the .env database, created bids are deleted again afterwards:
+python benchmarks/admission_shedding.py [seconds]
+"""
+
+PORT = 8091
+LIST_CLIENTS = 12
+WRITE_CLIENTS = 2
+LOOKUP_CLIENTS = 2
+
+
+def start_server():
+    env = dict(
+        os.environ,
+        POOL_MAX_CONNECTIONS="4",
+        RATE_LIMIT_ENABLED="false",
+        AUCTION_SCHEDULER_ENABLED="false",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(PORT), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+    )
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{PORT}/metrics", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The server didn't start")
+
+
+def call(method, path, timeout=15):
+    """ Returns (status, parsed body or None, seconds), status is "timeout" when the client gave up """
+    request = urllib.request.Request(f"http://127.0.0.1:{PORT}{path}", method=method)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read() or b"null"), time.perf_counter() - start
+    except urllib.error.HTTPError as error:
+        return error.code, None, time.perf_counter() - start
+    except OSError:
+        return "timeout", None, time.perf_counter() - start
+
+
+def client(kind, method, path, until, results):
+    while time.monotonic() < until:
+        status, body, elapsed = call(method, path)
+        results.append((kind, status, elapsed, body))
+
+
+def run(seconds):
+    connection = get_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM listings WHERE status = 'active' AND deleted_at IS NULL ORDER BY id LIMIT 1;"
+            )
+            listing_id = cursor.fetchone()[0]
+            cursor.execute("SELECT MIN(id) FROM users WHERE deleted_at IS NULL;")
+            user_id = cursor.fetchone()[0]
+
+    server = start_server()
+    locker = get_connection()
+    results = []
+    try:
+        with locker.cursor() as cursor:
+            # Held until the end, every query on categories waits for it
+            cursor.execute("LOCK TABLE categories IN ACCESS EXCLUSIVE MODE;")
+        until = time.monotonic() + seconds
+        clients = (
+            [("list", "GET", "/categories")] * LIST_CLIENTS
+            + [("write", "POST", f"/bids?user_id={user_id}&listing_id={listing_id}&amount=1")] * WRITE_CLIENTS
+            + [("lookup", "GET", f"/listings/{listing_id}")] * LOOKUP_CLIENTS
+        )
+        threads = [threading.Thread(target=client, args=(*args, until, results)) for args in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        locker.rollback()
+        locker.close()
+        server.terminate()
+        server.wait()
+
+    print(f"{seconds}s, pool of 4, categories locked")
+    for kind in ("list", "write", "lookup"):
+        rows = [row for row in results if row[0] == kind]
+        statuses = {}
+        for _, status, _, _ in rows:
+            statuses[status] = statuses.get(status, 0) + 1
+        slowest = max((elapsed for _, _, elapsed, _ in rows), default=0)
+        print(f"  {kind:<7} {len(rows):6} requests, slowest {slowest:6.2f}s, statuses {statuses}")
+
+    bid_ids = [body["id"] for kind, status, _, body in results if kind == "write" and status == 201]
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM bids WHERE id = ANY(%s);", (bid_ids,))
+    connection.close()
+
+
+if __name__ == "__main__":
+    run(float(sys.argv[1]) if len(sys.argv) > 1 else 10)
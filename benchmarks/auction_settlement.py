@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auctions
+from db_setup import get_connection
+
+"""
+Measures how fast ended auctions are settled with several schedulers side by side, and checks that
+every auction is settled exactly once: one transaction per auction with bids, none for the others.
+Seeds ended auctions (two out of three with bids), deleted again afterwards together with their
+transactions and notifications. Like the real scheduler it also settles any other ended auctions in the database:
+python benchmarks/auction_settlement.py [auctions] [schedulers]
+"""
+
+
+def seed_auctions(connection, count):
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO listings (user_id, category_id, title, listing_type, price, region, description, ends_at)
+                SELECT (SELECT MIN(id) FROM users), (SELECT MIN(id) FROM categories), 'Auktion ' || n,
+                    'selling', 100, 'Stockholm', '', LOCALTIMESTAMP - interval '1 minute'
+                FROM generate_series(1, %s) n
+                RETURNING id;
+                """,
+                (count,),
+            )
+            listing_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                """
+                INSERT INTO bids (user_id, listing_id, amount)
+                SELECT u.id, l.id, 100 + b
+                FROM unnest(%s::bigint[]) WITH ORDINALITY AS l (id, n)
+                CROSS JOIN generate_series(1, 3) b
+                CROSS JOIN LATERAL (SELECT MAX(id) AS id FROM users) u
+                WHERE l.n %% 3 <> 0;
+                """,
+                (listing_ids,),
+            )
+            return listing_ids
+
+
+def run(auction_count, scheduler_count):
+    connection = get_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT user_id, unread_notifications FROM user_counters;")
+            unread_before = cursor.fetchall()
+    listing_ids = seed_auctions(connection, auction_count)
+    settled = []
+    try:
+        def scheduler():
+            scheduler_connection = get_connection()
+            try:
+                settled.append(auctions.settle_due_auctions(scheduler_connection))
+            finally:
+                scheduler_connection.close()
+
+        threads = [threading.Thread(target=scheduler) for _ in range(scheduler_count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT
+                        COUNT(*) FILTER (WHERE l.status = 'sold' AND t.transactions = 1),
+                        COUNT(*) FILTER (WHERE l.status = 'closed' AND t.transactions IS NULL),
+                        COUNT(*) FILTER (WHERE l.status = 'active'),
+                        COUNT(*) FILTER (WHERE t.transactions > 1)
+                    FROM listings l
+                    LEFT JOIN (
+                        SELECT listing_id, COUNT(*) AS transactions FROM transactions GROUP BY listing_id
+                    ) t ON t.listing_id = l.id
+                    WHERE l.id = ANY(%s);
+                    """,
+                    (listing_ids,),
+                )
+                sold, closed, unsettled, settled_twice = cursor.fetchone()
+        print(f"{auction_count} ended auctions, {scheduler_count} schedulers")
+        print(f"  settled {sum(settled)} in {elapsed:.2f}s ({sum(settled) / elapsed:.0f}/s), per scheduler {settled}")
+        print(f"  sold with one transaction: {sold}, closed without bids: {closed}")
+        print(f"  still active: {unsettled}, more than one transaction: {settled_twice}")
+    finally:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM transactions WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM notifications WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM bids WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM listings WHERE id = ANY(%s);", (listing_ids,))
+                cursor.executemany(
+                    "UPDATE user_counters SET unread_notifications = %s WHERE user_id = %s;",
+                    [(unread, user_id) for user_id, unread in unread_before],
+                )
+        connection.close()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+    )
@@ -0,0 +1,107 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db_setup import get_connection
+
+"""
+Checks that POST /checkout sells a listing only once: several buyers check out the same listing at the same moment,
+for every one of the seeded listings. Exactly one of them should get the listing (201), the others None (409),
+and every listing should end up with exactly one transaction, payment and shipping row.
+Everything it creates is deleted again afterwards: python benchmarks/checkout_race.py [listings] [buyers]
+"""
+
+
+def seed_listings(connection, seller_id, count):
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO listings (user_id, category_id, title, listing_type, price, region, description)
+                SELECT %s, (SELECT MIN(id) FROM categories), 'Checkout ' || n, 'selling', 100, 'Stockholm', ''
+                FROM generate_series(1, %s) n
+                RETURNING id;
+                """,
+                (seller_id, count),
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def race(listing_id, buyer_ids):
+    """ Returns how many of the buyers got the listing """
+    barrier = threading.Barrier(len(buyer_ids))
+    bought = []
+
+    def buy(buyer_id):
+        connection = get_connection()
+        try:
+            barrier.wait()
+            purchase = db.checkout(connection, buyer_id, listing_id, "card", "postnord", 49)
+            bought.append(purchase is not None)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=buy, args=(buyer_id,)) for buyer_id in buyer_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(bought)
+
+
+def run(listing_count, buyer_count):
+    connection = get_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM users WHERE deleted_at IS NULL ORDER BY id;")
+            user_ids = [row[0] for row in cursor.fetchall()]
+            seller_id, other_ids = user_ids[0], user_ids[1:]
+            cursor.execute("SELECT unread_notifications FROM user_counters WHERE user_id = %s;", (seller_id,))
+            seller_unread = cursor.fetchone()
+    buyer_ids = [other_ids[n % len(other_ids)] for n in range(buyer_count)]
+    listing_ids = seed_listings(connection, seller_id, listing_count)
+    try:
+        start = time.perf_counter()
+        winners = [race(listing_id, buyer_ids) for listing_id in listing_ids]
+        elapsed = time.perf_counter() - start
+        with connection:
+            with connection.cursor() as cursor:
+                counts = {}
+                for table in ("transactions", "payments", "shipping_details"):
+                    cursor.execute(
+                        f"""
+                        SELECT COUNT(*) FILTER (WHERE rows = 1), COUNT(*) FILTER (WHERE rows > 1)
+                        FROM (SELECT COUNT(*) AS rows FROM {table} WHERE listing_id = ANY(%s) GROUP BY listing_id) t;
+                        """,
+                        (listing_ids,),
+                    )
+                    counts[table] = cursor.fetchone()
+        print(f"{listing_count} listings, {buyer_count} buyers each, {elapsed:.2f}s")
+        print(f"  buyers who got the listing: {dict((n, winners.count(n)) for n in sorted(set(winners)))} (listings per count)")
+        for table, (once, more) in counts.items():
+            print(f"  {table:<17} listings with one row: {once}, with more than one: {more}")
+    finally:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM payments WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM transactions WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM shipping_details WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM notifications WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM listings WHERE id = ANY(%s);", (listing_ids,))
+                if seller_unread is not None:
+                    cursor.execute(
+                        "UPDATE user_counters SET unread_notifications = %s WHERE user_id = %s;",
+                        (seller_unread[0], seller_id),
+                    )
+        connection.close()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    )
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from compression import COMPRESSION_ENCODINGS, COMPRESSORS
+from db_setup import get_connection
+from responses import FastJSONResponse
+
+"""
+Compression ratio and CPU time per encoding and level for a /listings response, to pick COMPRESSION_*_LEVEL.
+Seeds extra listings (deleted again afterwards):
+python benchmarks/compression_levels.py [listings_to_seed]
+"""
+
+LEVELS = {
+    "gzip": [1, 4, 6, 9],
+    "br": [1, 4, 6, 9, 11],
+    "zstd": [1, 3, 6, 12, 19],
+}
+
+
+def seed_listings(connection, count):
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO listings (user_id, category_id, title, listing_type, price, region, description)
+                SELECT (SELECT MIN(id) FROM users), (SELECT MIN(id) FROM categories), 'Benchmark ' || n,
+                    'selling', 100 + n %% 1000, 'Stockholm', repeat('Beskrivning ', 20)
+                FROM generate_series(1, %s) n
+                RETURNING id;
+                """,
+                (count,),
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def run(seed_count):
+    connection = get_connection()
+    seeded_ids = seed_listings(connection, seed_count)
+    try:
+        body = FastJSONResponse({"listings": db.get_all_listings(connection)}).body
+        print(f"/listings body {len(body) / 1e6:.2f} MB")
+        for encoding in COMPRESSION_ENCODINGS:
+            for level in LEVELS[encoding]:
+                compressor = COMPRESSORS[encoding](level)
+                started = time.process_time()
+                compressed = compressor.compress(body, flush=False) + compressor.finish()
+                cpu_seconds = time.process_time() - started
+                print(
+                    f"  {encoding:<5} level {level:<3} ratio {len(compressed) / len(body):.3f} "
+                    f"{cpu_seconds * 1000:8.1f} ms CPU {len(body) / 1e6 / cpu_seconds:8.1f} MB/s"
+                )
+    finally:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM listings WHERE id = ANY(%s);", (seeded_ids,))
+        connection.close()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import export
+from db_setup import get_connection
+
+"""
+Compares the JSON list endpoints with the streamed exports for transactions and payments.
+Reports rows per second, bytes produced and peak Python memory for each path.
+Run against a database with realistic data: python benchmarks/export_throughput.py
+"""
+
+
+def measure(label, produce_chunks):
+    tracemalloc.start()
+    start = time.perf_counter()
+    total_bytes = 0
+    for chunk in produce_chunks():
+        total_bytes += len(chunk)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return label, elapsed, total_bytes, peak
+
+
+def json_path(fetch_all):
+    def produce():
+        connection = get_connection()
+        try:
+            rows = fetch_all(connection)
+        finally:
+            connection.close()
+        # Same work as FastAPI returning the list: all rows in memory, then one JSON document
+        yield json.dumps(rows, default=str).encode()
+    return produce
+
+
+def run():
+    connection = get_connection()
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT (SELECT COUNT(*) FROM transactions), (SELECT COUNT(*) FROM payments);")
+        row_counts = dict(zip(("transactions", "payments"), cursor.fetchone()))
+    connection.close()
+
+    fetch_all = {"transactions": db.get_all_transactions, "payments": db.get_all_payments}
+    for table in ("transactions", "payments"):
+        results = [measure("json", json_path(fetch_all[table]))]
+        for file_format in ("csv", "arrow", "parquet"):
+            try:
+                results.append(
+                    measure(file_format, lambda: export.stream_export(table, file_format))
+                )
+            except ValueError as error:
+                print(f"{table} {file_format}: skipped ({error})")
+        rows = row_counts[table]
+        print(f"\n{table}: {rows} rows")
+        for label, elapsed, total_bytes, peak in results:
+            print(
+                f"  {label:<8} {rows / elapsed if elapsed else 0:12.0f} rows/s "
+                f"{total_bytes / 1e6:9.2f} MB out {peak / 1e6:9.2f} MB peak memory"
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db_setup import get_connection
+from responses import FastJSONResponse
+
+"""
+Compares building list responses in Python with letting Postgres render the JSON (JSON_RESPONSE_MODE=postgres).
+Seeds extra listings (deleted again afterwards) so there is something to measure:
+python benchmarks/json_agg.py [listings_to_seed] [repeats]
+"""
+
+
+def measure(label, produce_body, repeats):
+    # Throughput over all repeats, peak Python memory for a single response
+    start = time.perf_counter()
+    for _ in range(repeats):
+        body = produce_body()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    produce_body()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"  {label:<28} {repeats / elapsed:8.1f} responses/s "
+        f"{len(body) / 1e6:7.2f} MB body {peak / 1e6:8.2f} MB peak memory"
+    )
+
+
+def seed_listings(connection, count):
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO listings (user_id, category_id, title, listing_type, price, region, description)
+                SELECT (SELECT MIN(id) FROM users), (SELECT MIN(id) FROM categories), 'Benchmark ' || n,
+                    'selling', 100 + n %% 1000, 'Stockholm', repeat('Beskrivning ', 20)
+                FROM generate_series(1, %s) n
+                RETURNING id;
+                """,
+                (count,),
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def run(seed_count, repeats):
+    connection = get_connection()
+    seeded_ids = seed_listings(connection, seed_count)
+    try:
+        listing_id = seeded_ids[0]
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO bids (user_id, listing_id, amount)
+                    SELECT (SELECT MIN(id) FROM users), %s, n FROM generate_series(1, 5000) n;
+                    """,
+                    (listing_id,),
+                )
+
+        print(f"/listings ({len(db.get_all_listings(connection))} rows)")
+        measure(
+            "python (FastJSONResponse)",
+            lambda: FastJSONResponse({"listings": db.get_all_listings(connection)}).body,
+            repeats,
+        )
+        measure(
+            "postgres (json_agg)",
+            lambda: db.get_all_listings_json(connection).encode(),
+            repeats,
+        )
+        print("/listings/{id}/bids (5000 rows)")
+        measure(
+            "python (FastJSONResponse)",
+            lambda: FastJSONResponse({"bids": db.get_bids_for_listing(connection, listing_id)}).body,
+            repeats,
+        )
+        measure(
+            "postgres (json_agg)",
+            lambda: db.get_bids_for_listing_json(connection, listing_id).encode(),
+            repeats,
+        )
+    finally:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM bids WHERE listing_id = ANY(%s);", (seeded_ids,))
+                cursor.execute("DELETE FROM listings WHERE id = ANY(%s);", (seeded_ids,))
+        connection.close()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+    )
@@ -0,0 +1,92 @@
+import cProfile
+import os
+import pstats
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from responses import FastJSONResponse
+
+"""
+CPU cost of turning /listings and /bids rows into a response body, without a database.
+Rows are built the way psycopg2 returns them (dicts for RealDictCursor, tuples for the compact mode).
+python benchmarks/json_serialization.py [rows] [--profile]
+"""
+
+LISTING_COLUMNS = [
+    "id", "user_id", "category_id", "title", "image_url", "listing_type",
+    "price", "created_at", "region", "status", "description", "ends_at",
+]
+BID_COLUMNS = ["id", "user_id", "listing_id", "created_at", "amount"]
+
+
+def make_rows(row_count):
+    now = datetime(2025, 1, 1, 12, 0, 0)
+    listings = [
+        (
+            i, i % 1000, i % 20, f"Listing {i}", f"https://example.com/{i}.jpg", "selling",
+            Decimal(f"{i % 5000}.50"), now + timedelta(seconds=i), "Stockholm", "active",
+            "Mycket bra skick, använd i 1 år " * 4, None,
+        )
+        for i in range(row_count)
+    ]
+    bids = [
+        (i, i % 1000, i % 5000, now + timedelta(seconds=i), Decimal(f"{i % 900}.00"))
+        for i in range(row_count)
+    ]
+    return listings, bids
+
+
+def old_path(key, columns, rows):
+    # What FastAPI does for a returned dict: jsonable_encoder, then json.dumps in JSONResponse
+    content = {key: [dict(zip(columns, row)) for row in rows]}
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def fast_path(key, columns, rows):
+    content = {key: [dict(zip(columns, row)) for row in rows]}
+    return FastJSONResponse(content).body
+
+
+def compact_path(key, columns, rows):
+    return FastJSONResponse({key: {"columns": columns, "rows": rows}}).body
+
+
+def time_path(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        body = function(*args)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def run(row_count, profile):
+    listings, bids = make_rows(row_count)
+    for key, columns, rows in (("listings", LISTING_COLUMNS, listings), ("bids", BID_COLUMNS, bids)):
+        print(f"/{key} with {row_count} rows (CPU time, best of 3)")
+        baseline = None
+        for label, function in (
+            ("jsonable_encoder + JSONResponse", old_path),
+            ("FastJSONResponse", fast_path),
+            ("FastJSONResponse compact", compact_path),
+        ):
+            elapsed, size = time_path(function, key, columns, rows)
+            baseline = baseline or elapsed
+            print(f"  {label:<34} {elapsed * 1000:8.1f} ms {size / 1e6:7.2f} MB {baseline / elapsed:6.1f}x")
+            if profile:
+                profiler = cProfile.Profile()
+                profiler.runcall(function, key, columns, rows)
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(6)
+
+
+if __name__ == "__main__":
+    arguments = [argument for argument in sys.argv[1:] if argument != "--profile"]
+    run(int(arguments[0]) if arguments else 20000, "--profile" in sys.argv)
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# media reads MEDIA_DIR when it is imported
+os.environ["MEDIA_DIR"] = tempfile.mkdtemp(prefix="media-benchmark-")
+
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.routing import Route
+
+import media
+
+"""
+Listing grid workload against GET /media: media.media_response (memory cache, ETag, chunked reads in worker threads)
+compared with a plain starlette FileResponse of the same files.
+Pages of GRID_SIZE small thumbnails are requested at once, popular listings more often than others (Zipf).
+Revisits send If-None-Match like a browser revalidating its cache, which FileResponse can't answer with 304.
+Runs the ASGI apps in process, so only the serving code is measured, not HTTP parsing:
+python benchmarks/media_serving.py [pages]
+"""
+
+LISTINGS = 2000
+GRID_SIZE = 48
+THUMBNAIL_BYTES = 12 * 1024
+REVISIT_SHARE = 0.3
+
+
+def create_thumbnails():
+    filenames = []
+    for _ in range(LISTINGS):
+        filename = f"{os.urandom(32).hex()}.jpg"
+        path = media.media_path("small", filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(os.urandom(THUMBNAIL_BYTES))
+        filenames.append(filename)
+    return filenames
+
+
+async def plain_file(request):
+    path = media.resolve_media_path(request.path_params["variant"], request.path_params["filename"])
+    if path is None or not os.path.exists(path):
+        return Response(status_code=404)
+    return FileResponse(path, headers={"Cache-Control": media.MEDIA_CACHE_CONTROL})
+
+
+async def media_file(request):
+    response = await media.media_response(
+        request.path_params["variant"], request.path_params["filename"], request.headers
+    )
+    return response or Response(status_code=404)
+
+
+APPS = {
+    "FileResponse": Starlette(routes=[Route("/media/{variant}/{filename}", plain_file)]),
+    "media_response": Starlette(routes=[Route("/media/{variant}/{filename}", media_file)]),
+}
+
+
+async def request(app, path, headers):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": [(name.encode(), value.encode()) for name, value in headers.items()],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+    sent = {"status": None, "bytes": 0, "headers": None}
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        # Like a server: the request has no body, and the client never disconnects
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            sent["status"] = message["status"]
+            sent["headers"] = Headers(raw=message["headers"])
+        elif message["type"] == "http.response.body":
+            sent["bytes"] += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return sent
+
+
+async def run_workload(app, filenames, pages, seed):
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, len(filenames) + 1)]
+    etags = {}
+    statuses = {}
+    body_bytes = 0
+    started = time.perf_counter()
+    for _ in range(pages):
+        page = rng.choices(filenames, weights, k=GRID_SIZE)
+        requests = []
+        for filename in page:
+            headers = {}
+            if filename in etags and rng.random() < REVISIT_SHARE:
+                headers["if-none-match"] = etags[filename]
+            requests.append(request(app, f"/media/small/{filename}", headers))
+        for filename, sent in zip(page, await asyncio.gather(*requests)):
+            statuses[sent["status"]] = statuses.get(sent["status"], 0) + 1
+            body_bytes += sent["bytes"]
+            etags[filename] = sent["headers"]["etag"]
+    elapsed = time.perf_counter() - started
+    return pages * GRID_SIZE / elapsed, body_bytes, statuses
+
+
+def run(pages):
+    filenames = create_thumbnails()
+    print(f"{LISTINGS} thumbnails of {THUMBNAIL_BYTES // 1024} kB, {pages} grid pages of {GRID_SIZE}")
+    try:
+        for name, app in APPS.items():
+            # Same page sequence for both, the first run warms the page cache (and the memory cache)
+            asyncio.run(run_workload(app, filenames, pages // 10 or 1, seed=1))
+            per_second, body_bytes, statuses = asyncio.run(run_workload(app, filenames, pages, seed=2))
+            print(
+                f"  {name:<15} {per_second:9.0f} requests/s {body_bytes / 1e6:8.1f} MB sent "
+                f"statuses {dict(sorted(statuses.items()))}"
+            )
+    finally:
+        shutil.rmtree(media.MEDIA_DIR)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,130 @@
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db_setup import get_connection, rebuild_listing_facets
+
+"""
+Measures GET /listings/nearby on a large table: the first page, and every page when paging through
+all listings within the radius with after_region_id/after_id. Checks that the pages together hold
+every nearby listing exactly once.
+Seeds listings spread over the regions table, deleted again afterwards. The facets and similarity triggers
+are turned off while seeding and deleting, and listing_facets is recounted at the end:
+python benchmarks/nearby_listings.py [listings_to_seed] [radius_km]
+"""
+
+SEED_BATCH = 100000
+# Triggers that would do per-row work nothing here needs
+SEED_DISABLED_TRIGGERS = ("listings_facets_trigger", "listings_similarity_insert_trigger")
+
+
+def set_seed_triggers(cursor, enabled):
+    for trigger in SEED_DISABLED_TRIGGERS:
+        cursor.execute(f"ALTER TABLE listings {'ENABLE' if enabled else 'DISABLE'} TRIGGER {trigger};")
+
+
+def seed_listings(connection, count):
+    listing_ids = []
+    for batch_start in range(0, count, SEED_BATCH):
+        with connection:
+            with connection.cursor() as cursor:
+                set_seed_triggers(cursor, False)
+                # region is set by name, the region trigger fills in region_id
+                cursor.execute(
+                    """
+                    INSERT INTO listings (user_id, category_id, title, listing_type, price, region, description)
+                    SELECT (SELECT MIN(id) FROM users), (SELECT MIN(id) FROM categories), 'Nära ' || n,
+                        'selling', 100 + n %% 1000, r.name, ''
+                    FROM generate_series(1, %s) n
+                    JOIN (SELECT row_number() OVER (ORDER BY id) - 1 AS position, name FROM regions) r
+                        ON r.position = n %% (SELECT COUNT(*) FROM regions)
+                    RETURNING id;
+                    """,
+                    (min(SEED_BATCH, count - batch_start),),
+                )
+                listing_ids.extend(row[0] for row in cursor.fetchall())
+                set_seed_triggers(cursor, True)
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE listings;")
+    return listing_ids
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run(seed_count, radius_km):
+    connection = get_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT latitude, longitude FROM regions WHERE name = 'Stockholm';")
+            latitude, longitude = cursor.fetchone()
+    listing_ids = seed_listings(connection, seed_count)
+    try:
+        first_pages = [
+            timed(lambda: db.get_nearby_listings(connection, latitude, longitude, radius_km, 20))[1]
+            for _ in range(20)
+        ]
+        print(f"{seed_count} listings seeded, {radius_km} km around Stockholm")
+        print(f"  first page of 20: median {statistics.median(first_pages):.1f} ms")
+
+        page_times, seen = [], []
+        after_region_id = after_id = None
+        while True:
+            page, elapsed = timed(
+                lambda: db.get_nearby_listings(
+                    connection, latitude, longitude, radius_km, 500, after_region_id, after_id, "id"
+                )
+            )
+            if not page:
+                break
+            page_times.append(elapsed)
+            seen.extend(row["id"] for row in page)
+            after_region_id, after_id = page[-1]["region_id"], page[-1]["id"]
+
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT id FROM listings
+                    WHERE status = 'active' AND deleted_at IS NULL AND region_id IN (
+                        SELECT id FROM regions
+                        WHERE 12742 * asin(sqrt(
+                            sin(radians(latitude - %s) / 2) ^ 2
+                            + cos(radians(%s)) * cos(radians(latitude)) * sin(radians(longitude - %s) / 2) ^ 2
+                        )) <= %s
+                    );
+                    """,
+                    (latitude, latitude, longitude, radius_km),
+                )
+                expected = {row[0] for row in cursor.fetchall()}
+        print(
+            f"  {len(page_times)} pages of 500: median {statistics.median(page_times):.1f} ms, "
+            f"slowest {max(page_times):.1f} ms, last {page_times[-1]:.1f} ms"
+        )
+        print(
+            f"  {len(seen)} listings paged, {len(set(seen))} different, "
+            f"same as all nearby listings: {set(seen) == expected and len(seen) == len(expected)}"
+        )
+    finally:
+        with connection:
+            with connection.cursor() as cursor:
+                set_seed_triggers(cursor, False)
+                cursor.execute("DELETE FROM listings WHERE id = ANY(%s);", (listing_ids,))
+                set_seed_triggers(cursor, True)
+                rebuild_listing_facets(cursor)
+        connection.close()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 300,
+    )
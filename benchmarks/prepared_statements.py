@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db_setup import get_connection
+
+"""
+Compares plain queries with prepared statements for the hot db.py functions.
+Run against a database created with db_setup.py: python benchmarks/prepared_statements.py [iterations]
+create_bid inserts real bids, they are deleted again at the end.
+"""
+
+
+def time_calls(label, function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<45} {elapsed * 1000:9.1f} ms total {elapsed / iterations * 1e6:9.1f} us/call")
+    return elapsed
+
+
+def run(iterations):
+    connection = get_connection()
+    listing_id = db.get_all_listings(connection)[0]["id"]
+    user_id = db.get_all_users(connection)[0]["id"]
+    created_bids = []
+
+    def create_bid():
+        created_bids.append(db.create_bid(connection, user_id, listing_id, 1)["id"])
+
+    results = {}
+    for prepared in (False, True):
+        db.USE_PREPARED_STATEMENTS = prepared
+        connection.prepared_statements.clear()
+        mode = "prepared" if prepared else "plain"
+        results[("get_listing_by_id", mode)] = time_calls(
+            f"get_listing_by_id ({mode})",
+            lambda: db.get_listing_by_id(connection, listing_id),
+            iterations,
+        )
+        results[("create_bid", mode)] = time_calls(
+            f"create_bid ({mode})", create_bid, iterations
+        )
+
+    for name in ("get_listing_by_id", "create_bid"):
+        saved = results[(name, "plain")] - results[(name, "prepared")]
+        print(f"{name}: {saved / iterations * 1e6:.1f} us saved per call with prepared statements")
+
+    for bid_id in created_bids:
+        db.delete_bid(connection, bid_id)
+    connection.close()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db_setup import get_connection
+from responses import FastJSONResponse
+
+"""
+Compares the bytes read and sent for list endpoints with every column against the slim default projection.
+Seeds listings with realistic (long) descriptions, deleted again afterwards:
+python benchmarks/projection_bytes.py [listings_to_seed] [repeats]
+"""
+
+
+def seed_listings(connection, count):
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO listings (user_id, category_id, title, listing_type, price, region, description)
+                SELECT (SELECT MIN(id) FROM users), (SELECT MIN(id) FROM categories), 'Benchmark ' || n,
+                    'selling', 100 + n %% 1000, 'Stockholm', repeat('Beskrivning av varan ' || n || '. ', 60)
+                FROM generate_series(1, %s) n
+                RETURNING id;
+                """,
+                (count,),
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def column_bytes(connection, columns):
+    """ Returns how many bytes Postgres has to read and send for these columns of every listing """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT SUM(pg_column_size(l)) FROM (SELECT {columns} FROM listings) l;"
+            )
+            return cursor.fetchone()[0]
+
+
+def measure(label, columns, fields, connection, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        body = FastJSONResponse({"listings": db.get_all_listings(connection, fields=fields)}).body
+    elapsed = time.perf_counter() - start
+    print(
+        f"  {label:<22} {column_bytes(connection, columns) / 1e6:7.2f} MB rows "
+        f"{len(body) / 1e6:7.2f} MB body {repeats / elapsed:7.1f} responses/s"
+    )
+
+
+def run(seed_count, repeats):
+    connection = get_connection()
+    seeded_ids = seed_listings(connection, seed_count)
+    try:
+        print(f"/listings ({len(db.get_all_listings(connection))} rows)")
+        measure("all columns", "*", ",".join(db.LISTING_FIELDS), connection, repeats)
+        measure("default (slim)", ", ".join(db.LISTING_LIST_FIELDS), None, connection, repeats)
+        measure("fields=id,title,price", "id, title, price", "id,title,price", connection, repeats)
+    finally:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM listings WHERE id = ANY(%s);", (seeded_ids,))
+        connection.close()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+    )
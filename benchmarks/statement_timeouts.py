@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from db_setup import get_connection
+
+"""
+Checks per-route statement timeouts and cancel-on-disconnect against a real server, with tables locked
+so the queries get stuck:
+- a GET /categories the client abandons after 1 s should leave no query running on the database
+- GET /listings/search should give up after SEARCH_STATEMENT_TIMEOUT_MS (3 s) with a statement timeout
+Starts uvicorn itself against the .env database: python benchmarks/statement_timeouts.py
+"""
+
+PORT = 8092
+
+
+def start_server():
+    env = dict(os.environ, RATE_LIMIT_ENABLED="false", AUCTION_SCHEDULER_ENABLED="false")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(PORT), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+    )
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{PORT}/metrics", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The server didn't start")
+
+
+def call(path, timeout):
+    """ Returns (status, body, seconds), status is "abandoned" when the client gave up """
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{PORT}{path}", timeout=timeout) as response:
+            return response.status, response.read().decode(), time.perf_counter() - start
+    except urllib.error.HTTPError as error:
+        return error.code, error.read().decode(), time.perf_counter() - start
+    except OSError:
+        return "abandoned", "", time.perf_counter() - start
+
+
+def waiting_queries(cursor, table):
+    """ Returns how many queries on table are still running, not counting the lock itself """
+    cursor.execute(
+        """
+        SELECT COUNT(*) FROM pg_stat_activity
+        WHERE state = 'active' AND pid <> pg_backend_pid()
+        AND query ILIKE %s AND query NOT ILIKE 'LOCK TABLE%%';
+        """,
+        (f"%FROM {table}%",),
+    )
+    return cursor.fetchone()[0]
+
+
+def run():
+    server = start_server()
+    locker = get_connection()
+    watcher = get_connection()
+    watcher.autocommit = True
+    try:
+        with locker.cursor() as cursor:
+            cursor.execute("LOCK TABLE categories IN ACCESS EXCLUSIVE MODE;")
+        status, _, elapsed = call("/categories", timeout=1)
+        time.sleep(1)
+        with watcher.cursor() as cursor:
+            left_behind = waiting_queries(cursor, "categories")
+        print(f"GET /categories, client gave up: {status} after {elapsed:.2f}s, queries still running 1s later: {left_behind}")
+        locker.rollback()
+
+        with locker.cursor() as cursor:
+            cursor.execute("LOCK TABLE listings IN ACCESS EXCLUSIVE MODE;")
+        status, body, elapsed = call("/listings/search?search_term=cykel", timeout=30)
+        print(f"GET /listings/search: {status} after {elapsed:.2f}s {body[:100]}")
+    finally:
+        locker.rollback()
+        locker.close()
+        watcher.close()
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    run()
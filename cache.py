@@ -0,0 +1,41 @@
+import threading
+import time
+
+"""
+Small in-memory cache with a time to live, used in front of cheap but very frequent reads.
+Every worker process has its own cache, so entries are kept short-lived and deleted on writes.
+"""
+
+
+class TTLCache:
+    def __init__(self, ttl_seconds, max_entries=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached value, or None if it's missing or expired """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            # Drop everything when full, cheaper than tracking the oldest entry
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,76 @@
+import asyncio
+import collections
+
+import anyio
+
+import metrics
+from db_setup import request_connections
+
+"""
+Cancels the request's running queries when the client disconnects before the response is sent.
+Routes are sync and run in the threadpool, so they can't notice a disconnect themselves:
+without this, a long search keeps running on Postgres after the client gave up.
+"""
+
+
+class CancelOnDisconnectMiddleware:
+    """
+    ASGI middleware, has to run inside the middleware that sets request_connections
+    It reads the request messages ahead of the route so it sees the disconnect while the route is still busy
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        connections = request_connections.get()
+        if scope["type"] != "http" or connections is None:
+            await self.app(scope, receive, send)
+            return
+
+        messages = collections.deque()
+        arrived = asyncio.Event()
+        state = {"disconnected": False, "response_sent": False}
+
+        async def read_ahead():
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    state["disconnected"] = True
+                    arrived.set()
+                    if not state["response_sent"] and connections:
+                        metrics.increment("queries.cancelled_on_disconnect", cost_class=scope.get("cost_class"))
+                        # cancel() opens a connection to the server, keep it off the event loop
+                        await anyio.to_thread.run_sync(_cancel_all, connections)
+                    return
+                messages.append(message)
+                arrived.set()
+
+        async def wrapped_receive():
+            while not messages:
+                if state["disconnected"]:
+                    return {"type": "http.disconnect"}
+                arrived.clear()
+                await arrived.wait()
+            return messages.popleft()
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                state["response_sent"] = True
+            await send(message)
+
+        reader = asyncio.create_task(read_ahead())
+        try:
+            await self.app(scope, wrapped_receive, wrapped_send)
+        finally:
+            reader.cancel()
+
+
+def _cancel_all(connections):
+    # The list is emptied when the connections go back to the pool, so only this request's queries are cancelled
+    for _, connection in list(connections):
+        try:
+            # Stops the query running on the connection, if any, the route then fails with QueryCanceled
+            connection.cancel()
+        except Exception:
+            pass
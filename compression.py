@@ -0,0 +1,241 @@
+import os
+import time
+import zlib
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+
+import metrics
+
+"""
+Compresses responses with zstd, brotli or gzip, whichever the client accepts and is installed here.
+Works for normal and streaming responses: a body is held back until it reaches COMPRESSION_MIN_BYTES,
+so small responses go out as they are and streams (e.g. CSV exports) are compressed chunk by chunk.
+zstandard and brotli are optional, gzip always works.
+Ratio and CPU time per encoding end up in GET /metrics, use them to tune the COMPRESSION_*_LEVEL settings.
+"""
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Bodies at least this big are compressed in a worker thread so other requests keep being served
+COMPRESSION_THREAD_BYTES = int(os.getenv("COMPRESSION_THREAD_BYTES", "262144"))
+COMPRESSION_LEVELS = {
+    "zstd": int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3")),
+    "br": int(os.getenv("COMPRESSION_BROTLI_LEVEL", "4")),
+    "gzip": int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")),
+}
+# Preferred first, when the client accepts several with the same q-value
+COMPRESSION_ENCODINGS = [
+    encoding
+    for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",")
+    if encoding == "gzip"
+    or (encoding == "zstd" and zstandard is not None)
+    or (encoding == "br" and brotli is not None)
+]
+# Parquet and images are compressed already
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/vnd.apache.arrow.stream",
+    "image/svg+xml",
+)
+
+
+class _GzipCompressor:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip header
+
+    def compress(self, data, flush):
+        compressed = self._compressor.compress(data)
+        if flush:
+            compressed += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return compressed
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data, flush):
+        compressed = self._compressor.compress(data)
+        if flush:
+            compressed += self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return compressed
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data, flush):
+        compressed = self._compressor.process(data)
+        if flush:
+            compressed += self._compressor.flush()
+        return compressed
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+COMPRESSORS = {"gzip": _GzipCompressor, "zstd": _ZstdCompressor, "br": _BrotliCompressor}
+
+
+def choose_encoding(accept_encoding):
+    """ Returns the encoding to use for an Accept-Encoding header, or None to send the body as is """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.strip().partition(";")
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in COMPRESSION_ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(headers):
+    """ Returns True if a response with these headers should be compressed """
+    if "content-encoding" in headers:
+        return False
+    content_type = headers.get("content-type", "").lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or "+json" in content_type
+
+
+class CompressionMiddleware:
+    """ ASGI middleware, add it with app.add_middleware(CompressionMiddleware) """
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressingResponder(send, encoding, self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressingResponder:
+    """ Wraps send() for one response """
+
+    def __init__(self, send, encoding, minimum_size):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.pending = []  # Body held back until we know it's big enough
+        self.pending_size = 0
+        self.compressor = None
+        self.passthrough = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            headers = MutableHeaders(scope=message)
+            if is_compressible(headers):
+                headers.add_vary_header("Accept-Encoding")
+            else:
+                self.passthrough = True
+                metrics.increment("compression.skipped", reason="content_type")
+                await self._send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            self.pending.append(body)
+            self.pending_size += len(body)
+            if self.pending_size < self.minimum_size:
+                if more_body:
+                    return
+                # The whole response is smaller than the threshold
+                metrics.increment("compression.skipped", reason="small")
+                self.passthrough = True
+                await self._send(self.start_message)
+                await self._send({"type": "http.response.body", "body": b"".join(self.pending)})
+                return
+            self.compressor = COMPRESSORS[self.encoding](COMPRESSION_LEVELS[self.encoding])
+            headers = MutableHeaders(scope=self.start_message)
+            headers["Content-Encoding"] = self.encoding
+            body = b"".join(self.pending)
+            self.pending = []
+            if more_body:
+                # Streaming: the compressed length isn't known until the end
+                del headers["Content-Length"]
+                await self._send(self.start_message)
+            else:
+                compressed = await self._compress(body, more_body)
+                headers["Content-Length"] = str(len(compressed))
+                await self._send(self.start_message)
+                await self._send({"type": "http.response.body", "body": compressed})
+                self._record()
+                return
+
+        compressed = await self._compress(body, more_body)
+        await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        if not more_body:
+            self._record()
+
+    async def _compress(self, body, more_body):
+        """ Returns the compressed chunk, flushed so streaming clients get it right away """
+
+        def compress():
+            started = time.thread_time()
+            if more_body:
+                compressed = self.compressor.compress(body, flush=True)
+            else:
+                compressed = self.compressor.compress(body, flush=False) + self.compressor.finish()
+            return compressed, time.thread_time() - started
+
+        if len(body) >= COMPRESSION_THREAD_BYTES:
+            compressed, cpu_seconds = await anyio.to_thread.run_sync(compress)
+        else:
+            compressed, cpu_seconds = compress()
+        self.bytes_in += len(body)
+        self.bytes_out += len(compressed)
+        self.cpu_seconds += cpu_seconds
+        return compressed
+
+    def _record(self):
+        metrics.increment("compression.responses", encoding=self.encoding)
+        metrics.increment("compression.bytes_in", self.bytes_in, encoding=self.encoding)
+        metrics.increment("compression.bytes_out", self.bytes_out, encoding=self.encoding)
+        metrics.observe("compression.cpu_seconds", self.cpu_seconds, encoding=self.encoding)
+        if self.bytes_in:
+            metrics.observe("compression.ratio", self.bytes_out / self.bytes_in, encoding=self.encoding)
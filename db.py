@@ -1,12 +1,102 @@
+import math
+import os
+
 import psycopg2
+import psycopg2.errors
 from fastapi import HTTPException
-from psycopg2.extras import RealDictCursor
+from psycopg2 import sql
+from psycopg2.extras import Json, RealDictCursor
+
+from responses import compact_rows, dumps
 
 """
 This file contains database functions for FastAPI endpoints.
 Each function execute queries, returns the result and handles exceptions when necessary. 
 """
 
+# Messages and notifications are partitioned by month, history reads only look this far back by default
+# so Postgres can skip the older partitions
+RECENT_WINDOW_DAYS = 90
+
+# Turn off when running behind a pooler that doesn't keep server connections per client (e.g. pgbouncer in transaction mode)
+USE_PREPARED_STATEMENTS = os.getenv("USE_PREPARED_STATEMENTS", "true").lower() == "true"
+
+
+def _execute(cursor, name, query, params=()):
+    """
+    Runs one of the fixed db.py queries as a server-side prepared statement
+    The statement is prepared the first time it's used on a connection, after that Postgres skips parsing and planning
+    """
+    connection = cursor.connection
+    prepared_statements = getattr(connection, "prepared_statements", None)
+    # name=None is for queries that change per call (e.g. a requested set of fields)
+    if not USE_PREPARED_STATEMENTS or prepared_statements is None or name is None:
+        cursor.execute(query, params)
+        return
+    # A statement the server lost (or can't run any more because a table changed) fails the transaction it runs in.
+    # As the first statement of a transaction that's only this call's own work, later ones run in a savepoint
+    # so the caller's earlier work survives. It's sent with the EXECUTE, no extra round trip
+    in_transaction = connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if not in_transaction:
+        connection.execute_savepoint = False
+    try:
+        if name not in prepared_statements:
+            # PREPARE uses $1, $2 ... instead of %s
+            numbered_query = query
+            for number in range(1, len(params) + 1):
+                numbered_query = numbered_query.replace("%s", f"${number}", 1)
+            # In a savepoint, so a statement that is still prepared on the server doesn't abort the transaction
+            try:
+                cursor.execute(
+                    sql.SQL("SAVEPOINT prepare_statement; PREPARE {} AS ").format(sql.Identifier(name))
+                    + sql.SQL(numbered_query)
+                    + sql.SQL("; RELEASE SAVEPOINT prepare_statement")
+                )
+            except psycopg2.errors.DuplicatePreparedStatement:
+                # Already prepared on this connection (e.g. before prepared_statements was cleared), just use it
+                cursor.execute("ROLLBACK TO SAVEPOINT prepare_statement; RELEASE SAVEPOINT prepare_statement")
+            prepared_statements.add(name)
+        savepoint = ""
+        if in_transaction:
+            # The previous call's savepoint is released first, so they don't pile up in a long transaction
+            if getattr(connection, "execute_savepoint", False):
+                savepoint = "RELEASE SAVEPOINT execute_statement; "
+            savepoint += "SAVEPOINT execute_statement; "
+            connection.execute_savepoint = True
+        if params:
+            placeholders = sql.SQL(", ").join(sql.Placeholder() * len(params))
+            cursor.execute(
+                sql.SQL(savepoint + "EXECUTE {} ({})").format(sql.Identifier(name), placeholders), params
+            )
+        else:
+            cursor.execute(sql.SQL(savepoint + "EXECUTE {}").format(sql.Identifier(name)))
+    except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.FeatureNotSupported):
+        if in_transaction:
+            cursor.execute("ROLLBACK TO SAVEPOINT execute_statement")
+        else:
+            connection.rollback()
+        # PREPARE isn't undone by a rollback, so the server still has the rest of them: drop them all,
+        # or preparing them again fails with DuplicatePreparedStatement. This call runs unprepared,
+        # the next one prepares the statement again
+        cursor.execute("DEALLOCATE ALL")
+        prepared_statements.clear()
+        cursor.execute(query, params)
+
+
+def _change_unread_counters(cursor, user_id, notifications=0, messages=0):
+    """ Adds to (or subtracts from) the unread counters of a user, runs in the caller's transaction """
+    cursor.execute(
+        """
+        INSERT INTO user_counters (user_id, unread_notifications, unread_messages)
+        VALUES (%s, GREATEST(%s, 0), GREATEST(%s, 0))
+        ON CONFLICT (user_id) DO UPDATE
+        SET unread_notifications = GREATEST(user_counters.unread_notifications + %s, 0),
+            unread_messages = GREATEST(user_counters.unread_messages + %s, 0);
+        """,
+        (user_id, notifications, messages, notifications, messages)
+    )
+
+
 # Users
 def create_user(
     connection, username, email, password, date_of_birth, phone_number
@@ -29,11 +119,11 @@ def create_user(
 def get_user_by_id(connection, user_id):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_user_by_id",
                 """
             SELECT id, username, email, user_since, date_of_birth, phone_number 
             FROM users 
-            WHERE id = %s""",
+            WHERE id = %s AND deleted_at IS NULL""",
                 (user_id,),
             )
             user_by_id = cursor.fetchone()
@@ -44,11 +134,11 @@ def get_user_by_id(connection, user_id):
 def get_user_by_email(connection, email):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_user_by_email",
                 """
             SELECT id, username, email, user_since, date_of_birth, phone_number 
             FROM users 
-            WHERE email = %s""",
+            WHERE email = %s AND deleted_at IS NULL""",
                 (email,),
             )
             user_by_email = cursor.fetchone()
@@ -59,11 +149,11 @@ def get_user_by_email(connection, email):
 def get_user_by_username(connection, username):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_user_by_username",
                 """
             SELECT id, username, email, user_since, date_of_birth, phone_number 
             FROM users 
-            WHERE username = %s""",
+            WHERE username = %s AND deleted_at IS NULL""",
                 (username,),
             )
             user_by_username = cursor.fetchone()
@@ -73,7 +163,7 @@ def get_user_by_username(connection, username):
 def get_all_users(connection):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM users;")
+            cursor.execute("SELECT * FROM users WHERE deleted_at IS NULL;")
             all_users = cursor.fetchall()
         return all_users
 
@@ -86,7 +176,7 @@ def update_user(connection, user_id, email=None, phone_number=None):
                 UPDATE users 
                 SET email = COALESCE (%s, email),
                     phone_number = COALESCE (%s, phone_number)
-                WHERE id = %s RETURNING *;
+                WHERE id = %s AND deleted_at IS NULL RETURNING *;
                 """,
                 (email, phone_number, user_id),
             )
@@ -95,9 +185,28 @@ def update_user(connection, user_id, email=None, phone_number=None):
 
 
 def delete_user(connection, user_id):
+    """
+    Soft deletes a user and their listings, archive.py moves them and everything that refers to them to archived_rows later
+    Returns the deleted user, None if there is no such user
+    """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("DELETE FROM users WHERE id = %s RETURNING *;", (user_id,))
+            cursor.execute(
+                """
+                WITH deleted_user AS (
+                    UPDATE users SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND deleted_at IS NULL
+                    RETURNING *
+                ),
+                deleted_listings AS (
+                    UPDATE listings l SET deleted_at = d.deleted_at
+                    FROM deleted_user d
+                    WHERE l.user_id = d.id AND l.deleted_at IS NULL
+                )
+                SELECT * FROM deleted_user;
+                """,
+                (user_id,),
+            )
             deleted_user = cursor.fetchone()
             return deleted_user
 
@@ -109,7 +218,7 @@ def get_all_categories(connection):
         # Create a cursor to run SQL commands
         # RealDictCursor turn the results into dictionarys
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(  # Run SQL ("Fetch everything from the table categories")
+            _execute(cursor, "get_all_categories",  # Run SQL ("Fetch everything from the table categories")
                 """
                 SELECT * 
                 FROM categories;
@@ -123,7 +232,7 @@ def get_category_by_id(connection, category_id):
     """ Returns a category with a specific id """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_category_by_id",
                 """
                 SELECT * 
                 FROM categories 
@@ -138,6 +247,41 @@ def get_category_by_id(connection, category_id):
 
 
 # Listings
+# Columns that can be requested with fields=
+LISTING_FIELDS = (
+    "id",
+    "user_id",
+    "category_id",
+    "title",
+    "image_url",
+    "listing_type",
+    "price",
+    "created_at",
+    "region",
+    "region_id",
+    "status",
+    "description",
+    "ends_at",
+)
+# Lists leave out description, it's long (stored out of line by Postgres) and only needed on the listing page
+LISTING_LIST_FIELDS = tuple(field for field in LISTING_FIELDS if field != "description")
+
+
+def _listing_columns(fields=None):
+    """
+    Returns the column list for a listings SELECT
+    fields is a comma separated string from the client, every name has to be in LISTING_FIELDS
+    """
+    if fields is None:
+        return ", ".join(LISTING_LIST_FIELDS)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in LISTING_FIELDS]
+    if unknown or not requested:
+        raise ValueError(f"Unknown fields {', '.join(unknown)}, use any of {', '.join(LISTING_FIELDS)}.")
+    # Only whitelisted names get here, so they can go into the query text as they are
+    return ", ".join(dict.fromkeys(requested))
+
+
 def create_listing(
     connection,
     user_id,
@@ -148,15 +292,16 @@ def create_listing(
     region,
     description,
     image_url=None,
+    ends_at=None,
 ):
-    """ Creates a new listing in the database """
+    """ Creates a new listing in the database, listings with ends_at are auctions settled by auctions.py """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute( # Run SQL ("Insert a new listing with these values")
                 """
                 INSERT INTO listings 
-                (user_id, category_id, title, listing_type, price, region, description, image_url)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s) 
+                (user_id, category_id, title, listing_type, price, region, description, image_url, ends_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) 
                 RETURNING *;
                 """,
                 # RETURNING *: return the new row that was created
@@ -170,35 +315,57 @@ def create_listing(
                     region,
                     description,
                     image_url,
+                    ends_at,
                 ) # Sending all the values
             )
             new_listing = cursor.fetchone() # Fetch only one result (the first one)
         return new_listing
 
 
-def get_all_listings(connection):
-    """ Returns all listings """
+def get_all_listings(connection, compact=False, fields=None):
+    """ Returns all listings, as {"columns", "rows"} with plain tuples when compact is True """
+    columns = _listing_columns(fields)
     with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                """
-                SELECT * 
-                FROM listings;
+        # Tuples are much cheaper to build (and to serialize) than one dictionary per row
+        with connection.cursor(cursor_factory=None if compact else RealDictCursor) as cursor:
+            _execute(cursor, None if fields else "get_all_listings",
+                f"""
+                SELECT {columns} 
+                FROM listings 
+                WHERE deleted_at IS NULL;
                 """
             )
             all_listings = cursor.fetchall()
+            if compact:
+                return compact_rows(cursor, all_listings)
         return all_listings
 
 
+def get_all_listings_json(connection, fields=None):
+    """ Returns all listings as JSON text ({"listings": [...]}) rendered by Postgres """
+    columns = _listing_columns(fields)
+    with connection:
+        with connection.cursor() as cursor:
+            # ::text so psycopg2 hands back the string instead of parsing the JSON into Python objects
+            _execute(cursor, None if fields else "get_all_listings_json",
+                f"""
+                SELECT json_build_object('listings', COALESCE(json_agg(l), '[]'::json))::text
+                FROM (SELECT {columns} FROM listings WHERE deleted_at IS NULL) l;
+                """
+            )
+            all_listings_json = cursor.fetchone()[0]
+        return all_listings_json
+
+
 def get_listing_by_id(connection, listing_id):
     """ Returns a listing with a specific id """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_listing_by_id",
                 """
                 SELECT * 
                 FROM listings 
-                WHERE id = %s;
+                WHERE id = %s AND deleted_at IS NULL;
                 """,
                 (listing_id,)
             )  # %s: placeholder for listing_id
@@ -235,7 +402,7 @@ def update_listing(
                 region = COALESCE(%s, region),
                 description = COALESCE(%s, description),
                 image_url = COALESCE(%s, image_url)
-                WHERE id = %s 
+                WHERE id = %s AND deleted_at IS NULL 
                 RETURNING *;
                 """,
                 (
@@ -254,13 +421,14 @@ def update_listing(
 
 
 def delete_listing(connection, listing_id):
+    """ Soft deletes a listing, archive.py moves it and its bids, images, messages etc. to archived_rows later """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 """
-                DELETE 
-                FROM listings 
-                WHERE id = %s 
+                UPDATE listings 
+                SET deleted_at = CURRENT_TIMESTAMP 
+                WHERE id = %s AND deleted_at IS NULL 
                 RETURNING *;
                 """,
                 (listing_id,)
@@ -271,16 +439,17 @@ def delete_listing(connection, listing_id):
     return deleted_listing
 
 
-def search_listings(connection, search_term):
+def search_listings(connection, search_term, fields=None):
     """ Searches listings by title and description """
+    columns = _listing_columns(fields)
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 # ILIKE: makes the search case-insensitive
-                """
-                SELECT * 
+                f"""
+                SELECT {columns} 
                 FROM listings 
-                WHERE title ILIKE %s OR description ILIKE %s;
+                WHERE (title ILIKE %s OR description ILIKE %s) AND deleted_at IS NULL;
                 """,
                 (f"%{search_term}%", f"%{search_term}%") # %{search_term}%: search anywhere in the text
             )
@@ -288,15 +457,16 @@ def search_listings(connection, search_term):
     return searched_listings
 
 
-def get_listings_by_category(connection, category_id):
+def get_listings_by_category(connection, category_id, fields=None):
     """ Returns all listings with a specific category """
+    columns = _listing_columns(fields)
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                """
-                SELECT * 
+            _execute(cursor, None if fields else "get_listings_by_category",
+                f"""
+                SELECT {columns} 
                 FROM listings 
-                WHERE category_id = %s;
+                WHERE category_id = %s AND deleted_at IS NULL;
                 """,
                 (category_id,)
             )
@@ -304,6 +474,281 @@ def get_listings_by_category(connection, category_id):
     return listings_by_category
 
 
+# Sort orders for browse_listings, id is added so pages don't overlap when values are equal
+BROWSE_SORTS = {
+    "newest": "created_at DESC, id DESC",
+    "price_asc": "price ASC, id ASC",
+    "price_desc": "price DESC, id DESC",
+    "ending_soon": "ends_at ASC NULLS LAST, id ASC",
+}
+
+
+def _browse_filters(category_id=None, region=None, listing_type=None, status=None):
+    """ Returns the WHERE conditions and values for the facet filters that are set """
+    conditions = []
+    values = []
+    for column, value in (
+        ("category_id", category_id),
+        ("listing_type", listing_type),
+        ("status", status),
+    ):
+        if value is not None:
+            conditions.append(sql.SQL("{} = %s").format(sql.Identifier(column)))
+            values.append(value)
+    if region is not None:
+        # Normalized like listings_normalize_region stores it: "gbg" finds Göteborg, unknown regions as typed
+        conditions.append(
+            sql.SQL(
+                """
+                region = COALESCE(
+                    (SELECT r.name FROM region_aliases a JOIN regions r ON r.id = a.region_id
+                    WHERE a.alias = region_key(%s)),
+                    %s
+                )
+                """
+            )
+        )
+        values.extend([region, region])
+    return conditions, values
+
+
+def browse_listings(
+    connection,
+    category_id=None,
+    region=None,
+    listing_type=None,
+    status=None,
+    min_price=None,
+    max_price=None,
+    sort="newest",
+    limit=20,
+    offset=0,
+    fields=None,
+):
+    """ Returns one page of listings matching all the given filters """
+    columns = _listing_columns(fields)
+    if sort not in BROWSE_SORTS:
+        raise ValueError(f"Unknown sort {sort}, use one of {', '.join(BROWSE_SORTS)}.")
+    conditions, values = _browse_filters(category_id, region, listing_type, status)
+    # Also lets the planner use the partial browse indexes, which leave deleted listings out
+    conditions.append(sql.SQL("deleted_at IS NULL"))
+    if min_price is not None:
+        conditions.append(sql.SQL("price >= %s"))
+        values.append(min_price)
+    if max_price is not None:
+        conditions.append(sql.SQL("price <= %s"))
+        values.append(max_price)
+    where = sql.SQL(" AND ").join(conditions)
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                sql.SQL(
+                    """
+                    SELECT {} 
+                    FROM listings 
+                    WHERE {}
+                    ORDER BY {}
+                    LIMIT %s OFFSET %s;
+                    """
+                ).format(sql.SQL(columns), where, sql.SQL(BROWSE_SORTS[sort])),
+                values + [limit, offset]
+            )
+            browsed_listings = cursor.fetchall()
+    return browsed_listings
+
+
+def get_listing_facets(connection, category_id=None, region=None, listing_type=None, status=None):
+    """
+    Returns listing counts per category, region and listing type from the listing_facets table
+    Each facet is counted with the other filters applied but not its own, so every option shows how many it would give
+    The price range isn't part of the facet table and doesn't change the counts
+    """
+    filters = {
+        "category_id": category_id,
+        "region": region,
+        "listing_type": listing_type,
+        "status": status,
+    }
+    queries = []
+    values = []
+    for facet in ("category_id", "region", "listing_type"):
+        other_filters = dict(filters, **{facet: None})
+        conditions, facet_values = _browse_filters(**other_filters)
+        where = sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("TRUE")
+        queries.append(
+            sql.SQL(
+                """
+                SELECT %s AS facet, {}::text AS value, SUM(listing_count)::bigint AS listing_count
+                FROM listing_facets
+                WHERE {}
+                GROUP BY {}
+                HAVING SUM(listing_count) > 0
+                """
+            ).format(sql.Identifier(facet), where, sql.Identifier(facet))
+        )
+        values += [facet] + facet_values
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                sql.SQL(" UNION ALL ").join(queries) + sql.SQL(" ORDER BY facet, listing_count DESC;"),
+                values
+            )
+            rows = cursor.fetchall()
+    facets = {"category_id": [], "region": [], "listing_type": []}
+    for row in rows:
+        facets[row["facet"]].append({"value": row["value"], "count": row["listing_count"]})
+    return facets
+
+
+# Regions within %(radius_km)s of the point, with their distance
+_NEARBY_REGIONS = """
+    near AS (
+        SELECT id, distance_km
+        FROM (
+            -- Haversine distance in km
+            SELECT id, 12742 * asin(sqrt(
+                sin(radians(latitude - %(latitude)s) / 2) ^ 2
+                + cos(radians(%(latitude)s)) * cos(radians(latitude))
+                * sin(radians(longitude - %(longitude)s) / 2) ^ 2
+            )) AS distance_km
+            FROM regions
+            WHERE latitude BETWEEN %(latitude)s - %(latitude_delta)s AND %(latitude)s + %(latitude_delta)s
+            AND longitude BETWEEN %(longitude)s - %(longitude_delta)s AND %(longitude)s + %(longitude_delta)s
+        ) r
+        WHERE distance_km <= %(radius_km)s
+    )
+"""
+
+
+def get_nearby_listings(
+    connection,
+    latitude,
+    longitude,
+    radius_km=50,
+    limit=20,
+    after_region_id=None,
+    after_id=None,
+    fields=None,
+):
+    """
+    Returns active listings in the regions within radius_km of a point, nearest region first, newest first within a region
+    Pass region_id and id of the last listing as after_region_id and after_id to get the next page,
+    with the same point and radius_km
+    The search box doesn't wrap around longitude ±180, fine for the Swedish regions it's made for
+    """
+    if (after_region_id is None) != (after_id is None):
+        raise ValueError("after_region_id and after_id have to be given together.")
+    # id and region_id are needed for the order and the next page
+    columns = _listing_columns(None if fields is None else f"id,region_id,{fields}")
+    # A box around the point that holds the whole circle, so the regions index narrows the search first
+    latitude_delta = radius_km / 111.2
+    longitude_delta = radius_km / (111.2 * max(math.cos(math.radians(latitude)), 0.01))
+    params = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "latitude_delta": latitude_delta,
+        "longitude_delta": longitude_delta,
+        "radius_km": radius_km,
+        "limit": limit,
+        "after_region_id": after_region_id,
+        "after_id": after_id,
+    }
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"""
+                WITH {_NEARBY_REGIONS},
+                after_region AS (
+                    SELECT distance_km, id FROM near WHERE id = %(after_region_id)s
+                ),
+                -- Regions the previous pages haven't finished yet, none when after_region_id isn't near
+                remaining AS (
+                    SELECT * FROM near
+                    WHERE %(after_region_id)s::bigint IS NULL
+                    OR (distance_km, id) >= (SELECT distance_km, id FROM after_region)
+                )
+                SELECT l.*, round(remaining.distance_km::numeric, 1) AS distance_km
+                FROM remaining
+                -- At most one page per region, each one range of listings_live_region_idx
+                CROSS JOIN LATERAL (
+                    SELECT {columns} 
+                    FROM listings 
+                    WHERE region_id = remaining.id AND status = 'active' AND deleted_at IS NULL
+                    -- A bound on id for every region (not an OR), so it stays an index condition
+                    AND id < CASE WHEN remaining.id = %(after_region_id)s THEN %(after_id)s
+                        ELSE 9223372036854775807 END
+                    ORDER BY id DESC
+                    LIMIT %(limit)s
+                ) l
+                ORDER BY remaining.distance_km, remaining.id, l.id DESC
+                LIMIT %(limit)s;
+                """,
+                params,
+            )
+            nearby_listings = cursor.fetchall()
+            if not nearby_listings and after_region_id is not None:
+                # The last page, or a cursor from another point or radius: starting over would loop forever
+                cursor.execute(
+                    f"WITH {_NEARBY_REGIONS} SELECT EXISTS (SELECT 1 FROM near WHERE id = %(after_region_id)s) AS near;",
+                    params,
+                )
+                if not cursor.fetchone()["near"]:
+                    raise ValueError(
+                        "after_region_id isn't within radius_km of the point, "
+                        "page with the same latitude, longitude and radius_km."
+                    )
+    return nearby_listings
+
+
+def get_similar_listings(connection, listing_id, limit=10, fields=None):
+    """ Returns the active listings most similar to a listing, best first, as worked out by similarity.py """
+    columns = _listing_columns(fields)
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # One primary key lookup for the list, then one per suggested listing
+            _execute(cursor, None if fields else "get_similar_listings",
+                f"""
+                SELECT {columns}, s.score 
+                FROM listing_similarities ls 
+                CROSS JOIN LATERAL unnest(ls.similar_ids, ls.scores) WITH ORDINALITY AS s (similar_id, score, position) 
+                JOIN listings l ON l.id = s.similar_id 
+                WHERE ls.listing_id = %s AND l.status = 'active' AND l.deleted_at IS NULL 
+                AND EXISTS (SELECT 1 FROM listings src WHERE src.id = ls.listing_id AND src.deleted_at IS NULL) 
+                ORDER BY s.position 
+                LIMIT %s;
+                """,
+                (listing_id, limit)
+            )
+            similar_listings = cursor.fetchall()
+    return similar_listings
+
+
+def get_user_feed(connection, user_id, offset=0, limit=20, fields=None):
+    """ Returns a page of a user's home feed, best first, as worked out by feed.py """
+    columns = _listing_columns(fields)
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # One primary key lookup for the feed, only the page is unnested
+            _execute(cursor, None if fields else "get_user_feed",
+                f"""
+                SELECT {columns}, s.score
+                FROM (
+                    SELECT page.*
+                    FROM user_feeds f
+                    CROSS JOIN LATERAL unnest(f.listing_ids[%s:%s], f.scores[%s:%s]) WITH ORDINALITY AS page (listing_id, score, position)
+                    WHERE f.user_id = %s
+                    AND EXISTS (SELECT 1 FROM users u WHERE u.id = f.user_id AND u.deleted_at IS NULL)
+                ) s
+                JOIN listings l ON l.id = s.listing_id
+                WHERE l.status = 'active' AND l.deleted_at IS NULL
+                ORDER BY s.position;
+                """,
+                (offset + 1, offset + limit, offset + 1, offset + limit, user_id)
+            )
+            feed = cursor.fetchall()
+    return feed
+
+
 # Listings_watch_list
 def add_to_watch_list(connection, user_id, listing_id):
     with connection:
@@ -324,11 +769,12 @@ def get_all_watched_listings(connection, user_id):
     """ Returns all watched_listing for a specific user """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_all_watched_listings",
                 """
                 SELECT * 
-                FROM listings_watch_list 
-                WHERE user_id = %s;
+                FROM listings_watch_list w 
+                WHERE user_id = %s 
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = w.listing_id AND l.deleted_at IS NULL);
                 """,
                 (user_id,)
             )
@@ -354,17 +800,55 @@ def remove_from_watch_list(connection, user_id, listing_id):
 
 # Messages
 def create_message(connection, sender_id, recipient_id, listing_id, message_text):
+    """ Creates a message and files it in the conversation for the listing and the two users """
+    # Only the recipient's unread counts go up, so a message to yourself would never count as unread
+    if sender_id == recipient_id:
+        raise ValueError("A message can't be sent to yourself.")
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Find or create the conversation, the lower user id is always user_one_id
             cursor.execute(
                 """
-                INSERT INTO messages (sender_id, recipient_id, listing_id, message_text)
-                VALUES (%s, %s, %s, %s) 
+                INSERT INTO conversations (listing_id, user_one_id, user_two_id)
+                VALUES (%s, LEAST(%s, %s), GREATEST(%s, %s))
+                ON CONFLICT (listing_id, user_one_id, user_two_id)
+                DO UPDATE SET listing_id = EXCLUDED.listing_id
+                RETURNING id;
+                """,
+                (listing_id, sender_id, recipient_id, sender_id, recipient_id)
+            )
+            conversation_id = cursor.fetchone()["id"]
+            cursor.execute(
+                """
+                INSERT INTO messages (sender_id, recipient_id, listing_id, message_text, conversation_id)
+                VALUES (%s, %s, %s, %s, %s) 
                 RETURNING *;
                 """,
-                (sender_id, recipient_id, listing_id, message_text)
+                (sender_id, recipient_id, listing_id, message_text, conversation_id)
             )
             new_message = cursor.fetchone()
+            cursor.execute(
+                """
+                UPDATE conversations 
+                SET last_message_id = %s, last_message_at = %s
+                WHERE id = %s;
+                """,
+                (new_message["id"], new_message["created_at"], conversation_id)
+            )
+            # Move the conversation to the top of both inboxes, only the recipient gets an unread message
+            for user_id, unread in ((sender_id, 0), (recipient_id, 1)):
+                cursor.execute(
+                    """
+                    INSERT INTO conversation_participants (conversation_id, user_id, last_message_at, unread_count)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (user_id, conversation_id) DO UPDATE
+                    SET last_message_at = EXCLUDED.last_message_at,
+                        unread_count = conversation_participants.unread_count + EXCLUDED.unread_count;
+                    """,
+                    (conversation_id, user_id, new_message["created_at"], unread)
+                )
+                if unread:
+                    _change_unread_counters(cursor, user_id, messages=unread)
         return new_message
 
 
@@ -382,27 +866,113 @@ def get_all_messages(connection):
         return all_messages
 
 
-def get_all_user_messages(connection, user_id):
-    """ Returns all messages for a specific user """
+def get_all_user_messages(connection, user_id, days=RECENT_WINDOW_DAYS):
+    """ Returns the messages for a specific user from the last days (all of them if days is None) """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # UNION ALL instead of OR so each side can use its own index
             cursor.execute(
                 """
                 SELECT * 
                 FROM messages 
-                WHERE sender_id= %s OR recipient_id = %s;
+                WHERE sender_id = %s
+                AND (%s::int IS NULL OR created_at >= LOCALTIMESTAMP - make_interval(days => %s::int))
+                UNION ALL
+                SELECT * 
+                FROM messages 
+                WHERE recipient_id = %s AND sender_id <> %s
+                AND (%s::int IS NULL OR created_at >= LOCALTIMESTAMP - make_interval(days => %s::int))
+                ORDER BY id DESC;
                 """,
-                (user_id, user_id)
+                (user_id, days, days, user_id, user_id, days, days)
             )
             user_messages = cursor.fetchall()
         return user_messages
 
 
+# Conversations
+def get_user_conversations(connection, user_id, before=None, limit=20):
+    """ Returns the inbox for a user: one row per conversation with the latest message and unread count """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # before: last_message_at of the last conversation on the previous page
+            cursor.execute(
+                """
+                SELECT 
+                    p.conversation_id,
+                    p.unread_count,
+                    p.last_message_at,
+                    c.listing_id,
+                    CASE WHEN c.user_one_id = p.user_id THEN c.user_two_id ELSE c.user_one_id END AS other_user_id,
+                    m.id AS last_message_id,
+                    m.sender_id AS last_message_sender_id,
+                    m.message_text AS last_message_text
+                FROM conversation_participants p
+                JOIN conversations c ON c.id = p.conversation_id
+                LEFT JOIN messages m ON m.id = c.last_message_id
+                WHERE p.user_id = %s 
+                AND (%s::timestamp IS NULL OR p.last_message_at < %s::timestamp)
+                ORDER BY p.last_message_at DESC
+                LIMIT %s;
+                """,
+                (user_id, before, before, limit)
+            )
+            conversations = cursor.fetchall()
+        return conversations
+
+
+def get_conversation_messages(connection, conversation_id, before_id=None, limit=50):
+    """ Returns one page of messages in a conversation, newest first """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # before_id: id of the oldest message on the previous page
+            cursor.execute(
+                """
+                SELECT * 
+                FROM messages 
+                WHERE conversation_id = %s 
+                AND (%s::bigint IS NULL OR id < %s::bigint)
+                ORDER BY id DESC
+                LIMIT %s;
+                """,
+                (conversation_id, before_id, before_id, limit)
+            )
+            conversation_messages = cursor.fetchall()
+        return conversation_messages
+
+
+def mark_conversation_as_read(connection, conversation_id, user_id):
+    """ Marks all messages sent to a user in a conversation as read, returns how many were updated """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Messages to yourself (only left from before they were rejected) were never counted as unread
+            cursor.execute(
+                """
+                UPDATE messages 
+                SET is_read = TRUE 
+                WHERE conversation_id = %s AND recipient_id = %s AND sender_id <> recipient_id AND is_read = FALSE;
+                """,
+                (conversation_id, user_id)
+            )
+            marked_count = cursor.rowcount
+            cursor.execute(
+                """
+                UPDATE conversation_participants 
+                SET unread_count = 0 
+                WHERE conversation_id = %s AND user_id = %s AND unread_count <> 0;
+                """,
+                (conversation_id, user_id)
+            )
+            if marked_count:
+                _change_unread_counters(cursor, user_id, messages=-marked_count)
+        return marked_count
+
+
 def get_message_by_id(connection, message_id):
     """ Returns a message with a specific id """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_message_by_id",
                 """
                 SELECT * 
                 FROM messages 
@@ -428,6 +998,21 @@ def delete_message(connection, message_id):
                 (message_id,)
             )
             deleted_message = cursor.fetchone()
+            # Keep the recipient's unread count in line with the remaining messages, messages to yourself never counted
+            if (
+                deleted_message is not None
+                and not deleted_message["is_read"]
+                and deleted_message["sender_id"] != deleted_message["recipient_id"]
+            ):
+                cursor.execute(
+                    """
+                    UPDATE conversation_participants 
+                    SET unread_count = GREATEST(unread_count - 1, 0)
+                    WHERE conversation_id = %s AND user_id = %s;
+                    """,
+                    (deleted_message["conversation_id"], deleted_message["recipient_id"])
+                )
+                _change_unread_counters(cursor, deleted_message["recipient_id"], messages=-1)
         if deleted_message is None:
             raise ValueError(f"Message with id {message_id} not found.")
     return deleted_message
@@ -487,7 +1072,7 @@ def get_payment_by_id(connection, payment_id):
     """ Returns a payment with a specific id """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_payment_by_id",
                 """
                 SELECT * 
                 FROM payments 
@@ -537,32 +1122,44 @@ def delete_payment(connection, payment_id):
 
 # Bids
 def create_bid(connection, user_id, listing_id, amount):
+    """ Places a bid, returns None if the listing isn't open for bids (ended, sold, closed, deleted or missing) """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            # FOR SHARE: settlement claims due auctions FOR UPDATE SKIP LOCKED, so it either waits for this bid
+            # to commit (and skips the listing until the next poll) or settles first and the bid finds nothing
+            _execute(cursor, "create_bid",
                 """
                 INSERT INTO bids (user_id, listing_id, amount)
-                VALUES (%s, %s, %s)
-                RETURNING *; 
+                SELECT %s, l.id, %s
+                FROM (
+                    SELECT id FROM listings
+                    WHERE id = %s AND status = 'active' AND deleted_at IS NULL
+                    AND (ends_at IS NULL OR ends_at > LOCALTIMESTAMP)
+                    FOR SHARE
+                ) l
+                RETURNING *;
                 """,
-                (user_id, listing_id, amount)
+                (user_id, amount, listing_id)
             )
             new_bid = cursor.fetchone()
     return new_bid
 
 
-def get_all_bids(connection):
-    """ Returns all bids """
+def get_all_bids(connection, compact=False):
+    """ Returns all bids, as {"columns", "rows"} with plain tuples when compact is True """
     with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        with connection.cursor(cursor_factory=None if compact else RealDictCursor) as cursor:
             cursor.execute(
                 """
                 SELECT * 
-                FROM bids 
+                FROM bids b 
+                WHERE EXISTS (SELECT 1 FROM listings l WHERE l.id = b.listing_id AND l.deleted_at IS NULL) 
                 ORDER BY created_at DESC;
                 """
             )
             all_bids = cursor.fetchall()
+            if compact:
+                return compact_rows(cursor, all_bids)
     return all_bids
 
 
@@ -570,11 +1167,12 @@ def get_bid_by_id(connection, bid_id):
     """ Returns a bid with a specific id """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_bid_by_id",
                 """
                 SELECT * 
-                FROM bids 
-                WHERE id = %s;
+                FROM bids b 
+                WHERE id = %s 
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = b.listing_id AND l.deleted_at IS NULL);
                 """,
                 (bid_id,)
             )
@@ -588,11 +1186,12 @@ def get_bids_for_listing(connection, listing_id):
     """ Returns all bids for a listing """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_bids_for_listing",
                 """
                 SELECT * 
-                FROM bids 
+                FROM bids b 
                 WHERE listing_id = %s 
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = b.listing_id AND l.deleted_at IS NULL) 
                 ORDER BY amount DESC;
                 """,
                 (listing_id,)
@@ -601,6 +1200,23 @@ def get_bids_for_listing(connection, listing_id):
     return bids_for_listing
 
 
+def get_bids_for_listing_json(connection, listing_id):
+    """ Returns all bids for a listing as JSON text ({"bids": [...]}) rendered by Postgres """
+    with connection:
+        with connection.cursor() as cursor:
+            _execute(cursor, "get_bids_for_listing_json",
+                """
+                SELECT json_build_object('bids', COALESCE(json_agg(b ORDER BY b.amount DESC), '[]'::json))::text
+                FROM bids b
+                WHERE b.listing_id = %s
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = b.listing_id AND l.deleted_at IS NULL);
+                """,
+                (listing_id,)
+            )
+            bids_for_listing_json = cursor.fetchone()[0]
+    return bids_for_listing_json
+
+
 def delete_bid(connection, bid_id):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
@@ -653,7 +1269,7 @@ def get_user_rating_by_user_id(connection, user_id):
     """ Returns user rating for a specific user """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_user_rating_by_user_id",
                 """
                 SELECT * 
                 FROM user_ratings 
@@ -726,7 +1342,8 @@ def get_all_reviews(conncection):
             cursor.execute(
                 """
                 SELECT * 
-                FROM reviews 
+                FROM reviews r 
+                WHERE EXISTS (SELECT 1 FROM listings l WHERE l.id = r.listing_id AND l.deleted_at IS NULL) 
                 ORDER BY created_at DESC;
                 """
             )
@@ -738,11 +1355,12 @@ def get_review_by_id(connection, review_id):
     """ Returns a review with a specific id """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_review_by_id",
                 """
                 SELECT * 
-                FROM reviews 
-                WHERE id = %s;""",
+                FROM reviews r 
+                WHERE id = %s 
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = r.listing_id AND l.deleted_at IS NULL);""",
                 (review_id,)
             )
             review_by_id = cursor.fetchone()
@@ -755,11 +1373,12 @@ def get_reviews_for_user(connection, user_id):
     """ Returns all the reviews for a specific user """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_reviews_for_user",
                 """
                 SELECT * 
-                FROM reviews 
+                FROM reviews r 
                 WHERE reviewed_user_id = %s 
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = r.listing_id AND l.deleted_at IS NULL) 
                 ORDER BY created_at DESC;
                 """,
                 (user_id,)
@@ -883,6 +1502,53 @@ def create_image(connection, user_id, listing_id, image_url):
     return new_image
 
 
+def user_and_listing_exist(connection, user_id, listing_id):
+    """ Returns True if neither the user nor the listing is missing or deleted """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT EXISTS (SELECT 1 FROM users WHERE id = %s AND deleted_at IS NULL)
+                    AND EXISTS (SELECT 1 FROM listings WHERE id = %s AND deleted_at IS NULL) AS found;
+                """,
+                (user_id, listing_id)
+            )
+            found = cursor.fetchone()["found"]
+    return found
+
+
+def create_uploaded_image(connection, user_id, listing_id, image_url, content_hash, thumbnail_url):
+    """
+    Adds an image stored by media.py, the thumbnail becomes the listing's image if it has none yet
+    Returns None when the user or the listing is missing or deleted
+    """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # FOR SHARE: the listing can't be deleted between the check and the insert
+            cursor.execute(
+                """
+                WITH live_listing AS (
+                    SELECT id FROM listings WHERE id = %s AND deleted_at IS NULL FOR SHARE
+                ),
+                new_image AS (
+                    INSERT INTO images (user_id, listing_id, image_url, content_hash)
+                    SELECT u.id, l.id, %s, %s
+                    FROM users u, live_listing l
+                    WHERE u.id = %s AND u.deleted_at IS NULL
+                    RETURNING *
+                ),
+                listing_image AS (
+                    UPDATE listings SET image_url = %s
+                    WHERE id = (SELECT listing_id FROM new_image) AND image_url IS NULL
+                )
+                SELECT * FROM new_image;
+                """,
+                (listing_id, image_url, content_hash, user_id, thumbnail_url)
+            )
+            new_image = cursor.fetchone()
+    return new_image
+
+
 def get_all_images(connection):
     """ Returns all images """
     with connection:
@@ -890,7 +1556,8 @@ def get_all_images(connection):
             cursor.execute(
                 """
                 SELECT * 
-                FROM images 
+                FROM images i 
+                WHERE EXISTS (SELECT 1 FROM listings l WHERE l.id = i.listing_id AND l.deleted_at IS NULL) 
                 ORDER BY created_at DESC;
                 """
             )
@@ -905,8 +1572,9 @@ def get_image_by_id(connection, image_id):
             cursor.execute(
                 """
                 SELECT * 
-                FROM images 
-                WHERE id = %s;
+                FROM images i 
+                WHERE id = %s 
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = i.listing_id AND l.deleted_at IS NULL);
                 """,
                 (image_id,)
             )
@@ -920,10 +1588,11 @@ def get_images_for_listing(connection, listing_id):
     """ Returns all the images for a listing """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_images_for_listing",
                 """
-                SELECT * FROM images 
+                SELECT * FROM images i 
                 WHERE listing_id = %s 
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = i.listing_id AND l.deleted_at IS NULL) 
                 ORDER BY created_at ASC
                 """,
                 (listing_id,)
@@ -969,7 +1638,7 @@ def create_transaction(connection, user_id, listing_id, amount, status, bid_id=N
 def get_transaction_by_id(connection, transaction_id):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_transaction_by_id",
                 """
             SELECT * FROM transactions 
             WHERE id = %s""",
@@ -1017,6 +1686,81 @@ def update_transaction(connection, transaction_id, new_status):
         return updated_transaction
 
 
+def checkout(
+    connection,
+    buyer_id,
+    listing_id,
+    payment_method,
+    shipping_method,
+    shipping_cost,
+    estimated_delivery_days=None,
+):
+    """
+    Buys a listing at its price: creates the transaction, payment and shipping row, marks the listing sold
+    and notifies the seller, all in one statement
+    Returns None when the listing isn't active any more (or belongs to the buyer)
+    """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # One statement means one round trip and one commit, and nothing half done if a step fails.
+            # Two buyers at once: the second UPDATE waits for the first, then finds the listing sold and does nothing
+            _execute(cursor, "checkout",
+                """
+                WITH listing AS (
+                    UPDATE listings 
+                    SET status = 'sold'
+                    WHERE id = %s AND status = 'active' AND deleted_at IS NULL AND user_id <> %s
+                    RETURNING id, user_id AS seller_id, title, price
+                ),
+                new_transaction AS (
+                    INSERT INTO transactions (user_id, listing_id, amount, status)
+                    SELECT %s, id, price, 'pending' 
+                    FROM listing
+                    RETURNING *
+                ),
+                new_payment AS (
+                    INSERT INTO payments (transaction_id, listing_id, payment_method, amount)
+                    SELECT id, listing_id, %s, amount 
+                    FROM new_transaction
+                    RETURNING *
+                ),
+                new_shipping AS (
+                    INSERT INTO shipping_details (user_id, listing_id, shipping_method, shipping_cost, estimated_delivery_days, status)
+                    SELECT %s, id, %s, %s, %s, 'pending' 
+                    FROM listing
+                    RETURNING *
+                ),
+                new_notification AS (
+                    INSERT INTO notifications (user_id, listing_id, notification_type, notification_message)
+                    SELECT seller_id, id, 'sale_completed', 'Din annons "' || title || '" har sålts' 
+                    FROM listing
+                    RETURNING user_id
+                ),
+                seller_counters AS (
+                    INSERT INTO user_counters (user_id, unread_notifications, unread_messages)
+                    SELECT user_id, 1, 0 
+                    FROM new_notification
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET unread_notifications = user_counters.unread_notifications + 1
+                )
+                SELECT l.seller_id, row_to_json(t) AS transaction, row_to_json(p) AS payment, row_to_json(s) AS shipping
+                FROM listing l, new_transaction t, new_payment p, new_shipping s;
+                """,
+                (
+                    listing_id,
+                    buyer_id,
+                    buyer_id,
+                    payment_method,
+                    buyer_id,
+                    shipping_method,
+                    shipping_cost,
+                    estimated_delivery_days,
+                )
+            )
+            purchase = cursor.fetchone()
+    return purchase
+
+
 # Shipping_details
 def create_shipping_details(
     connection,
@@ -1098,18 +1842,26 @@ def create_notification(
                 (user_id, listing_id, notification_type, notification_message),
             )
             notification_id = cursor.fetchone()["id"]
+            _change_unread_counters(cursor, user_id, notifications=1)
         return notification_id
 
 
-def get_notifications_by_user_id(connection, user_id):
+def get_notifications_by_user_id(connection, user_id, days=RECENT_WINDOW_DAYS):
+    """ Returns the notifications for a user from the last days (all of them if days is None), newest first """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Notifications at or below the user's read watermark count as read
             cursor.execute(
                 """
-            SELECT *
-            FROM notifications
-            WHERE user_id = %s""",
-                (user_id,),
+            SELECT n.id, n.user_id, n.listing_id, n.notification_type, n.notification_message,
+                (n.is_read OR n.id <= COALESCE(w.read_up_to_id, 0)) AS is_read,
+                n.created_at
+            FROM notifications n
+            LEFT JOIN notification_read_marks w ON w.user_id = n.user_id
+            WHERE n.user_id = %s
+            AND (%s::int IS NULL OR n.created_at >= LOCALTIMESTAMP - make_interval(days => %s::int))
+            ORDER BY n.created_at DESC""",
+                (user_id, days, days),
             )
             notifications_by_user_id = cursor.fetchall()
         return notifications_by_user_id
@@ -1121,26 +1873,121 @@ def get_unread_notifications(connection, user_id):
             cursor.execute(
                 """
             SELECT * FROM notifications
-            WHERE user_id = %s AND is_read = FALSE""",
-                (user_id,),
+            WHERE user_id = %s AND is_read = FALSE
+            AND id > COALESCE((SELECT read_up_to_id FROM notification_read_marks WHERE user_id = %s), 0)
+            ORDER BY id DESC""",
+                (user_id, user_id),
             )
             unread_notifications = cursor.fetchall()
         return unread_notifications
 
 
-def mark_all_notifications_as_read(connection, user_id):
+def mark_notifications_as_read(
+    connection, user_id, notification_ids=None, up_to_id=None, up_to_time=None
+):
+    """
+    Marks unread notifications for a user as read and returns how many were updated
+    notification_ids, up_to_id and up_to_time narrow down which notifications, leave them out to mark all
+    """
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Only unread rows above the watermark are touched, everything else is already read
             cursor.execute(
                 """
                 UPDATE notifications
                 SET is_read = TRUE 
-                WHERE user_id = %s RETURNING *;
+                WHERE user_id = %s AND is_read = FALSE
+                AND id > COALESCE((SELECT read_up_to_id FROM notification_read_marks WHERE user_id = %s), 0)
+                AND (%s::bigint[] IS NULL OR id = ANY(%s::bigint[]))
+                AND (%s::bigint IS NULL OR id <= %s::bigint)
+                AND (%s::timestamp IS NULL OR created_at <= %s::timestamp);
+                """,
+                (
+                    user_id,
+                    user_id,
+                    notification_ids,
+                    notification_ids,
+                    up_to_id,
+                    up_to_id,
+                    up_to_time,
+                    up_to_time,
+                ),
+            )
+            marked_count = cursor.rowcount
+            if marked_count:
+                _change_unread_counters(cursor, user_id, notifications=-marked_count)
+        return marked_count
+
+
+def mark_all_notifications_as_read(connection, user_id):
+    """ Marks every unread notification for a user as read, returns how many were updated """
+    return mark_notifications_as_read(connection, user_id)
+
+
+def set_notification_read_watermark(connection, user_id, up_to_id):
+    """
+    Marks everything up to up_to_id as read without updating the notification rows
+    Returns the stored watermark and the number of notifications that are still unread
+    """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Lock the counter row first, a notification created meanwhile waits for the recount
+            # and is added on top of it instead of being overwritten by it
+            cursor.execute(
+                """
+                INSERT INTO user_counters (user_id) VALUES (%s)
+                ON CONFLICT (user_id) DO NOTHING;
+                SELECT 1 FROM user_counters WHERE user_id = %s FOR UPDATE;
+                """,
+                (user_id, user_id),
+            )
+            # The watermark only moves forward, and never past the user's newest notification,
+            # or notifications that don't exist yet would already count as read
+            cursor.execute(
+                """
+                INSERT INTO notification_read_marks (user_id, read_up_to_id)
+                VALUES (%s, LEAST(%s, (SELECT COALESCE(MAX(id), 0) FROM notifications WHERE user_id = %s)))
+                ON CONFLICT (user_id) DO UPDATE
+                SET read_up_to_id = GREATEST(notification_read_marks.read_up_to_id, EXCLUDED.read_up_to_id)
+                RETURNING read_up_to_id;
+                """,
+                (user_id, up_to_id, user_id),
+            )
+            read_up_to_id = cursor.fetchone()["read_up_to_id"]
+            # Recount from the partial index on unread notifications, only rows above the watermark are read
+            cursor.execute(
+                """
+                SELECT COUNT(*) AS unread
+                FROM notifications
+                WHERE user_id = %s AND is_read = FALSE AND id > %s;
+                """,
+                (user_id, read_up_to_id),
+            )
+            unread = cursor.fetchone()["unread"]
+            cursor.execute(
+                "UPDATE user_counters SET unread_notifications = %s WHERE user_id = %s;",
+                (unread, user_id),
+            )
+        return {"read_up_to_id": read_up_to_id, "unread_notifications": unread}
+
+
+def get_user_badges(connection, user_id):
+    """ Returns the unread notification and message counts for a user """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            _execute(cursor, "get_user_badges",
+                """
+                SELECT unread_notifications, unread_messages
+                FROM user_counters
+                WHERE user_id = %s;
                 """,
                 (user_id,),
             )
-            mark_notifications_read = cursor.fetchall()
-        return mark_notifications_read
+            badges = cursor.fetchone()
+        # Users without a counters row have nothing unread
+        if badges is None:
+            return {"unread_notifications": 0, "unread_messages": 0}
+        return badges
 
 
 def delete_notification(connection, notification_id):
@@ -1151,6 +1998,19 @@ def delete_notification(connection, notification_id):
                 (notification_id,),
             )
             deleted_notification = cursor.fetchone()
+            if deleted_notification is not None and not deleted_notification["is_read"]:
+                # Only unread if it was above the user's read watermark
+                cursor.execute(
+                    """
+                    SELECT read_up_to_id 
+                    FROM notification_read_marks 
+                    WHERE user_id = %s;
+                    """,
+                    (deleted_notification["user_id"],),
+                )
+                watermark = cursor.fetchone()
+                if watermark is None or deleted_notification["id"] > watermark["read_up_to_id"]:
+                    _change_unread_counters(cursor, deleted_notification["user_id"], notifications=-1)
             return deleted_notification
 
 
@@ -1172,24 +2032,45 @@ def create_listing_comment(connection, user_id, listing_id, comment_text):
 def get_comments_by_listing_id(connection, listing_id):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            _execute(cursor, "get_comments_by_listing_id",
                 """
             SELECT id, user_id, listing_id, comment_text, answer_text
-            FROM listing_comments
-            WHERE listing_id = %s""",
+            FROM listing_comments c
+            WHERE listing_id = %s
+            AND EXISTS (SELECT 1 FROM listings l WHERE l.id = c.listing_id AND l.deleted_at IS NULL)""",
                 (listing_id,),
             )
             comments_by_listing_id = cursor.fetchall()
         return comments_by_listing_id
 
 
+def get_comments_by_listing_id_json(connection, listing_id):
+    """ Returns the comments for a listing as a JSON array rendered by Postgres """
+    with connection:
+        with connection.cursor() as cursor:
+            _execute(cursor, "get_comments_by_listing_id_json",
+                """
+            SELECT COALESCE(json_agg(c), '[]'::json)::text
+            FROM (
+                SELECT id, user_id, listing_id, comment_text, answer_text
+                FROM listing_comments lc
+                WHERE listing_id = %s
+                AND EXISTS (SELECT 1 FROM listings l WHERE l.id = lc.listing_id AND l.deleted_at IS NULL)
+            ) c""",
+                (listing_id,),
+            )
+            comments_by_listing_id_json = cursor.fetchone()[0]
+        return comments_by_listing_id_json
+
+
 def get_comments_by_user_id(connection, user_id):
     with connection:
         with connection.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 """
-            SELECT * FROM listing_comments
-            WHERE user_id = %s""",
+            SELECT * FROM listing_comments c
+            WHERE user_id = %s
+            AND EXISTS (SELECT 1 FROM listings l WHERE l.id = c.listing_id AND l.deleted_at IS NULL)""",
                 (user_id,),
             )
             comments_by_user_id = cursor.fetchall()
@@ -1219,3 +2100,141 @@ def delete_listing_comment(connection, comment_id):
             )
             deleted_listing_comment = cursor.fetchone()
             return deleted_listing_comment
+
+
+# Stats (read from the rollup tables kept up to date by stats.py)
+def get_daily_listing_stats(connection, days=30, category_id=None, region=None):
+    """ Returns the number of listings created per day, category and region """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT day, category_id, region, listings_created
+                FROM daily_listing_stats
+                WHERE day >= CURRENT_DATE - %s
+                AND (%s::bigint IS NULL OR category_id = %s::bigint)
+                AND (%s::text IS NULL OR region = %s::text)
+                ORDER BY day DESC, listings_created DESC;
+                """,
+                (days, category_id, category_id, region, region)
+            )
+            listing_stats = cursor.fetchall()
+    return listing_stats
+
+
+def get_daily_transaction_stats(connection, days=30):
+    """ Returns the number and total amount of transactions per day and status """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT day, status, transaction_count, total_amount
+                FROM daily_transaction_stats
+                WHERE day >= CURRENT_DATE - %s
+                ORDER BY day DESC, status;
+                """,
+                (days,)
+            )
+            transaction_stats = cursor.fetchall()
+    return transaction_stats
+
+
+def get_transaction_totals(connection, days=30):
+    """ Returns completed transaction count, total and average sale price """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT 
+                    COALESCE(SUM(transaction_count), 0) AS completed_transactions,
+                    COALESCE(SUM(total_amount), 0) AS completed_total,
+                    ROUND(SUM(total_amount) / NULLIF(SUM(transaction_count), 0), 2) AS average_sale_price
+                FROM daily_transaction_stats
+                WHERE status = 'completed' AND day >= CURRENT_DATE - %s;
+                """,
+                (days,)
+            )
+            transaction_totals = cursor.fetchone()
+    return transaction_totals
+
+
+def get_daily_payment_stats(connection, days=30):
+    """ Returns the number and total amount of payments per day and status """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT day, payment_status, payment_count, total_amount
+                FROM daily_payment_stats
+                WHERE day >= CURRENT_DATE - %s
+                ORDER BY day DESC, payment_status;
+                """,
+                (days,)
+            )
+            payment_stats = cursor.fetchall()
+    return payment_stats
+
+
+def get_active_listing_counts(connection):
+    """ Returns the number of active listings per category and region, from the listing_facets table """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT category_id, region, SUM(listing_count)::bigint AS active_listings
+                FROM listing_facets
+                WHERE status = 'active'
+                GROUP BY category_id, region
+                HAVING SUM(listing_count) > 0
+                ORDER BY active_listings DESC;
+                """
+            )
+            active_listings = cursor.fetchall()
+    return active_listings
+
+
+# Idempotency keys
+def claim_idempotency_key(connection, scope, key, request_hash):
+    """
+    Claims an Idempotency-Key for a request, meant to run in a unit of work together with the write
+    Returns None when the caller got the key and should run the request, otherwise the stored row
+    """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            # A second request with the same key waits here until the first one commits,
+            # then gets the conflict, so only one of them can run the write
+            _execute(cursor, "claim_idempotency_key",
+                """
+                INSERT INTO idempotency_keys (scope, key, request_hash)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (scope, key) DO NOTHING
+                RETURNING scope;
+                """,
+                (scope, key, request_hash)
+            )
+            if cursor.fetchone() is not None:
+                return None
+            _execute(cursor, "get_idempotency_key",
+                """
+                SELECT request_hash, status_code, response
+                FROM idempotency_keys 
+                WHERE scope = %s AND key = %s;
+                """,
+                (scope, key)
+            )
+            stored = cursor.fetchone()
+    return stored
+
+
+def save_idempotent_response(connection, scope, key, status_code, response):
+    """ Stores the response for a claimed key, retries with the key get this from now on """
+    with connection:
+        with connection.cursor() as cursor:
+            _execute(cursor, "save_idempotent_response",
+                """
+                UPDATE idempotency_keys 
+                SET status_code = %s, response = %s
+                WHERE scope = %s AND key = %s;
+                """,
+                (status_code, Json(response, dumps=lambda value: dumps(value).decode()), scope, key)
+            )
@@ -1,26 +1,422 @@
+import contextvars
+import itertools
 import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from dotenv import load_dotenv
+from psycopg2 import sql
 
 load_dotenv(override=True)
 
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 PASSWORD = os.getenv("PASSWORD")
 
+# Messages and notifications are partitioned by month on created_at
+# Partitions older than the retention window are dropped by maintain_partitions()
+PARTITION_RETENTION_MONTHS = {
+    "messages": int(os.getenv("MESSAGE_RETENTION_MONTHS", "24")),
+    "notifications": int(os.getenv("NOTIFICATION_RETENTION_MONTHS", "12")),
+}
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+
+# Stored responses for Idempotency-Key retries are purged by maintain after this long
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+
+# Connection pool size per worker process, and how long a request may wait for a free connection
+POOL_MIN_CONNECTIONS = int(os.getenv("POOL_MIN_CONNECTIONS", "1"))
+POOL_MAX_CONNECTIONS = int(os.getenv("POOL_MAX_CONNECTIONS", "10"))
+POOL_TIMEOUT_SECONDS = float(os.getenv("POOL_TIMEOUT_SECONDS", "10"))
+# How fast the average wait for a connection forgets old waits when nobody acquires one
+POOL_WAIT_HALF_LIFE_SECONDS = 1.0
+
+# statement_timeout per route cost class (see ratelimit.py) for connections used during a request, 0 = no limit
+# Scripts (migrations, maintain, stats) run without a timeout
+STATEMENT_TIMEOUTS_MS = {
+    "search": int(os.getenv("SEARCH_STATEMENT_TIMEOUT_MS", "3000")),
+    "list": int(os.getenv("LIST_STATEMENT_TIMEOUT_MS", "10000")),
+    "lookup": int(os.getenv("LOOKUP_STATEMENT_TIMEOUT_MS", "2000")),
+    "write": int(os.getenv("WRITE_STATEMENT_TIMEOUT_MS", "5000")),
+    "export": 0,
+}
+DEFAULT_STATEMENT_TIMEOUT_MS = int(os.getenv("STATEMENT_TIMEOUT_MS", "30000"))
+
+CONNECTION_PARAMS = {
+    "dbname": DATABASE_NAME,
+    "user": "postgres",
+    "password": PASSWORD,
+    "host": "localhost",
+    "port": "5432",
+}
+
+# Read replicas, comma separated libpq connection strings, e.g. "host=replica1 dbname=tradera user=postgres"
+REPLICA_DSNS = [dsn.strip() for dsn in os.getenv("REPLICA_DSNS", "").split(",") if dsn.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_CHECK_INTERVAL_SECONDS = float(os.getenv("REPLICA_CHECK_INTERVAL_SECONDS", "5"))
+# After a client writes, its reads go to the primary for this long so it sees its own changes
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+
+# Connections handed out during a request as (pool, connection), app.py returns them when the request is done
+request_connections = contextvars.ContextVar("request_connections", default=None)
+# Set by app.py for clients that wrote recently
+read_from_primary = contextvars.ContextVar("read_from_primary", default=False)
+# Set by app.py from the route, applied to every connection the request gets
+statement_timeout_ms = contextvars.ContextVar("statement_timeout_ms", default=None)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that remembers which statements were prepared on it
+    A new connection (e.g. after a reconnect) starts with an empty set, so db.py prepares again
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.statement_timeout_ms = None
+
+
+class ConnectionPool:
+    """
+    Thread safe pool that waits for a free connection instead of failing right away
+    psycopg2's ThreadedConnectionPool raises an error when all connections are in use
+    """
+
+    def __init__(self, min_connections, max_connections, **connection_params):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            min_connections,
+            max_connections,
+            connection_factory=PooledConnection,
+            **connection_params,
+        )
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.max_connections = max_connections
+        self.in_use = 0
+        # Moving average of how long acquire() waited, read by admission.py
+        self._wait_average = 0.0
+        self._wait_updated_at = time.monotonic()
+        self._stats_lock = threading.Lock()
+
+    def recent_wait_seconds(self):
+        """ Returns the average wait for a connection, decayed so it drops back to 0 when the waiting stops """
+        idle_seconds = time.monotonic() - self._wait_updated_at
+        return self._wait_average * 0.5 ** (idle_seconds / POOL_WAIT_HALF_LIFE_SECONDS)
+
+    def _record_wait(self, wait_seconds, acquired):
+        with self._stats_lock:
+            self._wait_average = 0.8 * self.recent_wait_seconds() + 0.2 * wait_seconds
+            self._wait_updated_at = time.monotonic()
+            if acquired:
+                self.in_use += 1
+
+    def acquire(self, timeout=POOL_TIMEOUT_SECONDS):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            self._record_wait(time.monotonic() - started, acquired=False)
+            raise psycopg2.pool.PoolError("Timed out waiting for a database connection")
+        self._record_wait(time.monotonic() - started, acquired=True)
+        try:
+            connection = self._pool.getconn()
+            # The server may have closed it while it was idle, replace it with a new one
+            if connection.closed:
+                self._pool.putconn(connection, close=True)
+                connection = self._pool.getconn()
+            try:
+                _apply_statement_timeout(connection)
+            except Exception:
+                self._pool.putconn(connection, close=True)
+                raise
+            return connection
+        except Exception:
+            self._release_slot()
+            raise
+
+    def _release_slot(self):
+        with self._stats_lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    def release(self, connection):
+        try:
+            if connection.closed:
+                self._pool.putconn(connection, close=True)
+                return
+            # Don't hand out a connection in the middle of a transaction
+            if connection.status != psycopg2.extensions.STATUS_READY:
+                connection.rollback()
+            self._pool.putconn(connection)
+        except Exception:
+            self._pool.putconn(connection, close=True)
+        finally:
+            self._release_slot()
+
+
+def _apply_statement_timeout(connection):
+    """ Sets the request's statement_timeout on a connection, only when it differs from what the connection has """
+    timeout = statement_timeout_ms.get()
+    if timeout is None or connection.statement_timeout_ms == timeout:
+        return
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SET statement_timeout = %s;", (timeout,))
+    connection.statement_timeout_ms = timeout
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ Returns the connection pool, it's created on first use so importing this file doesn't connect """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **CONNECTION_PARAMS
+                )
+    return _pool
+
+
+def primary_pool_load():
+    """ Returns (connections in use, pool size, recent wait for a connection in seconds) for the primary """
+    if _pool is None:
+        return 0, POOL_MAX_CONNECTIONS, 0.0
+    return _pool.in_use, _pool.max_connections, _pool.recent_wait_seconds()
+
+
 def get_connection():
     """
-    Function that returns a single connection
-    In reality, we might use a connection pool, since
-    This way we'll start a new connection each time
-    Someone hits one of our endpoints, which isn't great for performance
+    Function that returns a single connection to the primary
+    During a request the connection comes from the pool and is returned by app.py when the request ends,
+    outside of a request (scripts, migrations) a new connection is opened that the caller closes
     """
-    return psycopg2.connect(
-        dbname=DATABASE_NAME,
-        user="postgres",
-        password=PASSWORD,
-        host="localhost",
-        port="5432",
-    )
+    connections = request_connections.get()
+    if connections is None:
+        return psycopg2.connect(connection_factory=PooledConnection, **CONNECTION_PARAMS)
+    pool = get_pool()
+    connection = pool.acquire()
+    connections.append((pool, connection))
+    return connection
+
+
+def release_connection(connection):
+    """
+    Hands a connection from get_connection() back before the request ends, for routes that go on to slow work
+    without the database. Outside of a request the connection is closed
+    """
+    connections = request_connections.get()
+    if connections is None:
+        connection.close()
+        return
+    for position, (pool, request_connection) in enumerate(connections):
+        if request_connection is connection:
+            del connections[position]
+            pool.release(connection)
+            return
+
+
+def release_request_connections(connections):
+    """ Returns the connections used by a request to their pools """
+    for pool, connection in connections:
+        pool.release(connection)
+    connections.clear()
+
+
+# Unit of work
+class TransactionConnection:
+    """
+    Stands in for a connection inside unit_of_work()
+    db.py functions use it like any connection, but their own `with connection:` doesn't commit,
+    the unit of work commits (or rolls back) once at the end
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An error propagates to unit_of_work(), which rolls everything back
+        return False
+
+
+@contextmanager
+def unit_of_work(connection):
+    """
+    Runs several db.py calls in one transaction on one connection, e.g.
+        with unit_of_work(get_connection()) as connection:
+            transaction_id = db.create_transaction(connection, ...)
+            db.create_payment(connection, transaction_id, ...)
+    Everything is committed together at the end, or rolled back if anything raised
+    Since it's one transaction, a failing call can't be caught and skipped, the whole unit fails
+    """
+    with connection:
+        yield TransactionConnection(connection)
+
+
+# Read replicas
+class Replica:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.healthy = True
+        self.lag_seconds = 0.0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, dsn=self.dsn
+                    )
+        return self._pool
+
+    def check(self):
+        """ Marks the replica healthy if it answers, is streaming from the primary and isn't too far behind it """
+        try:
+            pool = self.get_pool()
+            connection = pool.acquire(timeout=1)
+            try:
+                with connection:
+                    with connection.cursor() as cursor:
+                        # A standby whose WAL receiver is down has replayed everything it received,
+                        # but falls further behind every second: it only counts as caught up while streaming.
+                        # status is NULL for roles without pg_read_all_stats, then a running receiver has to do
+                        cursor.execute(
+                            """
+                            WITH standby AS (
+                                SELECT pg_is_in_recovery() AS in_recovery,
+                                    EXISTS (
+                                        SELECT 1 FROM pg_stat_wal_receiver
+                                        WHERE COALESCE(status, 'streaming') = 'streaming'
+                                    ) AS streaming
+                            )
+                            SELECT in_recovery AND NOT streaming, COALESCE(CASE
+                                WHEN NOT in_recovery THEN 0
+                                WHEN streaming AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                            END, 0)
+                            FROM standby;
+                            """
+                        )
+                        disconnected, lag_seconds = cursor.fetchone()
+                        self.lag_seconds = float(lag_seconds)
+            finally:
+                pool.release(connection)
+            self.healthy = not disconnected and self.lag_seconds <= REPLICA_MAX_LAG_SECONDS
+        except Exception:
+            self.healthy = False
+
+
+replicas = [Replica(dsn) for dsn in REPLICA_DSNS]
+_next_replica = itertools.count()
+_health_checker = None
+
+
+def _check_replicas_forever():
+    while True:
+        for replica in replicas:
+            replica.check()
+        time.sleep(REPLICA_CHECK_INTERVAL_SECONDS)
+
+
+def start_replica_health_checks():
+    """ Starts the background thread that checks the replicas, once per process """
+    global _health_checker
+    if _health_checker is None and replicas:
+        with _pool_lock:
+            if _health_checker is None:
+                _health_checker = threading.Thread(target=_check_replicas_forever, daemon=True)
+                _health_checker.start()
+
+
+def _acquire_replica_connection():
+    """ Returns (pool, connection) from the next healthy replica, or None when there is none """
+    if not replicas:
+        return None
+    start_replica_health_checks()
+    first = next(_next_replica)
+    for offset in range(len(replicas)):
+        replica = replicas[(first + offset) % len(replicas)]
+        if not replica.healthy:
+            continue
+        try:
+            pool = replica.get_pool()
+            return pool, pool.acquire()
+        except (psycopg2.OperationalError, psycopg2.pool.PoolError):
+            # Skip it until the health check sees it again
+            replica.healthy = False
+    return None
+
+
+def get_read_connection():
+    """
+    Returns a connection for read-only queries
+    Replicas are used round robin, the primary is used when there are no healthy replicas,
+    outside of a request, or when the client wrote something recently (read your writes)
+    """
+    connections = request_connections.get()
+    if connections is None or read_from_primary.get():
+        return get_connection()
+    replica_connection = _acquire_replica_connection()
+    if replica_connection is None:
+        return get_connection()
+    connections.append(replica_connection)
+    return replica_connection[1]
+
+
+def acquire_streaming_connection():
+    """
+    Returns (pool, connection) for a read that outlives the request handler, e.g. a streamed response
+    The caller gives it back with pool.release(connection) when the stream is done
+    """
+    replica_connection = None if read_from_primary.get() else _acquire_replica_connection()
+    if replica_connection is not None:
+        return replica_connection
+    pool = get_pool()
+    return pool, pool.acquire()
+
+
+# Tables that are partitioned by created_at, used both to create them and to migrate plain tables
+MESSAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS "messages" (
+        id BIGSERIAL NOT NULL,
+        sender_id BIGINT NOT NULL REFERENCES "users"(id),
+        recipient_id BIGINT NOT NULL REFERENCES "users"(id),
+        listing_id BIGINT NOT NULL REFERENCES "listings"(id),
+        message_text TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        is_read BOOLEAN DEFAULT FALSE,
+        conversation_id BIGINT REFERENCES "conversations"(id),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+"""
+
+NOTIFICATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS "notifications" (
+        id BIGSERIAL NOT NULL,
+        user_id BIGINT NOT NULL REFERENCES "users"(id),
+        listing_id BIGINT NOT NULL REFERENCES "listings"(id),
+        notification_type VARCHAR(50) NOT NULL,
+        notification_message TEXT NOT NULL,
+        is_read BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+"""
+
 
 def create_tables():
     """
@@ -40,7 +436,8 @@ def create_tables():
             password VARCHAR(255) NOT NULL,
             user_since TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
             date_of_birth DATE NOT NULL,
-            phone_number VARCHAR(20)
+            phone_number VARCHAR(20),
+            deleted_at TIMESTAMP
         );
     """
     )
@@ -69,11 +466,316 @@ def create_tables():
             created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
             region VARCHAR(255) NOT NULL,
             status VARCHAR(255) NOT NULL DEFAULT 'active' CHECK (status IN ('active', 'sold', 'closed')),
-            description TEXT NOT NULL
+            description TEXT NOT NULL,
+            ends_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    """
+    )
+
+    # End time for auctions, used by the "ending soon" sort
+    cursor.execute(
+        """
+        ALTER TABLE listings ADD COLUMN IF NOT EXISTS ends_at TIMESTAMP;
+    """
+    )
+
+    # Soft delete: deleted rows stay until archive.py moves them to archived_rows
+    cursor.execute(
+        """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+        ALTER TABLE listings ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+    """
+    )
+
+    # Regions
+    # Reference list of regions with coordinates, listings.region is matched against it (see region_key)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "regions" (
+            id BIGSERIAL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL UNIQUE,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL
+        );
+
+        -- Bounding box lookups for /listings/nearby
+        CREATE INDEX IF NOT EXISTS regions_location_idx ON regions (latitude, longitude);
+
+        -- Other spellings people type, by region_key
+        CREATE TABLE IF NOT EXISTS "region_aliases" (
+            alias VARCHAR(255) PRIMARY KEY,
+            region_id BIGINT NOT NULL REFERENCES "regions"(id)
+        );
+
+        INSERT INTO regions (name, latitude, longitude) VALUES
+            ('Stockholm', 59.3293, 18.0686),
+            ('Göteborg', 57.7089, 11.9746),
+            ('Malmö', 55.605, 13.0038),
+            ('Uppsala', 59.8586, 17.6389),
+            ('Västerås', 59.6099, 16.5448),
+            ('Örebro', 59.2741, 15.2066),
+            ('Linköping', 58.4108, 15.6214),
+            ('Helsingborg', 56.0465, 12.6945),
+            ('Jönköping', 57.7826, 14.1618),
+            ('Norrköping', 58.5877, 16.1924),
+            ('Lund', 55.7047, 13.191),
+            ('Umeå', 63.8258, 20.263),
+            ('Gävle', 60.6749, 17.1413),
+            ('Borås', 57.721, 12.9401),
+            ('Södertälje', 59.1955, 17.6253),
+            ('Eskilstuna', 59.3666, 16.5077),
+            ('Halmstad', 56.6745, 12.8578),
+            ('Växjö', 56.8777, 14.8091),
+            ('Karlstad', 59.4022, 13.5115),
+            ('Sundsvall', 62.3908, 17.3069),
+            ('Luleå', 65.5848, 22.1547),
+            ('Östersund', 63.1792, 14.6357),
+            ('Trollhättan', 58.2837, 12.2886),
+            ('Kalmar', 56.6634, 16.3568),
+            ('Kristianstad', 56.0294, 14.1567),
+            ('Falun', 60.6065, 15.6355),
+            ('Karlskrona', 56.1612, 15.5869),
+            ('Skellefteå', 64.7507, 20.9528),
+            ('Visby', 57.6348, 18.2948),
+            ('Kiruna', 67.8558, 20.2253)
+        ON CONFLICT (name) DO NOTHING;
+    """
+    )
+
+    # Free text regions are normalized on the way in: "  goteborg" and "Gothenburg" both become Göteborg
+    cursor.execute(
+        """
+        CREATE OR REPLACE FUNCTION region_key(region TEXT) RETURNS TEXT AS $$
+            SELECT translate(lower(btrim(region)), 'åäöéü', 'aaoeu');
+        $$ LANGUAGE sql IMMUTABLE;
+
+        INSERT INTO region_aliases (alias, region_id)
+        SELECT region_key(name), id FROM regions
+        ON CONFLICT (alias) DO NOTHING;
+
+        INSERT INTO region_aliases (alias, region_id)
+        SELECT alias, (SELECT id FROM regions WHERE name = canonical)
+        FROM (VALUES ('gothenburg', 'Göteborg'), ('gbg', 'Göteborg'), ('sthlm', 'Stockholm')) a (alias, canonical)
+        ON CONFLICT (alias) DO NOTHING;
+
+        ALTER TABLE listings ADD COLUMN IF NOT EXISTS region_id BIGINT REFERENCES "regions"(id);
+
+        CREATE OR REPLACE FUNCTION listings_normalize_region() RETURNS TRIGGER AS $$
+        DECLARE
+            matched regions%ROWTYPE;
+        BEGIN
+            SELECT r.* INTO matched
+            FROM region_aliases a
+            JOIN regions r ON r.id = a.region_id
+            WHERE a.alias = region_key(NEW.region);
+            -- Regions that aren't in the list are kept as typed, they just can't be found by distance
+            NEW.region_id := matched.id;
+            NEW.region := COALESCE(matched.name, NEW.region);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS listings_region_trigger ON listings;
+        CREATE TRIGGER listings_region_trigger
+        BEFORE INSERT OR UPDATE OF region ON listings
+        FOR EACH ROW EXECUTE FUNCTION listings_normalize_region();
+
+        -- Listings from before the trigger, or typed before their region was added
+        UPDATE listings l SET region = l.region
+        WHERE region_id IS NULL
+        AND EXISTS (SELECT 1 FROM region_aliases a WHERE a.alias = region_key(l.region));
+
+        -- Newest active listings per region, /listings/nearby reads one short range of it per nearby region
+        CREATE INDEX IF NOT EXISTS listings_live_region_idx ON listings (region_id, id DESC)
+            WHERE status = 'active' AND deleted_at IS NULL;
+    """
+    )
+
+    # Browse sorts, each with the filters that are most often combined with them
+    # Only live listings are indexed, queries have to say deleted_at IS NULL to use them
+    cursor.execute(
+        """
+        DROP INDEX IF EXISTS listings_status_created_idx;
+        DROP INDEX IF EXISTS listings_category_created_idx;
+        DROP INDEX IF EXISTS listings_status_price_idx;
+        DROP INDEX IF EXISTS listings_ending_soon_idx;
+        CREATE INDEX IF NOT EXISTS listings_live_status_created_idx ON listings (status, created_at DESC, id DESC)
+            WHERE deleted_at IS NULL;
+        CREATE INDEX IF NOT EXISTS listings_live_category_created_idx ON listings (category_id, status, created_at DESC, id DESC)
+            WHERE deleted_at IS NULL;
+        CREATE INDEX IF NOT EXISTS listings_live_status_price_idx ON listings (status, price, id)
+            WHERE deleted_at IS NULL;
+        CREATE INDEX IF NOT EXISTS listings_live_ending_soon_idx ON listings (ends_at, id)
+            WHERE status = 'active' AND deleted_at IS NULL;
+    """
+    )
+
+    # The archiver only looks at deleted rows, which are few, so these indexes stay small
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS listings_deleted_idx ON listings (deleted_at) WHERE deleted_at IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS users_deleted_idx ON users (deleted_at) WHERE deleted_at IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS listings_user_idx ON listings (user_id);
+    """
+    )
+
+    # Listing_facets
+    # Number of listings per combination of facet values, kept up to date by a trigger on listings
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "listing_facets" (
+            category_id BIGINT NOT NULL,
+            region VARCHAR(255) NOT NULL,
+            listing_type VARCHAR(255) NOT NULL,
+            status VARCHAR(255) NOT NULL,
+            listing_count BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (category_id, region, listing_type, status)
+        );
+    """
+    )
+
+    # Moves a listing from its old facet combination to the new one, only when a facet column changed
+    cursor.execute(
+        """
+        CREATE OR REPLACE FUNCTION listing_facets_refresh() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                IF TG_OP = 'UPDATE'
+                    AND OLD.category_id = NEW.category_id AND OLD.region = NEW.region
+                    AND OLD.listing_type = NEW.listing_type AND OLD.status = NEW.status
+                    AND (OLD.deleted_at IS NULL) = (NEW.deleted_at IS NULL) THEN
+                    RETURN NEW;
+                END IF;
+                -- Deleted listings aren't counted
+                IF OLD.deleted_at IS NULL THEN
+                    UPDATE listing_facets SET listing_count = listing_count - 1
+                    WHERE category_id = OLD.category_id AND region = OLD.region
+                    AND listing_type = OLD.listing_type AND status = OLD.status;
+                END IF;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.deleted_at IS NULL THEN
+                INSERT INTO listing_facets (category_id, region, listing_type, status, listing_count)
+                VALUES (NEW.category_id, NEW.region, NEW.listing_type, NEW.status, 1)
+                ON CONFLICT (category_id, region, listing_type, status)
+                DO UPDATE SET listing_count = listing_facets.listing_count + 1;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS listings_facets_trigger ON listings;
+        CREATE TRIGGER listings_facets_trigger
+        AFTER INSERT OR UPDATE OR DELETE ON listings
+        FOR EACH ROW EXECUTE FUNCTION listing_facets_refresh();
+    """
+    )
+
+    # Similar listings, precomputed by similarity.py
+    # The most similar listings per listing, best first, so a listing page needs one primary key lookup
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "listing_similarities" (
+            listing_id BIGINT PRIMARY KEY,
+            similar_ids BIGINT[] NOT NULL,
+            scores REAL[] NOT NULL,
+            computed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Listings whose neighbours have to be worked out again
+        CREATE TABLE IF NOT EXISTS "similarity_queue" (
+            listing_id BIGINT PRIMARY KEY,
+            queued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        -- The transaction that last queued the listing: a rebuild only covers it when its snapshot saw that transaction
+        ALTER TABLE similarity_queue ADD COLUMN IF NOT EXISTS queued_xid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+        CREATE OR REPLACE FUNCTION queue_similarity_refresh() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO similarity_queue (listing_id) VALUES (NEW.id)
+            ON CONFLICT (listing_id) DO UPDATE SET queued_xid = EXCLUDED.queued_xid;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS listings_similarity_insert_trigger ON listings;
+        CREATE TRIGGER listings_similarity_insert_trigger
+        AFTER INSERT ON listings
+        FOR EACH ROW EXECUTE FUNCTION queue_similarity_refresh();
+
+        -- Only changes to what the similarity is based on
+        DROP TRIGGER IF EXISTS listings_similarity_update_trigger ON listings;
+        CREATE TRIGGER listings_similarity_update_trigger
+        AFTER UPDATE ON listings
+        FOR EACH ROW
+        WHEN (OLD.title IS DISTINCT FROM NEW.title OR OLD.description IS DISTINCT FROM NEW.description
+            OR OLD.category_id IS DISTINCT FROM NEW.category_id OR OLD.price IS DISTINCT FROM NEW.price
+            OR OLD.status IS DISTINCT FROM NEW.status OR OLD.deleted_at IS DISTINCT FROM NEW.deleted_at)
+        EXECUTE FUNCTION queue_similarity_refresh();
+    """
+    )
+
+    # Stats rollups, filled by stats.py from the rows created since the last refresh
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "daily_listing_stats" (
+            day DATE NOT NULL,
+            category_id BIGINT NOT NULL,
+            region VARCHAR(255) NOT NULL,
+            listings_created BIGINT NOT NULL,
+            PRIMARY KEY (day, category_id, region)
+        );
+
+        CREATE TABLE IF NOT EXISTS "daily_transaction_stats" (
+            day DATE NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            transaction_count BIGINT NOT NULL,
+            total_amount DECIMAL(14, 2) NOT NULL,
+            PRIMARY KEY (day, status)
+        );
+
+        CREATE TABLE IF NOT EXISTS "daily_payment_stats" (
+            day DATE NOT NULL,
+            payment_status VARCHAR(50) NOT NULL,
+            payment_count BIGINT NOT NULL,
+            total_amount DECIMAL(14, 2) NOT NULL,
+            PRIMARY KEY (day, payment_status)
+        );
+
+        CREATE TABLE IF NOT EXISTS "stats_watermarks" (
+            name VARCHAR(50) PRIMARY KEY,
+            refreshed_up_to TIMESTAMP NOT NULL
+        );
+
+        -- Days of a rollup whose rows changed after they were created, aggregated again by the next refresh
+        CREATE TABLE IF NOT EXISTS "stats_changed_days" (
+            name VARCHAR(50) NOT NULL,
+            day DATE NOT NULL,
+            PRIMARY KEY (name, day)
         );
     """
     )
 
+    # Idempotency keys
+    # One row per Idempotency-Key and endpoint, written in the same transaction as the request's own write
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "idempotency_keys" (
+            scope VARCHAR(50) NOT NULL,
+            key VARCHAR(255) NOT NULL,
+            request_hash CHAR(64) NOT NULL,
+            status_code SMALLINT,
+            response JSONB,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, key)
+        );
+
+        DROP INDEX IF EXISTS idx_idempotency_keys_created_at;
+        CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx
+        ON "idempotency_keys" (created_at);
+    """
+    )
+
     # Listings_watch_list
     cursor.execute(
         """
@@ -86,21 +788,91 @@ def create_tables():
     """
     )
 
-    # Messages
+    # Conversations
+    # One conversation per listing and pair of users, user_one_id is always the lower user id
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS "messages" (
+        CREATE TABLE IF NOT EXISTS "conversations" (
             id BIGSERIAL PRIMARY KEY,
-            sender_id BIGINT NOT NULL REFERENCES "users"(id),
-            recipient_id BIGINT NOT NULL REFERENCES "users"(id),
             listing_id BIGINT NOT NULL REFERENCES "listings"(id),
-            message_text TEXT NOT NULL,
+            user_one_id BIGINT NOT NULL REFERENCES "users"(id),
+            user_two_id BIGINT NOT NULL REFERENCES "users"(id),
+            last_message_id BIGINT,
+            last_message_at TIMESTAMP,
             created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            is_read BOOLEAN DEFAULT FALSE
+            UNIQUE (listing_id, user_one_id, user_two_id),
+            CHECK (user_one_id <= user_two_id)
+        );
+    """
+    )
+
+    # Conversation_participants
+    # One row per user and conversation, this is what the inbox reads
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "conversation_participants" (
+            conversation_id BIGINT NOT NULL REFERENCES "conversations"(id),
+            user_id BIGINT NOT NULL REFERENCES "users"(id),
+            last_message_at TIMESTAMP NOT NULL,
+            unread_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, conversation_id)
         );
     """
     )
 
+    # User_counters
+    # Unread counts kept up to date by db.py so badges don't need to count rows
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "user_counters" (
+            user_id BIGINT PRIMARY KEY REFERENCES "users"(id),
+            unread_notifications INT NOT NULL DEFAULT 0,
+            unread_messages INT NOT NULL DEFAULT 0
+        );
+    """
+    )
+
+    # Messages
+    # Partitioned by month, the primary key has to include the partition column
+    cursor.execute(MESSAGES_TABLE)
+
+    # Databases created before conversations existed need the column added
+    cursor.execute(
+        """
+        ALTER TABLE messages
+        ADD COLUMN IF NOT EXISTS conversation_id BIGINT REFERENCES "conversations"(id);
+    """
+    )
+
+    # Databases created before partitioning have a plain messages table
+    partition_existing_table(cursor, "messages", MESSAGES_TABLE)
+    create_partitions(cursor, "messages")
+
+    # Inbox: newest conversations first for a user, answered from the index alone
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS conversation_participants_inbox_idx
+        ON conversation_participants (user_id, last_message_at DESC)
+        INCLUDE (conversation_id, unread_count);
+    """
+    )
+
+    # Thread: newest messages first within a conversation
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS messages_conversation_idx
+        ON messages (conversation_id, id DESC);
+    """
+    )
+
+    # All messages for a user, one index per side of the conversation
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS messages_sender_idx ON messages (sender_id, id DESC);
+        CREATE INDEX IF NOT EXISTS messages_recipient_idx ON messages (recipient_id, id DESC);
+    """
+    )
+
     # Bids
     cursor.execute(
         """
@@ -114,6 +886,60 @@ def create_tables():
     """
     )
 
+    # Highest bid per listing, used when auctions are settled
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS bids_listing_amount_idx ON bids (listing_id, amount DESC, created_at);
+    """
+    )
+
+    # Home feeds, precomputed by feed.py from what users watch and bid on
+    # The feed of a user, best first, so every page of it is one primary key lookup
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "user_feeds" (
+            user_id BIGINT PRIMARY KEY,
+            listing_ids BIGINT[] NOT NULL,
+            scores REAL[] NOT NULL,
+            computed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Users whose feed has to be worked out again
+        CREATE TABLE IF NOT EXISTS "feed_queue" (
+            user_id BIGINT PRIMARY KEY,
+            queued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        -- The transaction that last queued the user, like similarity_queue.queued_xid
+        ALTER TABLE feed_queue ADD COLUMN IF NOT EXISTS queued_xid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+        -- A user's bids and watched listings, newest first, for building their feed
+        CREATE INDEX IF NOT EXISTS bids_user_created_idx ON bids (user_id, created_at DESC);
+
+        CREATE OR REPLACE FUNCTION queue_feed_refresh() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO feed_queue (user_id) VALUES (OLD.user_id)
+                ON CONFLICT (user_id) DO UPDATE SET queued_xid = EXCLUDED.queued_xid;
+            ELSE
+                INSERT INTO feed_queue (user_id) VALUES (NEW.user_id)
+                ON CONFLICT (user_id) DO UPDATE SET queued_xid = EXCLUDED.queued_xid;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS bids_feed_trigger ON bids;
+        CREATE TRIGGER bids_feed_trigger
+        AFTER INSERT ON bids
+        FOR EACH ROW EXECUTE FUNCTION queue_feed_refresh();
+
+        DROP TRIGGER IF EXISTS listings_watch_list_feed_trigger ON listings_watch_list;
+        CREATE TRIGGER listings_watch_list_feed_trigger
+        AFTER INSERT OR DELETE ON listings_watch_list
+        FOR EACH ROW EXECUTE FUNCTION queue_feed_refresh();
+    """
+    )
+
     # Transactions
     cursor.execute(
         """
@@ -144,6 +970,71 @@ def create_tables():
     """
     )
 
+    # Time range scans for the stats refresh, and the days changed rows belong to
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS listings_created_idx ON listings (created_at);
+        CREATE INDEX IF NOT EXISTS transactions_created_idx ON transactions (created_at);
+        CREATE INDEX IF NOT EXISTS payments_paid_idx ON payments (paid_at);
+
+        -- TG_ARGV[0] is the rollup in stats.py, TG_ARGV[1] the column that gives a row's day
+        CREATE OR REPLACE FUNCTION queue_stats_days() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO stats_changed_days (name, day)
+            SELECT TG_ARGV[0], changed.day
+            FROM (
+                SELECT (to_jsonb(OLD) ->> TG_ARGV[1])::date AS day
+                UNION
+                SELECT (to_jsonb(NEW) ->> TG_ARGV[1])::date WHERE TG_OP = 'UPDATE'
+            ) changed
+            WHERE changed.day IS NOT NULL
+            ON CONFLICT (name, day) DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Only changes to what the rollups group and sum by
+        DROP TRIGGER IF EXISTS listings_stats_update_trigger ON listings;
+        CREATE TRIGGER listings_stats_update_trigger
+        AFTER UPDATE ON listings
+        FOR EACH ROW
+        WHEN (OLD.created_at IS DISTINCT FROM NEW.created_at OR OLD.category_id IS DISTINCT FROM NEW.category_id
+            OR OLD.region IS DISTINCT FROM NEW.region)
+        EXECUTE FUNCTION queue_stats_days('listings', 'created_at');
+
+        DROP TRIGGER IF EXISTS listings_stats_delete_trigger ON listings;
+        CREATE TRIGGER listings_stats_delete_trigger
+        AFTER DELETE ON listings
+        FOR EACH ROW EXECUTE FUNCTION queue_stats_days('listings', 'created_at');
+
+        DROP TRIGGER IF EXISTS transactions_stats_update_trigger ON transactions;
+        CREATE TRIGGER transactions_stats_update_trigger
+        AFTER UPDATE ON transactions
+        FOR EACH ROW
+        WHEN (OLD.created_at IS DISTINCT FROM NEW.created_at OR OLD.status IS DISTINCT FROM NEW.status
+            OR OLD.amount IS DISTINCT FROM NEW.amount)
+        EXECUTE FUNCTION queue_stats_days('transactions', 'created_at');
+
+        DROP TRIGGER IF EXISTS transactions_stats_delete_trigger ON transactions;
+        CREATE TRIGGER transactions_stats_delete_trigger
+        AFTER DELETE ON transactions
+        FOR EACH ROW EXECUTE FUNCTION queue_stats_days('transactions', 'created_at');
+
+        DROP TRIGGER IF EXISTS payments_stats_update_trigger ON payments;
+        CREATE TRIGGER payments_stats_update_trigger
+        AFTER UPDATE ON payments
+        FOR EACH ROW
+        WHEN (OLD.paid_at IS DISTINCT FROM NEW.paid_at OR OLD.payment_status IS DISTINCT FROM NEW.payment_status
+            OR OLD.amount IS DISTINCT FROM NEW.amount)
+        EXECUTE FUNCTION queue_stats_days('payments', 'paid_at');
+
+        DROP TRIGGER IF EXISTS payments_stats_delete_trigger ON payments;
+        CREATE TRIGGER payments_stats_delete_trigger
+        AFTER DELETE ON payments
+        FOR EACH ROW EXECUTE FUNCTION queue_stats_days('payments', 'paid_at');
+    """
+    )
+
     # Images
     cursor.execute(
         """
@@ -152,11 +1043,19 @@ def create_tables():
             user_id BIGINT NOT NULL REFERENCES "users"(id),
             listing_id BIGINT NOT NULL REFERENCES "listings"(id), 
             image_url VARCHAR(500) NOT NULL,
-            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            content_hash CHAR(64)
         );
     """
     )
 
+    # SHA-256 of uploaded images (media.py), NULL for images added by URL
+    cursor.execute(
+        """
+        ALTER TABLE images ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+    """
+    )
+
     # User_ratings
     cursor.execute(
         """
@@ -185,20 +1084,39 @@ def create_tables():
     )
 
     # Notifications
+    # Partitioned by month, the primary key has to include the partition column
+    cursor.execute(NOTIFICATIONS_TABLE)
+    partition_existing_table(cursor, "notifications", NOTIFICATIONS_TABLE)
+    create_partitions(cursor, "notifications")
+
+    # Newest notifications first for a user
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS "notifications" (
-            id BIGSERIAL PRIMARY KEY NOT NULL,
-            user_id BIGINT NOT NULL REFERENCES "users"(id),
-            listing_id BIGINT NOT NULL REFERENCES "listings"(id),
-            notification_type VARCHAR(50) NOT NULL,
-            notification_message TEXT NOT NULL,
-            is_read BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        CREATE INDEX IF NOT EXISTS notifications_user_idx
+        ON notifications (user_id, created_at DESC);
+    """
+    )
+
+    # Notification_read_marks
+    # Everything with an id at or below read_up_to_id counts as read, without updating the rows
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "notification_read_marks" (
+            user_id BIGINT PRIMARY KEY REFERENCES "users"(id),
+            read_up_to_id BIGINT NOT NULL DEFAULT 0
         );
     """
     )
 
+    # Only unread notifications are indexed, read ones never need to be found by this index
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS notifications_unread_idx
+        ON notifications (user_id, id)
+        WHERE is_read = FALSE;
+    """
+    )
+
     # Reports
     cursor.execute(
         """
@@ -244,6 +1162,38 @@ def create_tables():
     """
     )
 
+    # Archived_rows
+    # Soft deleted listings and users, and the rows that referenced them, moved here by archive.py
+    # One JSONB table instead of a copy of every table, so archiving doesn't have to follow schema changes
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "archived_rows" (
+            id BIGSERIAL PRIMARY KEY,
+            table_name VARCHAR(50) NOT NULL,
+            row_data JSONB NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+    )
+
+    # Child rows of a listing, so archiving a batch of listings doesn't scan these tables
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS transactions_listing_idx ON transactions (listing_id);
+        CREATE INDEX IF NOT EXISTS transactions_bid_idx ON transactions (bid_id);
+        CREATE INDEX IF NOT EXISTS payments_transaction_idx ON payments (transaction_id);
+        CREATE INDEX IF NOT EXISTS payments_listing_idx ON payments (listing_id);
+        CREATE INDEX IF NOT EXISTS images_listing_idx ON images (listing_id);
+        CREATE INDEX IF NOT EXISTS reviews_listing_idx ON reviews (listing_id);
+        CREATE INDEX IF NOT EXISTS reports_listing_idx ON reports (listing_id);
+        CREATE INDEX IF NOT EXISTS listing_comments_listing_idx ON listing_comments (listing_id);
+        CREATE INDEX IF NOT EXISTS listings_watch_list_listing_idx ON listings_watch_list (listing_id);
+        CREATE INDEX IF NOT EXISTS shipping_details_listing_idx ON shipping_details (listing_id);
+        CREATE INDEX IF NOT EXISTS notifications_listing_idx ON notifications (listing_id);
+        CREATE INDEX IF NOT EXISTS messages_listing_idx ON messages (listing_id);
+    """
+    )
+
 # Some inserts for test data
 # Users
     cursor.execute(
@@ -409,11 +1359,376 @@ def create_tables():
         """
     )
 
+    backfill_conversations(cursor)
+    backfill_user_counters(cursor)
+    rebuild_listing_facets(cursor)
+
     connection.commit()
     cursor.close()
     connection.close()
 
+
+def backfill_conversations(cursor):
+    """
+    Groups messages that don't belong to a conversation yet into conversations
+    Rebuilds last message and unread counts for the participants
+    Can be run multiple times, only messages without a conversation are moved
+    """
+    # Create missing conversations (per listing + pair of users)
+    cursor.execute(
+        """
+        INSERT INTO conversations (listing_id, user_one_id, user_two_id, last_message_at)
+        SELECT listing_id, LEAST(sender_id, recipient_id), GREATEST(sender_id, recipient_id), MAX(created_at)
+        FROM messages
+        WHERE conversation_id IS NULL
+        GROUP BY listing_id, LEAST(sender_id, recipient_id), GREATEST(sender_id, recipient_id)
+        ON CONFLICT (listing_id, user_one_id, user_two_id) DO NOTHING;
+        """
+    )
+
+    # Point the messages at their conversation
+    cursor.execute(
+        """
+        UPDATE messages m
+        SET conversation_id = c.id
+        FROM conversations c
+        WHERE m.conversation_id IS NULL
+        AND c.listing_id = m.listing_id
+        AND c.user_one_id = LEAST(m.sender_id, m.recipient_id)
+        AND c.user_two_id = GREATEST(m.sender_id, m.recipient_id);
+        """
+    )
+
+    # Latest message per conversation
+    cursor.execute(
+        """
+        UPDATE conversations c
+        SET last_message_id = latest.id, last_message_at = latest.created_at
+        FROM (
+            SELECT DISTINCT ON (conversation_id) conversation_id, id, created_at
+            FROM messages
+            WHERE conversation_id IS NOT NULL
+            ORDER BY conversation_id, id DESC
+        ) latest
+        WHERE latest.conversation_id = c.id
+        AND c.last_message_id IS DISTINCT FROM latest.id;
+        """
+    )
+
+    # Inbox rows with unread counts for both users, messages to yourself are never unread
+    cursor.execute(
+        """
+        INSERT INTO conversation_participants (conversation_id, user_id, last_message_at, unread_count)
+        SELECT c.id, u.user_id, c.last_message_at,
+            (SELECT COUNT(*) FROM messages m
+             WHERE m.conversation_id = c.id AND m.recipient_id = u.user_id AND m.sender_id <> m.recipient_id
+             AND m.is_read = FALSE)
+        FROM conversations c
+        CROSS JOIN LATERAL (SELECT DISTINCT user_id FROM (VALUES (c.user_one_id), (c.user_two_id)) v(user_id)) u
+        WHERE c.last_message_at IS NOT NULL
+        ON CONFLICT (user_id, conversation_id) DO UPDATE
+        SET last_message_at = EXCLUDED.last_message_at, unread_count = EXCLUDED.unread_count;
+        """
+    )
+
+
+def recount_conversations(cursor):
+    """
+    Points conversations whose last message is gone at the latest message left (NULL when none is)
+    and recounts the unread messages of every inbox row that had any
+    Used after old messages partitions are dropped
+    """
+    cursor.execute(
+        """
+        UPDATE conversations c
+        SET last_message_id = latest.id, last_message_at = COALESCE(latest.created_at, c.last_message_at)
+        FROM conversations gone
+        LEFT JOIN LATERAL (
+            SELECT id, created_at FROM messages m
+            WHERE m.conversation_id = gone.id
+            ORDER BY id DESC
+            LIMIT 1
+        ) latest ON TRUE
+        WHERE gone.id = c.id
+        AND c.last_message_id IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.id = c.last_message_id);
+        """
+    )
+    # Same rule as everywhere else: messages to yourself are never unread
+    cursor.execute(
+        """
+        UPDATE conversation_participants p
+        SET unread_count = counted.unread_count
+        FROM (
+            SELECT p.conversation_id, p.user_id,
+                (SELECT COUNT(*) FROM messages m
+                 WHERE m.conversation_id = p.conversation_id AND m.recipient_id = p.user_id
+                 AND m.sender_id <> m.recipient_id AND m.is_read = FALSE) AS unread_count
+            FROM conversation_participants p
+            WHERE p.unread_count > 0
+        ) counted
+        WHERE p.conversation_id = counted.conversation_id AND p.user_id = counted.user_id
+        AND p.unread_count <> counted.unread_count;
+        """
+    )
+
+
+def backfill_user_counters(cursor):
+    """
+    Recounts unread notifications and messages for every user
+    Used when the counters table is created, or to repair counters that drifted
+    """
+    cursor.execute(
+        """
+        INSERT INTO user_counters (user_id, unread_notifications, unread_messages)
+        SELECT u.id,
+            (SELECT COUNT(*) FROM notifications n
+             WHERE n.user_id = u.id AND n.is_read = FALSE
+             AND n.id > COALESCE((SELECT read_up_to_id FROM notification_read_marks r WHERE r.user_id = u.id), 0)),
+            (SELECT COUNT(*) FROM messages m
+             WHERE m.recipient_id = u.id AND m.sender_id <> m.recipient_id AND m.is_read = FALSE)
+        FROM users u
+        ON CONFLICT (user_id) DO UPDATE
+        SET unread_notifications = EXCLUDED.unread_notifications,
+            unread_messages = EXCLUDED.unread_messages;
+        """
+    )
+
+
+def rebuild_listing_facets(cursor):
+    """
+    Recounts listing_facets from the listings table
+    The trigger keeps it up to date afterwards, this is only needed once or to repair it
+    """
+    # Block listing writes while counting so the trigger and the recount can't disagree
+    cursor.execute("LOCK TABLE listings IN SHARE MODE;")
+    cursor.execute("DELETE FROM listing_facets;")
+    cursor.execute(
+        """
+        INSERT INTO listing_facets (category_id, region, listing_type, status, listing_count)
+        SELECT category_id, region, listing_type, status, COUNT(*)
+        FROM listings
+        WHERE deleted_at IS NULL
+        GROUP BY category_id, region, listing_type, status;
+        """
+    )
+
+
+# Partitions
+def month_start(day, months_to_add=0):
+    """ Returns the first day of the month, moved by months_to_add months """
+    month_index = day.year * 12 + day.month - 1 + months_to_add
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(table_name, month):
+    return f"{table_name}_p{month.year}_{month.month:02d}"
+
+
+def create_partitions(cursor, table_name, from_month=None):
+    """
+    Creates monthly partitions from from_month (default: this month) up to PARTITION_MONTHS_AHEAD months ahead
+    Rows outside of all partitions end up in the default partition,
+    they are moved into a month's partition when it is created
+    """
+    this_month = month_start(date.today())
+    month = month_start(from_month or this_month)
+    last_month = month_start(this_month, PARTITION_MONTHS_AHEAD)
+    default_partition = f"{table_name}_default"
+    cursor.execute(
+        sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;").format(
+            sql.Identifier(default_partition), sql.Identifier(table_name)
+        )
+    )
+    while month <= last_month:
+        partition = partition_name(table_name, month)
+        cursor.execute("SELECT to_regclass(%s);", (partition,))
+        if cursor.fetchone()[0] is None:
+            create_partition(cursor, table_name, partition, month, month_start(month, 1))
+        month = month_start(month, 1)
+
+
+def create_partition(cursor, table_name, partition, from_day, to_day):
+    """
+    Creates the partition for created_at from from_day up to, not including, to_day
+    Postgres refuses to create it while the default partition has rows in that range (clock skew, late maintenance),
+    so these are moved out of the default partition while it's detached, then it's attached again
+    """
+    create_statement = sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);").format(
+        sql.Identifier(partition), sql.Identifier(table_name)
+    )
+    default_partition = sql.Identifier(f"{table_name}_default")
+    cursor.execute(
+        sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE created_at >= %s AND created_at < %s);").format(
+            default_partition
+        ),
+        (from_day, to_day),
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(create_statement, (from_day, to_day))
+        return
+
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position;",
+        (table_name,),
+    )
+    columns = sql.SQL(", ").join(sql.Identifier(column) for (column,) in cursor.fetchall())
+    # Detaching locks the table until the transaction ends, so no rows can land in the default partition meanwhile
+    cursor.execute(
+        sql.SQL("ALTER TABLE {} DETACH PARTITION {};").format(sql.Identifier(table_name), default_partition)
+    )
+    cursor.execute(create_statement, (from_day, to_day))
+    cursor.execute(
+        sql.SQL(
+            """
+            WITH moved AS (
+                DELETE FROM {}
+                WHERE created_at >= %s AND created_at < %s
+                RETURNING {}
+            )
+            INSERT INTO {} ({}) SELECT {} FROM moved;
+            """
+        ).format(default_partition, columns, sql.Identifier(partition), columns, columns),
+        (from_day, to_day),
+    )
+    cursor.execute(
+        sql.SQL("ALTER TABLE {} ATTACH PARTITION {} DEFAULT;").format(sql.Identifier(table_name), default_partition)
+    )
+
+
+def partition_existing_table(cursor, table_name, create_statement):
+    """
+    Moves a plain (not partitioned) table into a new partitioned table with the same name
+    Does nothing if the table is already partitioned
+    """
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE relname = %s AND relnamespace = 'public'::regnamespace;",
+        (table_name,),
+    )
+    row = cursor.fetchone()
+    if row is None or row[0] == "p":
+        return
+
+    old_table = f"{table_name}_unpartitioned"
+    cursor.execute(
+        sql.SQL("ALTER TABLE {} RENAME TO {};").format(
+            sql.Identifier(table_name), sql.Identifier(old_table)
+        )
+    )
+    # Index names are shared across the schema, free them up for the new table
+    cursor.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = %s;",
+        (old_table,),
+    )
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(
+            sql.SQL("ALTER INDEX {} RENAME TO {};").format(
+                sql.Identifier(index_name), sql.Identifier(f"{index_name}_unpartitioned")
+            )
+        )
+
+    cursor.execute(create_statement)
+    cursor.execute(
+        sql.SQL("SELECT MIN(created_at) FROM {};").format(sql.Identifier(old_table))
+    )
+    oldest = cursor.fetchone()[0]
+    create_partitions(cursor, table_name, oldest.date() if oldest else None)
+
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position;",
+        (table_name,),
+    )
+    columns = sql.SQL(", ").join(sql.Identifier(column) for (column,) in cursor.fetchall())
+    cursor.execute(
+        sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {};").format(
+            sql.Identifier(table_name), columns, columns, sql.Identifier(old_table)
+        )
+    )
+    # The new table got its own id sequence, continue after the copied ids
+    cursor.execute(
+        sql.SQL(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE((SELECT MAX(id) FROM {}), 0) + 1, false);"
+        ).format(sql.Identifier(table_name)),
+        (table_name,),
+    )
+    cursor.execute(sql.SQL("DROP TABLE {};").format(sql.Identifier(old_table)))
+
+
+def maintain_partitions():
+    """
+    Creates upcoming monthly partitions and drops the ones older than the retention window
+    Meant to be run once a day, e.g. from cron: python db_setup.py maintain
+    """
+    connection = get_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            dropped = []
+            purged_defaults = []
+            for table_name, retention_months in PARTITION_RETENTION_MONTHS.items():
+                create_partitions(cursor, table_name)
+                oldest_kept = month_start(date.today(), -retention_months)
+                cursor.execute(
+                    """
+                    SELECT c.relname
+                    FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = %s::regclass;
+                    """,
+                    (table_name,),
+                )
+                for (partition,) in cursor.fetchall():
+                    # Only monthly partitions are dropped, never the default partition
+                    suffix = partition[len(table_name) + 2:]
+                    if not partition.startswith(f"{table_name}_p") or len(suffix) != 7:
+                        continue
+                    year, month = suffix.split("_")
+                    if date(int(year), int(month), 1) < oldest_kept:
+                        cursor.execute(
+                            sql.SQL("DROP TABLE {};").format(sql.Identifier(partition))
+                        )
+                        dropped.append(partition)
+                # Expired rows that ended up in the default partition, e.g. from before partitioning
+                cursor.execute(
+                    sql.SQL("DELETE FROM {} WHERE created_at < %s;").format(
+                        sql.Identifier(f"{table_name}_default")
+                    ),
+                    (oldest_kept,),
+                )
+                if cursor.rowcount:
+                    purged_defaults.append(f"{table_name}_default")
+            # Dropped messages may have been the last or an unread message of a conversation
+            if any(partition.startswith("messages_") for partition in dropped + purged_defaults):
+                recount_conversations(cursor)
+            # Dropped notifications and messages may have been unread
+            if dropped or purged_defaults:
+                backfill_user_counters(cursor)
+    connection.close()
+    return dropped
+
+
+def purge_idempotency_keys():
+    """ Deletes idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS, returns how many """
+    connection = get_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM idempotency_keys
+                WHERE created_at < CURRENT_TIMESTAMP - make_interval(hours => %s);
+                """,
+                (IDEMPOTENCY_KEY_TTL_HOURS,),
+            )
+            purged = cursor.rowcount
+    connection.close()
+    return purged
+
+
 if __name__ == "__main__":
-    # Only reason to execute this file would be to create new tables, meaning it serves a migration file
-    create_tables()
-    print("Tables created successfully.")
+    if len(sys.argv) > 1 and sys.argv[1] == "maintain":
+        dropped_partitions = maintain_partitions()
+        print(f"Partitions maintained, dropped: {dropped_partitions or 'none'}")
+        print(f"Idempotency keys purged: {purge_idempotency_keys()}")
+    else:
+        # Only reason to execute this file would be to create new tables, meaning it serves a migration file
+        create_tables()
+        print("Tables created successfully.")
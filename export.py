@@ -0,0 +1,199 @@
+import os
+import queue
+import threading
+
+from psycopg2 import sql
+
+from db_setup import acquire_streaming_connection
+
+"""
+Streams transactions and payments out of the database for finance, as CSV, Arrow IPC or Parquet.
+Rows are never all in memory at once: CSV comes straight from COPY TO STDOUT,
+Arrow and Parquet are built from a server-side cursor one chunk at a time.
+pyarrow is only needed for the arrow and parquet formats.
+"""
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "10000"))
+# How many COPY chunks may wait for the client before the database side pauses
+EXPORT_QUEUE_CHUNKS = 16
+
+# table: (date column used for start/end, status column)
+EXPORT_TABLES = {
+    "transactions": ("created_at", "status"),
+    "payments": ("paid_at", "payment_status"),
+}
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def build_export_query(table, start=None, end=None, status=None):
+    """ Returns the SELECT for an export, start is inclusive and end exclusive """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Can't export {table}, use one of {', '.join(EXPORT_TABLES)}.")
+    date_column, status_column = EXPORT_TABLES[table]
+    conditions = []
+    if start is not None:
+        conditions.append(sql.SQL("{} >= {}").format(sql.Identifier(date_column), sql.Literal(start)))
+    if end is not None:
+        conditions.append(sql.SQL("{} < {}").format(sql.Identifier(date_column), sql.Literal(end)))
+    if status is not None:
+        conditions.append(sql.SQL("{} = {}").format(sql.Identifier(status_column), sql.Literal(status)))
+    where = sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("TRUE")
+    return sql.SQL("SELECT * FROM {} WHERE {} ORDER BY id").format(sql.Identifier(table), where)
+
+
+class _QueueWriter:
+    """ File-like object for copy_expert that hands every chunk to a bounded queue """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def write(self, data):
+        self.chunks.put(data)
+        return len(data)
+
+
+def stream_csv(table, start=None, end=None, status=None):
+    """ Yields the export as CSV chunks, straight from COPY TO STDOUT """
+    query = build_export_query(table, start, end, status)
+    pool, connection = acquire_streaming_connection()
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    finished = object()
+    errors = []
+
+    def copy():
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    copy_query = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)").format(query)
+                    cursor.copy_expert(copy_query.as_string(connection), _QueueWriter(chunks))
+        except Exception as error:
+            errors.append(error)
+        finally:
+            chunks.put(finished)
+
+    # COPY blocks until it's done, so it runs next to the generator and the queue limits memory
+    copy_thread = threading.Thread(target=copy, daemon=True)
+    copy_thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is finished:
+                break
+            yield chunk
+        if errors:
+            raise errors[0]
+    finally:
+        if copy_thread.is_alive():
+            # The client went away, stop the COPY and let the thread finish
+            connection.cancel()
+            while copy_thread.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        pool.release(connection)
+
+
+def _arrow_type(pyarrow, column):
+    """ Maps a psycopg2 column description to an Arrow type """
+    arrow_types = {
+        16: pyarrow.bool_(),
+        20: pyarrow.int64(),
+        21: pyarrow.int16(),
+        23: pyarrow.int32(),
+        700: pyarrow.float32(),
+        701: pyarrow.float64(),
+        1082: pyarrow.date32(),
+        1114: pyarrow.timestamp("us"),
+        1184: pyarrow.timestamp("us", tz="UTC"),
+    }
+    if column.type_code == 1700:
+        return pyarrow.decimal128(column.precision or 38, column.scale or 0)
+    return arrow_types.get(column.type_code, pyarrow.string())
+
+
+class _ChunkSink:
+    """ File-like object that collects what pyarrow writes until the generator picks it up """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_arrow(table, start=None, end=None, status=None, file_format="arrow"):
+    """ Yields the export as an Arrow IPC stream or a Parquet file, one record batch per chunk of rows """
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    query = build_export_query(table, start, end, status)
+    pool, connection = acquire_streaming_connection()
+    try:
+        with connection:
+            # Named cursor: rows stay on the server and are fetched EXPORT_CHUNK_ROWS at a time
+            with connection.cursor(name=f"export_{table}") as cursor:
+                cursor.itersize = EXPORT_CHUNK_ROWS
+                cursor.execute(query)
+                rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+                schema = pyarrow.schema(
+                    [(column.name, _arrow_type(pyarrow, column)) for column in cursor.description]
+                )
+                sink = _ChunkSink()
+                if file_format == "parquet":
+                    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+                else:
+                    writer = pyarrow.ipc.new_stream(sink, schema)
+                while rows:
+                    columns = list(zip(*rows))
+                    batch = pyarrow.RecordBatch.from_arrays(
+                        [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)],
+                        schema=schema,
+                    )
+                    writer.write_batch(batch)
+                    yield sink.take()
+                    rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+                writer.close()
+                yield sink.take()
+    finally:
+        pool.release(connection)
+
+
+def stream_export(table, file_format="csv", start=None, end=None, status=None):
+    """ Returns a generator with the export in the given format """
+    # Check everything up front, errors inside the generator would only show up after the response started
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format {file_format}, use one of {', '.join(EXPORT_FORMATS)}.")
+    build_export_query(table, start, end, status)
+    if file_format == "csv":
+        return stream_csv(table, start, end, status)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ValueError(f"The {file_format} format needs pyarrow, install it or use format=csv.")
+    return stream_arrow(table, start, end, status, file_format)
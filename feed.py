@@ -0,0 +1,324 @@
+import os
+import sys
+import time
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+import metrics
+from db_setup import get_connection
+
+"""
+Works out the home feed of every user who has bid on or watched listings lately and stores it in user_feeds,
+so every page of GET /users/{user_id}/feed is one primary key lookup.
+Listings are suggested for being similar to what the user watched or bid on (listing_similarities,
+filled by similarity.py), for being in the categories the user cares about, and for being popular right now.
+Recent bids and watches count more than old ones, bids more than watches.
+Listings the user already watched or bid on, and their own listings, are left out.
+
+Users are scored in batches of FEED_BATCH_SIZE: three queries per batch, then NumPy scores
+every (user, listing) pair of the batch at once and keeps the best FEED_LENGTH per user.
+Users are queued by the triggers on bids and listings_watch_list, and their feeds worked out again in between rebuilds.
+
+Needs numpy (pip install numpy), the API itself doesn't.
+Full rebuild: python feed.py
+Rebuild, then refresh queued users every FEED_POLL_SECONDS: python feed.py loop
+"""
+
+FEED_LENGTH = int(os.getenv("FEED_LENGTH", "200"))
+FEED_HISTORY_DAYS = int(os.getenv("FEED_HISTORY_DAYS", "90"))
+FEED_HALF_LIFE_DAYS = float(os.getenv("FEED_HALF_LIFE_DAYS", "14"))
+FEED_POPULAR_DAYS = int(os.getenv("FEED_POPULAR_DAYS", "7"))
+FEED_POPULAR_POOL = int(os.getenv("FEED_POPULAR_POOL", "500"))
+FEED_BATCH_SIZE = int(os.getenv("FEED_BATCH_SIZE", "500"))
+FEED_POLL_SECONDS = float(os.getenv("FEED_POLL_SECONDS", "30"))
+FEED_REBUILD_SECONDS = float(os.getenv("FEED_REBUILD_SECONDS", str(6 * 3600)))
+
+# A bid says more about what a user wants than watching a listing does
+BID_WEIGHT = 2.0
+WATCH_WEIGHT = 1.0
+
+SIMILAR_WEIGHT = 0.6
+CATEGORY_WEIGHT = 0.3
+POPULARITY_WEIGHT = 0.1
+
+# What the users watched and bid on lately, one row per user and listing, recent ones weigh more
+INTERACTIONS = """
+    SELECT i.user_id, i.listing_id, l.category_id,
+        SUM(i.weight * exp(-ln(2) * extract(epoch FROM LOCALTIMESTAMP - i.created_at) / 86400 / %(half_life)s))
+    FROM (
+        SELECT user_id, listing_id, created_at, %(watch_weight)s AS weight
+        FROM listings_watch_list
+        WHERE user_id = ANY(%(user_ids)s) AND created_at > LOCALTIMESTAMP - make_interval(days => %(days)s)
+        UNION ALL
+        SELECT user_id, listing_id, created_at, %(bid_weight)s
+        FROM bids
+        WHERE user_id = ANY(%(user_ids)s) AND created_at > LOCALTIMESTAMP - make_interval(days => %(days)s)
+    ) i
+    JOIN listings l ON l.id = i.listing_id AND l.deleted_at IS NULL
+    GROUP BY i.user_id, i.listing_id, l.category_id;
+"""
+
+# The listings similar to those, weighted by how much the user cared about the listing they're similar to
+SIMILAR = """
+    SELECT i.user_id, s.similar_id, i.weight * s.score
+    FROM unnest(%s::bigint[], %s::bigint[], %s::float8[]) AS i (user_id, listing_id, weight)
+    JOIN listing_similarities ls ON ls.listing_id = i.listing_id
+    CROSS JOIN LATERAL unnest(ls.similar_ids, ls.scores) AS s (similar_id, score);
+"""
+
+
+def _arrays(rows, *dtypes):
+    """ Returns the columns of rows as NumPy arrays """
+    columns = list(zip(*rows)) or [()] * len(dtypes)
+    return [np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes)]
+
+
+def _array_literal(values):
+    """ Returns values as a Postgres array literal, much faster for psycopg2 to send than a list """
+    return "{" + ",".join(map(str, values)) + "}"
+
+
+def score_feeds(user_ids, interactions, similar, candidates, popular, length=FEED_LENGTH):
+    """
+    Scores the candidate listings of a batch of users all at once
+    user_ids: sorted user ids of the batch
+    interactions: (user ids, listing ids, category ids, weights) of what they watched and bid on
+    similar: (user ids, listing ids, weights) of listings similar to those
+    candidates: (sorted listing ids, seller ids, category ids) of the active listings that can be suggested
+    popular: (listing ids, popularity from 0 to 1) of the popular listings, suggested to everyone
+    Returns {user_id: (listing ids, scores)}, best first
+    """
+    candidate_ids, sellers, candidate_categories = candidates
+    n_users, n_candidates = len(user_ids), len(candidate_ids)
+    feeds = {int(user_id): ([], []) for user_id in user_ids}
+    if not n_candidates:
+        return feeds
+
+    def candidate_rows(listing_ids):
+        # Row of each listing in candidates, -1 for listings that can't be suggested
+        rows = np.minimum(np.searchsorted(candidate_ids, listing_ids), n_candidates - 1)
+        return np.where(candidate_ids[rows] == listing_ids, rows, -1)
+
+    # Share of each user's interest per category, a users x categories matrix
+    interaction_users = np.searchsorted(user_ids, interactions[0])
+    categories, category_rows = np.unique(
+        np.concatenate((interactions[2], candidate_categories)), return_inverse=True
+    )
+    interaction_categories = category_rows[: len(interactions[2])]
+    candidate_category_rows = category_rows[len(interactions[2]) :]
+    affinity = np.bincount(
+        interaction_users * len(categories) + interaction_categories,
+        weights=interactions[3],
+        minlength=n_users * len(categories),
+    ).astype(np.float64).reshape(n_users, len(categories))  # bincount of no interactions at all is int64
+    totals = affinity.sum(axis=1, keepdims=True)
+    affinity /= np.where(totals > 0, totals, 1)
+
+    popularity = np.zeros(n_candidates)
+    popular_rows = candidate_rows(popular[0])
+    popularity[popular_rows[popular_rows >= 0]] = popular[1][popular_rows >= 0]
+    popular_rows = popular_rows[popular_rows >= 0]
+
+    # Every (user, listing) pair: the similar listings of each user, and the popular ones for everyone
+    similar_rows = candidate_rows(similar[1])
+    found = similar_rows >= 0
+    pair_keys = np.concatenate((
+        np.searchsorted(user_ids, similar[0][found]) * n_candidates + similar_rows[found],
+        np.repeat(np.arange(n_users), len(popular_rows)) * n_candidates + np.tile(popular_rows, n_users),
+    ))
+    pair_weights = np.concatenate((similar[2][found], np.zeros(n_users * len(popular_rows))))
+    pair_keys, inverse = np.unique(pair_keys, return_inverse=True)
+    # The best match among what the user cared about, a sum would let one interest crowd out the others
+    similarity = np.zeros(len(pair_keys))
+    np.maximum.at(similarity, inverse, pair_weights)
+    pair_users, pair_rows = pair_keys // n_candidates, pair_keys % n_candidates
+
+    # Similarity relative to the user's best match, so users with a long history don't get higher scores
+    best = np.zeros(n_users)
+    np.maximum.at(best, pair_users, similarity)
+    similarity /= np.where(best > 0, best, 1)[pair_users]
+    scores = (
+        SIMILAR_WEIGHT * similarity
+        + CATEGORY_WEIGHT * affinity[pair_users, candidate_category_rows[pair_rows]]
+        + POPULARITY_WEIGHT * popularity[pair_rows]
+    )
+
+    # Nothing the user watched or bid on already, and none of their own listings
+    seen_rows = candidate_rows(interactions[1])
+    seen_keys = (interaction_users * n_candidates + seen_rows)[seen_rows >= 0]
+    keep = ~np.isin(pair_keys, seen_keys) & (sellers[pair_rows] != user_ids[pair_users])
+    pair_users, pair_rows, scores = pair_users[keep], pair_rows[keep], scores[keep]
+
+    # Best first per user, then the first length of each user
+    order = np.lexsort((-scores, pair_users))
+    pair_users, pair_rows, scores = pair_users[order], pair_rows[order], scores[order]
+    user_starts = np.searchsorted(pair_users, np.arange(n_users + 1))
+    for row, user_id in enumerate(user_ids):
+        start, end = user_starts[row], min(user_starts[row + 1], user_starts[row] + length)
+        feeds[int(user_id)] = (candidate_ids[pair_rows[start:end]].tolist(), scores[start:end].round(4).tolist())
+    return feeds
+
+
+def popular_listings(cursor):
+    """ Returns (listing ids, popularity from 0 to 1) of the active listings with the most bids and watchers lately """
+    cursor.execute(
+        """
+        SELECT l.id, COUNT(*)
+        FROM (
+            SELECT listing_id FROM listings_watch_list WHERE created_at > LOCALTIMESTAMP - make_interval(days => %s)
+            UNION ALL
+            SELECT listing_id FROM bids WHERE created_at > LOCALTIMESTAMP - make_interval(days => %s)
+        ) a
+        JOIN listings l ON l.id = a.listing_id
+        WHERE l.status = 'active' AND l.deleted_at IS NULL
+        GROUP BY l.id
+        ORDER BY COUNT(*) DESC
+        LIMIT %s;
+        """,
+        (FEED_POPULAR_DAYS, FEED_POPULAR_DAYS, FEED_POPULAR_POOL),
+    )
+    listing_ids, counts = _arrays(cursor.fetchall(), np.int64, np.float64)
+    return listing_ids, counts / counts.max() if len(counts) else counts
+
+
+def build_feeds(cursor, user_ids, popular):
+    """ Works out and stores the feeds of a batch of users, returns how many """
+    user_ids = np.unique(np.array(user_ids, dtype=np.int64))
+    cursor.execute(
+        INTERACTIONS,
+        {
+            "user_ids": user_ids.tolist(),
+            "days": FEED_HISTORY_DAYS,
+            "half_life": FEED_HALF_LIFE_DAYS,
+            "watch_weight": WATCH_WEIGHT,
+            "bid_weight": BID_WEIGHT,
+        },
+    )
+    interactions = _arrays(cursor.fetchall(), np.int64, np.int64, np.int64, np.float64)
+    cursor.execute(SIMILAR, [column.tolist() for column in (interactions[0], interactions[1], interactions[3])])
+    similar = _arrays(cursor.fetchall(), np.int64, np.int64, np.float64)
+    cursor.execute(
+        """
+        SELECT l.id, l.user_id, l.category_id
+        FROM unnest(%s::bigint[]) AS c (id)
+        JOIN listings l ON l.id = c.id
+        WHERE l.status = 'active' AND l.deleted_at IS NULL
+        ORDER BY l.id;
+        """,
+        (np.union1d(similar[1], popular[0]).tolist(),),
+    )
+    candidates = _arrays(cursor.fetchall(), np.int64, np.int64, np.int64)
+    feeds = score_feeds(user_ids, interactions, similar, candidates, popular)
+    execute_values(
+        cursor,
+        """
+        INSERT INTO user_feeds (user_id, listing_ids, scores, computed_at)
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE
+        SET listing_ids = EXCLUDED.listing_ids, scores = EXCLUDED.scores, computed_at = EXCLUDED.computed_at;
+        """,
+        [
+            (user_id, _array_literal(listing_ids), _array_literal(scores))
+            for user_id, (listing_ids, scores) in feeds.items()
+        ],
+        template="(%s, %s::bigint[], %s::real[], CURRENT_TIMESTAMP)",
+        page_size=1000,
+    )
+    return len(feeds)
+
+
+def rebuild(connection, batch_size=FEED_BATCH_SIZE):
+    """ Rebuilds the feed of every user who bid or watched lately, returns the popular listings for refresh_queued """
+    started = time.perf_counter()
+    with connection:
+        with connection.cursor() as cursor:
+            # The batches below read later, so they see every transaction this snapshot sees
+            cursor.execute("SELECT LOCALTIMESTAMP, pg_current_snapshot()::text;")
+            read_at, snapshot = cursor.fetchone()
+            popular = popular_listings(cursor)
+            cursor.execute(
+                """
+                SELECT id FROM users u
+                WHERE deleted_at IS NULL AND (
+                    EXISTS (SELECT 1 FROM listings_watch_list w
+                        WHERE w.user_id = u.id AND w.created_at > LOCALTIMESTAMP - make_interval(days => %s))
+                    OR EXISTS (SELECT 1 FROM bids b
+                        WHERE b.user_id = u.id AND b.created_at > LOCALTIMESTAMP - make_interval(days => %s))
+                )
+                ORDER BY id;
+                """,
+                (FEED_HISTORY_DAYS, FEED_HISTORY_DAYS),
+            )
+            user_ids = [row[0] for row in cursor.fetchall()]
+    for batch_start in range(0, len(user_ids), batch_size):
+        # One transaction per batch, the API keeps reading the previous feeds meanwhile
+        with connection:
+            with connection.cursor() as cursor:
+                build_feeds(cursor, user_ids[batch_start : batch_start + batch_size], popular)
+    with connection:
+        with connection.cursor() as cursor:
+            # Only users queued by transactions the rebuild saw are covered by it,
+            # a bid or watch that committed after the rebuild started stays queued
+            cursor.execute(
+                "DELETE FROM feed_queue WHERE pg_visible_in_snapshot(queued_xid, %s::pg_snapshot);", (snapshot,)
+            )
+            # Feeds that weren't rebuilt belong to users who are deleted or haven't done anything lately
+            cursor.execute("DELETE FROM user_feeds WHERE computed_at < %s;", (read_at,))
+    metrics.observe("feed.rebuild_seconds", time.perf_counter() - started)
+    return popular
+
+
+def refresh_queued(connection, popular, batch_size=FEED_BATCH_SIZE):
+    """ Works out the feeds of up to batch_size queued users in one transaction, returns how many """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM feed_queue
+                WHERE user_id IN (
+                    SELECT user_id FROM feed_queue
+                    ORDER BY queued_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING user_id;
+                """,
+                (batch_size,),
+            )
+            queued_ids = [row[0] for row in cursor.fetchall()]
+            if not queued_ids:
+                return 0
+            cursor.execute("SELECT id FROM users WHERE id = ANY(%s) AND deleted_at IS NULL;", (queued_ids,))
+            user_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                "DELETE FROM user_feeds WHERE user_id = ANY(%s) AND NOT user_id = ANY(%s);", (queued_ids, user_ids)
+            )
+            if user_ids:
+                build_feeds(cursor, user_ids, popular)
+    metrics.increment("feed.refreshed", len(queued_ids))
+    return len(queued_ids)
+
+
+if __name__ == "__main__":
+    connection = get_connection()
+    try:
+        start = time.perf_counter()
+        popular = rebuild(connection)
+        rebuilt_at = time.monotonic()
+        print(f"Rebuilt feeds in {time.perf_counter() - start:.2f}s")
+        while len(sys.argv) > 1 and sys.argv[1] == "loop":
+            time.sleep(FEED_POLL_SECONDS)
+            if time.monotonic() - rebuilt_at > FEED_REBUILD_SECONDS:
+                popular = rebuild(connection)
+                rebuilt_at = time.monotonic()
+            refreshed = 0
+            while True:
+                batch = refresh_queued(connection, popular)
+                refreshed += batch
+                if batch < FEED_BATCH_SIZE:
+                    break
+            if refreshed:
+                print(f"Refreshed the feeds of {refreshed} users")
+    finally:
+        connection.close()
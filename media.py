@@ -0,0 +1,400 @@
+import collections
+import hashlib
+import mimetypes
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import formatdate, parsedate_to_datetime
+
+import anyio
+from starlette.responses import Response
+
+import metrics
+
+"""
+Uploaded images, stored on local disk under the SHA-256 of their content: the same file uploaded twice is stored once.
+Every upload gets a thumbnail per THUMBNAIL_SIZES, made in a process pool since decoding and resizing is CPU bound.
+Files never change once written, so their URLs can be cached forever by browsers and CDNs,
+and the server can keep hot thumbnails in memory (MEDIA_CACHE_BYTES) without ever checking them again.
+Pillow is optional (pip install pillow): without it uploads are turned away, stored files are still served.
+
+Layout: MEDIA_DIR/<variant>/<first two hash characters>/<hash>.<extension>
+variant is "original" or a thumbnail size name, thumbnails are always JPEG.
+"""
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+IMAGE_UPLOADS_ENABLED = Image is not None
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+# Larger images are refused before they are decoded, a small file can expand to gigabytes of pixels
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "40000000"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+IMAGE_PROCESS_TIMEOUT_SECONDS = float(os.getenv("IMAGE_PROCESS_TIMEOUT_SECONDS", "30"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "82"))
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Memory per worker for hot files, only files up to MEDIA_CACHE_MAX_FILE_BYTES (thumbnails) are kept
+MEDIA_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_BYTES", str(64 * 1024 * 1024)))
+MEDIA_CACHE_MAX_FILE_BYTES = int(os.getenv("MEDIA_CACHE_MAX_FILE_BYTES", str(256 * 1024)))
+
+# Size name: longest side in pixels, largest first so each thumbnail is made from the previous one
+THUMBNAIL_SIZES = {"large": 1200, "medium": 600, "small": 200}
+# Accepted upload formats (as Pillow names them): extension of the stored original
+IMAGE_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+_FILENAME = re.compile(r"^[0-9a-f]{64}\.(jpg|png|webp|gif)$")
+_CHUNK_BYTES = 1024 * 1024
+_SEND_CHUNK_BYTES = 256 * 1024
+
+
+def media_path(variant, filename):
+    """ Returns where a stored file lives on disk """
+    return os.path.join(MEDIA_DIR, variant, filename[:2], filename)
+
+
+def media_url(variant, filename):
+    """ Returns the URL a stored file is served at """
+    return f"/media/{variant}/{filename}"
+
+
+def resolve_media_path(variant, filename):
+    """ Returns the disk path for a media URL, or None if it can't be a stored file (keeps ../ out) """
+    if variant != "original" and variant not in THUMBNAIL_SIZES:
+        return None
+    if not _FILENAME.match(filename):
+        return None
+    return media_path(variant, filename)
+
+
+def _thumbnail_urls(digest):
+    return {name: media_url(name, f"{digest}.jpg") for name in THUMBNAIL_SIZES}
+
+
+def _stored_original(digest):
+    """ Returns the filename of an already stored original with this hash, or None """
+    for extension in IMAGE_FORMATS.values():
+        filename = f"{digest}.{extension}"
+        if os.path.exists(media_path("original", filename)):
+            return filename
+    return None
+
+
+def _receive(fileobj):
+    """ Copies an upload to a temporary file while hashing it, returns (hash, temporary path) """
+    temporary_dir = os.path.join(MEDIA_DIR, "tmp")
+    os.makedirs(temporary_dir, exist_ok=True)
+    # Same file system as the final location, so moving it there is a rename
+    temporary_path = os.path.join(temporary_dir, f"{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}")
+    digest = hashlib.sha256()
+    size = 0
+    with open(temporary_path, "wb") as temporary_file:
+        while chunk := fileobj.read(_CHUNK_BYTES):
+            size += len(chunk)
+            if size > IMAGE_MAX_BYTES:
+                temporary_file.close()
+                os.remove(temporary_path)
+                raise ValueError(f"Image is larger than {IMAGE_MAX_BYTES} bytes.")
+            digest.update(chunk)
+            temporary_file.write(chunk)
+    if size == 0:
+        os.remove(temporary_path)
+        raise ValueError("The uploaded file is empty.")
+    return digest.hexdigest(), temporary_path
+
+
+def _save_jpeg(image, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written next to the final path and renamed, so a half-written thumbnail is never served
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    image.save(temporary_path, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    os.replace(temporary_path, path)
+
+
+def _process_image(temporary_path, digest):
+    """
+    Runs in the process pool: checks the upload is an image, makes the missing thumbnails
+    and moves the original into place, returns the original's filename
+    """
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    try:
+        with Image.open(temporary_path) as image:
+            extension = IMAGE_FORMATS.get(image.format)
+            if extension is None:
+                raise ValueError(f"Unsupported image format {image.format}, use JPEG, PNG, WebP or GIF.")
+            if image.width * image.height > IMAGE_MAX_PIXELS:
+                raise ValueError(f"Image has more than {IMAGE_MAX_PIXELS} pixels.")
+            # JPEGs can be decoded at a fraction of their size, much cheaper when only thumbnails are needed
+            image.draft("RGB", (max(THUMBNAIL_SIZES.values()),) * 2)
+            thumbnail = ImageOps.exif_transpose(image).convert("RGB")
+            for name, longest_side in THUMBNAIL_SIZES.items():
+                path = media_path(name, f"{digest}.jpg")
+                thumbnail.thumbnail((longest_side, longest_side))
+                if not os.path.exists(path):
+                    _save_jpeg(thumbnail, path)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as error:
+        # Pillow's own exceptions are turned into ValueError, which is what the route expects for bad input
+        raise ValueError("The uploaded file is not a valid image.") from error
+    filename = f"{digest}.{extension}"
+    original_path = media_path("original", filename)
+    os.makedirs(os.path.dirname(original_path), exist_ok=True)
+    os.replace(temporary_path, original_path)
+    return filename
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, forking a process that runs threads can copy locks that are held
+            _pool = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+    return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def ingest_image(fileobj):
+    """
+    Stores an uploaded image and its thumbnails, raises ValueError if it isn't an acceptable image
+    Raises TimeoutError after IMAGE_PROCESS_TIMEOUT_SECONDS and BrokenProcessPool if a worker died
+    Returns {"hash", "original", "thumbnails": {size name: URL}}
+    """
+    started = time.perf_counter()
+    digest, temporary_path = _receive(fileobj)
+    try:
+        filename = _stored_original(digest)
+        if filename is not None and all(
+            os.path.exists(media_path(name, f"{digest}.jpg")) for name in THUMBNAIL_SIZES
+        ):
+            metrics.increment("images.uploaded", outcome="deduplicated")
+        else:
+            pool = _get_pool()
+            try:
+                filename = pool.submit(_process_image, temporary_path, digest).result(
+                    timeout=IMAGE_PROCESS_TIMEOUT_SECONDS
+                )
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory), the pool takes no more work: the next upload gets a new one
+                _discard_pool(pool)
+                raise
+            metrics.increment("images.uploaded", outcome="stored")
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    metrics.observe("images.ingest_seconds", time.perf_counter() - started)
+    return {
+        "hash": digest,
+        "original": media_url("original", filename),
+        "thumbnails": _thumbnail_urls(digest),
+    }
+
+
+# Serving
+_StoredFile = collections.namedtuple("_StoredFile", "size mtime last_modified body")
+
+
+class _LRUFileCache:
+    """ Stored files by path, the least recently used are dropped once max_bytes is reached """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            stored = self._entries.get(path)
+            if stored is not None:
+                self._entries.move_to_end(path)
+            return stored
+
+    def put(self, path, stored):
+        # Files never change, so an entry is never replaced or invalidated
+        if len(stored.body) > self.max_bytes:
+            return
+        with self._lock:
+            if path in self._entries:
+                return
+            self._entries[path] = stored
+            self.size += len(stored.body)
+            while self.size > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped.body)
+
+
+_file_cache = _LRUFileCache(MEDIA_CACHE_BYTES)
+
+
+def _load(path):
+    """ Stats a stored file and reads it if it is small enough to keep in memory, None if it doesn't exist """
+    try:
+        with open(path, "rb") as file:
+            stat_result = os.fstat(file.fileno())
+            body = file.read() if stat_result.st_size <= MEDIA_CACHE_MAX_FILE_BYTES else None
+    except FileNotFoundError:
+        return None
+    stored = _StoredFile(
+        stat_result.st_size, stat_result.st_mtime, formatdate(stat_result.st_mtime, usegmt=True), body
+    )
+    if body is not None:
+        _file_cache.put(path, stored)
+    return stored
+
+
+def _open_at(path, position):
+    file = open(path, "rb")
+    file.seek(position)
+    return file
+
+
+class _RangeNotSatisfiable(Exception):
+    pass
+
+
+def _byte_range(range_header, size):
+    """
+    Returns the (first, last) byte of a single range request, or None to send the whole file
+    Malformed and multi-range headers get the whole file, which the HTTP spec allows
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            # bytes=-500: the last 500 bytes
+            suffix = int(last)
+            if suffix <= 0:
+                raise _RangeNotSatisfiable()
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise _RangeNotSatisfiable()
+    if start > end:
+        return None
+    return start, end
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def _not_modified_since(if_modified_since, stored):
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have whole seconds
+    return int(stored.mtime) <= since
+
+
+class _StoredFileResponse(Response):
+    """
+    Sends (part of) a file that is too big for the memory cache, reading it in chunks in worker threads
+    A whole file is handed to the server instead when it supports http.response.pathsend (uvicorn doesn't)
+    """
+
+    def __init__(self, path, start, end, status_code, headers, media_type):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.status_code == 200 and "http.response.pathsend" in scope.get("extensions", {}):
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+            return
+        file = await anyio.to_thread.run_sync(_open_at, self.path, self.start)
+        try:
+            remaining = self.end - self.start + 1
+            while True:
+                # A cold file waits on the disk, which mustn't hold up the event loop
+                chunk = await anyio.to_thread.run_sync(file.read, min(_SEND_CHUNK_BYTES, remaining))
+                remaining -= len(chunk)
+                # An empty read means the file shrank, end the body rather than wait for bytes that won't come
+                done = not chunk or remaining <= 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": not done})
+                if done:
+                    break
+        finally:
+            file.close()
+
+
+async def media_response(variant, filename, request_headers):
+    """
+    Returns the response for GET /media/{variant}/{filename}, None if there is no such file
+    Handles If-None-Match, If-Modified-Since, If-Range and single byte ranges
+    """
+    path = resolve_media_path(variant, filename)
+    if path is None:
+        return None
+    # The file name is the content hash, so the ETag is known without reading the file
+    etag = f'"{variant}-{filename}"'
+    headers = {"Cache-Control": MEDIA_CACHE_CONTROL, "ETag": etag, "Accept-Ranges": "bytes"}
+    stored = _file_cache.get(path)
+    outcome = "memory"
+    if stored is None:
+        stored = await anyio.to_thread.run_sync(_load, path)
+        if stored is None:
+            return None
+        outcome = "disk"
+    headers["Last-Modified"] = stored.last_modified
+    # Only once the file is known to exist, If-None-Match: * (or a guessed tag) must not 304 a missing file
+    if _etag_matches(request_headers.get("if-none-match"), etag):
+        metrics.increment("media.served", outcome="not_modified")
+        return Response(status_code=304, headers=headers)
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since and "if-none-match" not in request_headers and _not_modified_since(
+        if_modified_since, stored
+    ):
+        metrics.increment("media.served", outcome="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    status_code, start, end = 200, 0, stored.size - 1
+    range_header = request_headers.get("range")
+    # If-Range: only send the range if the client's copy is still the current one
+    if range_header and request_headers.get("if-range", etag) in (etag, stored.last_modified):
+        try:
+            byte_range = _byte_range(range_header, stored.size)
+        except _RangeNotSatisfiable:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{stored.size}"})
+        if byte_range is not None:
+            status_code, (start, end) = 206, byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stored.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    media_type = mimetypes.guess_type(filename)[0]
+    metrics.increment("media.served", outcome=outcome)
+    if stored.body is not None:
+        body = stored.body if status_code == 200 else stored.body[start:end + 1]
+        return Response(body, status_code=status_code, headers=headers, media_type=media_type)
+    return _StoredFileResponse(path, start, end, status_code, headers, media_type)
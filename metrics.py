@@ -0,0 +1,61 @@
+import threading
+
+"""
+Small in-process metrics: counters and timings, read at GET /metrics.
+Every worker process keeps its own numbers, so a scraper has to add them up across workers.
+"""
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_timings = {}  # (name, labels) -> [count, total, max]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """ Adds value to a counter, e.g. increment("compression.bytes_in", 512, encoding="gzip") """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """ Records one measurement (seconds, a ratio ...) of a timing """
+    key = _key(name, labels)
+    with _lock:
+        timing = _timings.get(key)
+        if timing is None:
+            _timings[key] = [1, value, value]
+        else:
+            timing[0] += 1
+            timing[1] += value
+            timing[2] = max(timing[2], value)
+
+
+def snapshot():
+    """ Returns all counters and timings as lists of dictionaries """
+    with _lock:
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_counters.items())
+        ]
+        timings = [
+            {
+                "name": name,
+                "labels": dict(labels),
+                "count": count,
+                "total": total,
+                "average": total / count,
+                "max": maximum,
+            }
+            for (name, labels), (count, total, maximum) in sorted(_timings.items())
+        ]
+    return {"counters": counters, "timings": timings}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
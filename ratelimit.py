@@ -0,0 +1,191 @@
+import math
+import os
+import threading
+import time
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+import metrics
+
+"""
+Token bucket rate limiting per client and route cost class.
+Every client gets one bucket per cost class, so a scraper that burns through its search budget
+can still open listings by id. Buckets live in memory per worker process unless RATE_LIMIT_REDIS_URL
+is set (needs the redis package), then all workers share them.
+"""
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# When an auth proxy in front of the app sets a user header (e.g. X-User-Id), clients are limited by that instead of IP
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER")
+# Only trust X-Forwarded-For when running behind a proxy that sets it
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+RATE_LIMIT_MAX_BUCKETS = 100000
+
+# cost class: (tokens refilled per second, bucket size)
+RATE_LIMITS = {
+    "search": (1, 10),  # ILIKE scans and browse with facets
+    "export": (0.1, 2),
+    "list": (2, 20),  # Full-table lists
+    "write": (5, 30),
+    "lookup": (20, 100),  # Lookups by id
+}
+# Override with e.g. RATE_LIMITS="search=0.5/5,list=1/10"
+for _limit in os.getenv("RATE_LIMITS", "").split(","):
+    if "=" in _limit:
+        _cost_class, _, _value = _limit.partition("=")
+        _rate, _, _burst = _value.partition("/")
+        RATE_LIMITS[_cost_class.strip()] = (float(_rate), float(_burst))
+
+# Routes that don't follow the defaults in route_cost_class, None means not limited
+ROUTE_COST_CLASSES = {
+    ("GET", "/listings/search"): "search",
+    ("GET", "/listings/browse"): "search",
+    ("GET", "/listings/nearby"): "search",
+    ("GET", "/transactions/export"): "export",
+    ("GET", "/payments/export"): "export",
+    ("GET", "/metrics"): None,
+    # Files on disk, no database work, and a listing grid loads dozens at once
+    ("GET", "/media/{variant}/{filename}"): None,
+    ("GET", "/docs"): None,
+    ("GET", "/openapi.json"): None,
+}
+
+
+def route_cost_class(scope):
+    """
+    Returns the cost class of the route a request goes to
+    GET without path parameters is a full list, GET with them a lookup, everything else a write
+    """
+    if "cost_class" in scope:
+        # Already worked out by an earlier middleware
+        return scope["cost_class"]
+    method = scope["method"]
+    path = scope["path"]
+    for route in scope["app"].router.routes:
+        # Cheaper than route.matches(), which also converts the path parameters
+        if method in getattr(route, "methods", ()) and route.path_regex.match(path):
+            path = route.path
+            break
+    if (method, path) in ROUTE_COST_CLASSES:
+        cost_class = ROUTE_COST_CLASSES[(method, path)]
+    elif method in ("GET", "HEAD"):
+        cost_class = "lookup" if "{" in path else "list"
+    else:
+        cost_class = "write"
+    scope["cost_class"] = cost_class
+    return cost_class
+
+
+def client_key(scope):
+    """ Returns who a request counts against: the user header if configured, otherwise the client IP """
+    headers = Headers(scope=scope)
+    if RATE_LIMIT_KEY_HEADER and headers.get(RATE_LIMIT_KEY_HEADER):
+        return f"user:{headers[RATE_LIMIT_KEY_HEADER]}"
+    if RATE_LIMIT_TRUST_FORWARDED and headers.get("x-forwarded-for"):
+        return f"ip:{headers['x-forwarded-for'].split(',')[0].strip()}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class MemoryBuckets:
+    """ Token buckets of this worker process """
+
+    def __init__(self, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = {}  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    async def take(self, key, rate, burst, cost=1):
+        """ Returns 0 if the request may go ahead, otherwise how many seconds until it may """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._drop_full_buckets(now)
+                bucket = self._buckets[key] = [burst, now]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return 0
+            bucket[0] = tokens
+            return (cost - tokens) / rate
+
+    def _drop_full_buckets(self, now):
+        # A bucket that has refilled completely is the same as no bucket
+        for key, (tokens, updated_at) in list(self._buckets.items()):
+            cost_class = key.rsplit("|", 1)[-1]
+            rate, burst = RATE_LIMITS.get(cost_class, (1, 1))
+            if tokens + (now - updated_at) * rate >= burst:
+                del self._buckets[key]
+        if len(self._buckets) >= self.max_buckets:
+            self._buckets.clear()
+
+
+# Same bucket logic as MemoryBuckets.take, run atomically inside Redis
+_REDIS_TAKE = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local rate, burst, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """ Token buckets shared by all workers through Redis """
+
+    def __init__(self, url):
+        import redis.asyncio
+
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self._take = self._redis.register_script(_REDIS_TAKE)
+
+    async def take(self, key, rate, burst, cost=1):
+        """ Returns 0 if the request may go ahead, otherwise how many seconds until it may """
+        wait = await self._take(keys=[f"ratelimit:{key}"], args=[rate, burst, time.time(), cost])
+        return float(wait)
+
+
+class RateLimitMiddleware:
+    """ ASGI middleware, add it with app.add_middleware(RateLimitMiddleware) """
+
+    def __init__(self, app, buckets=None):
+        self.app = app
+        if buckets is None:
+            buckets = RedisBuckets(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryBuckets()
+        self.buckets = buckets
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        cost_class = route_cost_class(scope)
+        if cost_class is None:
+            await self.app(scope, receive, send)
+            return
+        rate, burst = RATE_LIMITS[cost_class]
+        wait = await self.buckets.take(f"{client_key(scope)}|{cost_class}", rate, burst)
+        if wait > 0:
+            metrics.increment("ratelimit.throttled", cost_class=cost_class)
+            retry_after = math.ceil(wait)
+            response = JSONResponse(
+                {"detail": f"Too many requests, try again in {retry_after} seconds."},
+                status_code=429,
+                headers={"Retry-After": str(retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -0,0 +1,302 @@
+import collections
+import os
+import re
+import sys
+import time
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+import metrics
+from db_setup import get_connection
+
+"""
+Works out the most similar listings for every listing and stores them in listing_similarities,
+so GET /listings/{id}/similar is one primary key lookup.
+Similarity is TF-IDF cosine over title and description (title words count double),
+plus a bonus for the same category and for a similar price. Only active listings are suggested.
+
+A full rebuild builds the TF-IDF index in memory (NumPy arrays, an inverted index per word)
+and scores every listing against it. In between, listings queued by the triggers on listings
+(created, or title, description, category, price or status changed) are scored against that index,
+and they are added to the stored lists of the listings they are now similar to.
+New words only count after the next full rebuild.
+
+Needs numpy (pip install numpy), the API itself doesn't.
+Full rebuild: python similarity.py
+Rebuild, then refresh queued listings every SIMILARITY_POLL_SECONDS: python similarity.py loop
+"""
+
+SIMILAR_LISTINGS_STORED = int(os.getenv("SIMILAR_LISTINGS_STORED", "20"))
+SIMILARITY_POLL_SECONDS = float(os.getenv("SIMILARITY_POLL_SECONDS", "30"))
+SIMILARITY_REBUILD_SECONDS = float(os.getenv("SIMILARITY_REBUILD_SECONDS", str(24 * 3600)))
+SIMILARITY_BATCH_SIZE = int(os.getenv("SIMILARITY_BATCH_SIZE", "1000"))
+# Words in more than this share of listings say little about them and make scoring slow, they are ignored
+SIMILARITY_MAX_DOCUMENT_SHARE = float(os.getenv("SIMILARITY_MAX_DOCUMENT_SHARE", "0.1"))
+
+TEXT_WEIGHT = 0.7
+CATEGORY_WEIGHT = 0.2
+PRICE_WEIGHT = 0.1
+
+_WORD = re.compile(r"\w{2,}")
+
+
+def word_counts(title, description):
+    """ Returns how often each word occurs, title words count double """
+    counts = collections.Counter(_WORD.findall(title.lower()) * 2)
+    counts.update(_WORD.findall((description or "").lower()))
+    return counts
+
+
+class SimilarityIndex:
+    """ TF-IDF vectors of the active listings, with an inverted index (word -> listings) as flat arrays """
+
+    def __init__(self, rows):
+        """ rows: (id, category_id, price, title, description) of the listings that can be suggested """
+        self.vocabulary = {}
+        ids, categories, prices, lengths, words, counts = [], [], [], [], [], []
+        for listing_id, category_id, price, title, description in rows:
+            listing_counts = word_counts(title, description)
+            ids.append(listing_id)
+            categories.append(category_id)
+            prices.append(float(price))
+            lengths.append(len(listing_counts))
+            for word, count in listing_counts.items():
+                words.append(self.vocabulary.setdefault(word, len(self.vocabulary)))
+                counts.append(count)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.categories = np.array(categories, dtype=np.int64)
+        self.prices = np.array(prices, dtype=np.float64)
+        words = np.array(words, dtype=np.int64)
+        listing_of_entry = np.repeat(np.arange(len(ids)), lengths)
+
+        document_frequency = np.bincount(words, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + len(ids)) / (1 + document_frequency)) + 1
+        self.idf[document_frequency > max(SIMILARITY_MAX_DOCUMENT_SHARE * len(ids), 10)] = 0
+        weights = (1 + np.log(np.array(counts, dtype=np.float64))) * self.idf[words]
+        norms = np.sqrt(np.bincount(listing_of_entry, weights=weights ** 2, minlength=len(ids)))
+        weights /= np.where(norms > 0, norms, 1)[listing_of_entry]
+
+        # Entries by listing: listing i's vector is entry_words/entry_weights[listing_start[i]:listing_start[i + 1]]
+        self.entry_words = words
+        self.entry_weights = weights
+        self.listing_start = np.concatenate(([0], np.cumsum(lengths)))
+        # Entries sorted by word: the listings with word w are posting_listings[word_start[w]:word_start[w + 1]]
+        order = np.argsort(words, kind="stable")
+        self.posting_listings = listing_of_entry[order]
+        self.posting_weights = weights[order]
+        self.word_start = np.concatenate(([0], np.cumsum(document_frequency)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def indexed_vector(self, row):
+        """ Returns the vector of the listing at this row of the index as (word ids, weights) """
+        start, end = self.listing_start[row], self.listing_start[row + 1]
+        return self.entry_words[start:end], self.entry_weights[start:end]
+
+    def vector(self, title, description):
+        """ Returns the TF-IDF vector of a text as (word ids, weights), words the index doesn't know are left out """
+        listing_counts = word_counts(title, description)
+        words = np.array(
+            [self.vocabulary[word] for word in listing_counts if word in self.vocabulary], dtype=np.int64
+        )
+        counts = np.array(
+            [count for word, count in listing_counts.items() if word in self.vocabulary], dtype=np.float64
+        )
+        weights = (1 + np.log(counts)) * self.idf[words] if len(words) else counts
+        norm = np.sqrt((weights ** 2).sum())
+        return words, weights / norm if norm > 0 else weights
+
+    def most_similar(self, listing_id, category_id, price, words, weights, limit=SIMILAR_LISTINGS_STORED):
+        """ Returns (ids, scores) of the most similar indexed listings, best first """
+        words, weights = words[weights > 0], weights[weights > 0]
+        if not len(words):
+            return [], []
+        starts, ends = self.word_start[words], self.word_start[words + 1]
+        # Every (listing, word) pair the listing shares with the query, scored in one go
+        positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        contributions = self.posting_weights[positions] * np.repeat(weights, ends - starts)
+        candidates, inverse = np.unique(self.posting_listings[positions], return_inverse=True)
+        text_scores = np.bincount(inverse, weights=contributions)
+
+        candidate_prices = self.prices[candidates]
+        price_proximity = np.minimum(candidate_prices, price) / np.maximum(candidate_prices, price)
+        scores = (
+            TEXT_WEIGHT * text_scores
+            + CATEGORY_WEIGHT * (self.categories[candidates] == category_id)
+            + PRICE_WEIGHT * price_proximity
+        )
+        scores[self.ids[candidates] == listing_id] = -np.inf
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[np.isfinite(scores[top])]
+        return self.ids[candidates[top]].tolist(), scores[top].round(4).tolist()
+
+
+def _save(cursor, neighbours):
+    """ neighbours: {listing_id: (similar ids, scores)} """
+    execute_values(
+        cursor,
+        """
+        INSERT INTO listing_similarities (listing_id, similar_ids, scores, computed_at)
+        VALUES %s
+        ON CONFLICT (listing_id) DO UPDATE
+        SET similar_ids = EXCLUDED.similar_ids, scores = EXCLUDED.scores, computed_at = EXCLUDED.computed_at;
+        """,
+        [(listing_id, ids, scores) for listing_id, (ids, scores) in neighbours.items()],
+        template="(%s, %s::bigint[], %s::real[], CURRENT_TIMESTAMP)",
+        page_size=1000,
+    )
+
+
+def load_index(connection):
+    """ Builds the index from the active listings, returns (index, a snapshot taken before they were read) """
+    with connection:
+        with connection.cursor() as cursor:
+            # Every transaction this snapshot sees is also seen by the read of the listings below
+            cursor.execute("SELECT pg_current_snapshot()::text;")
+            snapshot = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                SELECT id, category_id, price, title, description
+                FROM listings
+                WHERE status = 'active' AND deleted_at IS NULL;
+                """
+            )
+            rows = cursor.fetchall()
+    return SimilarityIndex(rows), snapshot
+
+
+def rebuild(connection):
+    """ Rebuilds the index and the neighbours of every active listing, returns the index for refresh_queued """
+    started = time.perf_counter()
+    index, snapshot = load_index(connection)
+    for batch_start in range(0, len(index), SIMILARITY_BATCH_SIZE):
+        neighbours = {}
+        for row in range(batch_start, min(batch_start + SIMILARITY_BATCH_SIZE, len(index))):
+            listing_id = int(index.ids[row])
+            words, weights = index.indexed_vector(row)
+            neighbours[listing_id] = index.most_similar(
+                listing_id, index.categories[row], index.prices[row], words, weights
+            )
+        # One transaction per batch, the API keeps reading the previous lists meanwhile
+        with connection:
+            with connection.cursor() as cursor:
+                _save(cursor, neighbours)
+    with connection:
+        with connection.cursor() as cursor:
+            # Only listings queued by transactions the rebuild saw are covered by it. A change that started
+            # before the read but committed after it stays queued, however long ago it was queued.
+            cursor.execute(
+                "DELETE FROM similarity_queue WHERE pg_visible_in_snapshot(queued_xid, %s::pg_snapshot);",
+                (snapshot,),
+            )
+            cursor.execute(
+                """
+                DELETE FROM listing_similarities s
+                WHERE NOT EXISTS (SELECT 1 FROM listings l WHERE l.id = s.listing_id AND l.deleted_at IS NULL);
+                """
+            )
+    metrics.observe("similarity.rebuild_seconds", time.perf_counter() - started)
+    return index
+
+
+def refresh_queued(connection, index, batch_size=SIMILARITY_BATCH_SIZE):
+    """ Works out the neighbours of up to batch_size queued listings in one transaction, returns how many """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM similarity_queue
+                WHERE listing_id IN (
+                    SELECT listing_id FROM similarity_queue
+                    ORDER BY queued_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING listing_id;
+                """,
+                (batch_size,),
+            )
+            queued_ids = [row[0] for row in cursor.fetchall()]
+            if not queued_ids:
+                return 0
+            cursor.execute(
+                """
+                SELECT id, category_id, price, title, description, status
+                FROM listings
+                WHERE id = ANY(%s) AND deleted_at IS NULL;
+                """,
+                (queued_ids,),
+            )
+            listings = cursor.fetchall()
+            # Deleted listings get no suggestions, and are filtered out of other listings' suggestions when read
+            cursor.execute(
+                "DELETE FROM listing_similarities WHERE listing_id = ANY(%s) AND NOT listing_id = ANY(%s);",
+                (queued_ids, [listing[0] for listing in listings]),
+            )
+
+            neighbours = {}
+            # similar id -> [(queued listing, score)], the queued listing may now belong in its list too
+            reverse = collections.defaultdict(list)
+            for listing_id, category_id, price, title, description, status in listings:
+                words, weights = index.vector(title, description)
+                ids, scores = index.most_similar(listing_id, category_id, float(price), words, weights)
+                neighbours[listing_id] = (ids, scores)
+                if status == "active":
+                    for similar_id, score in zip(ids, scores):
+                        reverse[similar_id].append((listing_id, score))
+            if neighbours:
+                _save(cursor, neighbours)
+            if reverse:
+                _merge_into_stored(cursor, reverse)
+    metrics.increment("similarity.refreshed", len(queued_ids))
+    return len(queued_ids)
+
+
+def _merge_into_stored(cursor, reverse):
+    cursor.execute(
+        """
+        SELECT listing_id, similar_ids, scores
+        FROM listing_similarities
+        WHERE listing_id = ANY(%s)
+        FOR UPDATE;
+        """,
+        (list(reverse),),
+    )
+    merged = {}
+    for listing_id, similar_ids, scores in cursor.fetchall():
+        combined = dict(zip(similar_ids, scores))
+        combined.update(reverse[listing_id])
+        best = sorted(combined.items(), key=lambda item: item[1], reverse=True)[:SIMILAR_LISTINGS_STORED]
+        merged[listing_id] = ([similar_id for similar_id, _ in best], [score for _, score in best])
+    if merged:
+        _save(cursor, merged)
+
+
+if __name__ == "__main__":
+    connection = get_connection()
+    try:
+        start = time.perf_counter()
+        index = rebuild(connection)
+        rebuilt_at = time.monotonic()
+        print(f"Rebuilt similar listings for {len(index)} listings in {time.perf_counter() - start:.2f}s")
+        while len(sys.argv) > 1 and sys.argv[1] == "loop":
+            time.sleep(SIMILARITY_POLL_SECONDS)
+            if time.monotonic() - rebuilt_at > SIMILARITY_REBUILD_SECONDS:
+                index = rebuild(connection)
+                rebuilt_at = time.monotonic()
+            refreshed = 0
+            while True:
+                batch = refresh_queued(connection, index)
+                refreshed += batch
+                if batch < SIMILARITY_BATCH_SIZE:
+                    break
+            if refreshed:
+                print(f"Refreshed similar listings for {refreshed} listings")
+    finally:
+        connection.close()
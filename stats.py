@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from db_setup import get_connection
+
+"""
+Keeps the daily stats tables up to date for the /stats endpoints.
+Each refresh only re-aggregates the days since the last refresh (minus a few days for rows that committed late),
+plus older days whose rows changed since, which the triggers on listings, transactions and payments
+queue in stats_changed_days. So it costs the same no matter how large those tables grow.
+
+Run once: python stats.py
+Run every STATS_REFRESH_SECONDS: python stats.py loop
+"""
+
+STATS_REFRESH_SECONDS = float(os.getenv("STATS_REFRESH_SECONDS", "60"))
+# Rows created in transactions that commit a while later, these days are always aggregated again.
+# Older days are only aggregated again when they are in stats_changed_days
+STATS_REPROCESS_DAYS = int(os.getenv("STATS_REPROCESS_DAYS", "2"))
+
+# name: (rollup table, query that aggregates the source rows from a day up to, not including, another day)
+ROLLUPS = {
+    "listings": (
+        "daily_listing_stats",
+        """
+        INSERT INTO daily_listing_stats (day, category_id, region, listings_created)
+        SELECT created_at::date, category_id, region, COUNT(*)
+        FROM listings
+        WHERE created_at >= %s AND created_at < %s
+        GROUP BY created_at::date, category_id, region;
+        """,
+    ),
+    "transactions": (
+        "daily_transaction_stats",
+        """
+        INSERT INTO daily_transaction_stats (day, status, transaction_count, total_amount)
+        SELECT created_at::date, status, COUNT(*), SUM(amount)
+        FROM transactions
+        WHERE created_at >= %s AND created_at < %s
+        GROUP BY created_at::date, status;
+        """,
+    ),
+    "payments": (
+        "daily_payment_stats",
+        """
+        INSERT INTO daily_payment_stats (day, payment_status, payment_count, total_amount)
+        SELECT paid_at::date, payment_status, COUNT(*), SUM(amount)
+        FROM payments
+        WHERE paid_at >= %s AND paid_at < %s
+        GROUP BY paid_at::date, payment_status;
+        """,
+    ),
+}
+
+
+def refresh_stats(connection):
+    """ Re-aggregates every rollup from its watermark and its changed days, returns the day each one was refreshed from """
+    refreshed_from = {}
+    for name, (table, aggregate_query) in ROLLUPS.items():
+        with connection:
+            with connection.cursor() as cursor:
+                # Lock the watermark row so two refreshes don't run the same rollup at once
+                cursor.execute(
+                    """
+                    INSERT INTO stats_watermarks (name, refreshed_up_to)
+                    VALUES (%s, '-infinity')
+                    ON CONFLICT (name) DO NOTHING;
+                    """,
+                    (name,),
+                )
+                cursor.execute(
+                    """
+                    SELECT refreshed_up_to, LOCALTIMESTAMP
+                    FROM stats_watermarks
+                    WHERE name = %s
+                    FOR UPDATE;
+                    """,
+                    (name,),
+                )
+                watermark, now = cursor.fetchone()
+                # First refresh: psycopg2 reads -infinity as datetime.min, aggregate everything
+                if watermark == datetime.min:
+                    from_day = None
+                else:
+                    from_day = watermark.date() - timedelta(days=STATS_REPROCESS_DAYS)
+                # Days queued by changes that haven't committed yet stay queued for the next refresh
+                cursor.execute("DELETE FROM stats_changed_days WHERE name = %s RETURNING day;", (name,))
+                changed_days = [row[0] for row in cursor.fetchall()]
+                if from_day is None:
+                    cursor.execute(f"DELETE FROM {table};")
+                    cursor.execute(aggregate_query, ("-infinity", "infinity"))
+                else:
+                    cursor.execute(f"DELETE FROM {table} WHERE day >= %s;", (from_day,))
+                    cursor.execute(aggregate_query, (from_day, "infinity"))
+                    for changed_day in sorted(day for day in changed_days if day < from_day):
+                        cursor.execute(f"DELETE FROM {table} WHERE day = %s;", (changed_day,))
+                        cursor.execute(aggregate_query, (changed_day, changed_day + timedelta(days=1)))
+                cursor.execute(
+                    "UPDATE stats_watermarks SET refreshed_up_to = %s WHERE name = %s;",
+                    (now, name),
+                )
+                refreshed_from[name] = from_day
+    return refreshed_from
+
+
+if __name__ == "__main__":
+    connection = get_connection()
+    try:
+        while True:
+            start = time.perf_counter()
+            refreshed_from = refresh_stats(connection)
+            print(f"Stats refreshed in {time.perf_counter() - start:.2f}s: {refreshed_from}")
+            if len(sys.argv) < 2 or sys.argv[1] != "loop":
+                break
+            time.sleep(STATS_REFRESH_SECONDS)
+    finally:
+        connection.close()
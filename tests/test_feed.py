@@ -0,0 +1,43 @@
+import numpy as np
+
+import feed
+
+
+def arrays(rows, *dtypes):
+    return feed._arrays(rows, *dtypes)
+
+
+def test_score_feeds_without_history_gets_popular_listings():
+    # A user who unwatched their only listing has no interactions, and nothing similar
+    user_ids = np.array([7], dtype=np.int64)
+    interactions = arrays([], np.int64, np.int64, np.int64, np.float64)
+    similar = arrays([], np.int64, np.int64, np.float64)
+    candidates = arrays([(10, 1, 1), (11, 2, 2), (12, 7, 1)], np.int64, np.int64, np.int64)
+    popular = (np.array([11, 10, 12], dtype=np.int64), np.array([1.0, 0.5, 0.2]))
+
+    feeds = feed.score_feeds(user_ids, interactions, similar, candidates, popular)
+
+    # Most popular first, and not their own listing
+    assert feeds[7][0] == [11, 10]
+
+
+def test_score_feeds_without_anything():
+    user_ids = np.array([7, 8], dtype=np.int64)
+    interactions = arrays([], np.int64, np.int64, np.int64, np.float64)
+    similar = arrays([], np.int64, np.int64, np.float64)
+    candidates = arrays([], np.int64, np.int64, np.int64)
+    popular = arrays([], np.int64, np.float64)
+
+    assert feed.score_feeds(user_ids, interactions, similar, candidates, popular) == {7: ([], []), 8: ([], [])}
+
+
+def test_score_feeds_leaves_out_watched_listings():
+    user_ids = np.array([7], dtype=np.int64)
+    interactions = arrays([(7, 10, 1, 1.0)], np.int64, np.int64, np.int64, np.float64)
+    similar = arrays([(7, 12, 0.9), (7, 11, 0.3)], np.int64, np.int64, np.float64)
+    candidates = arrays([(10, 1, 1), (11, 2, 2), (12, 3, 1)], np.int64, np.int64, np.int64)
+    popular = (np.array([10], dtype=np.int64), np.array([1.0]))
+
+    feeds = feed.score_feeds(user_ids, interactions, similar, candidates, popular)
+
+    assert feeds[7][0] == [12, 11]